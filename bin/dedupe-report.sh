@@ -14,17 +14,18 @@ from_address=${DATAGOV_DEDUPE_FROM_ADDRESS:-'no-reply+dedupe-report@data.gov'}
 # Log for this run.
 dedupe_run_log=$(mktemp)
 dedupe_report=$(mktemp)
+dedupe_metrics=$(mktemp)
 
 report_date=$(date +%Y-%m-%d)
 
 function cleanup () {
-  rm -rf "$dedupe_report" "$dedupe_run_log"
+  rm -rf "$dedupe_report" "$dedupe_run_log" "$dedupe_metrics"
 }
 
 trap cleanup EXIT
 
 # Run the script, appending to dedupe.log across runs as well as this run log.
-python duplicates-identifier-api.py 2>&1 | tee -a dedupe.log > "$dedupe_run_log"
+python duplicates-identifier-api.py --metrics-json "$dedupe_metrics" 2>&1 | tee -a dedupe.log > "$dedupe_run_log"
 
 # For the actual report, include errors, warnings, and non-zero summary items.
 grep -E 'ERROR|WARN|Summary' < "$dedupe_run_log" | grep -v 'duplicate_count=0' > "$dedupe_report"
@@ -41,6 +42,10 @@ This is datagov-dedupe reporting on the number of duplicate packages detected on
 
 $(cat "$dedupe_report")
 
+API requests for this run:
+
+$(python -m dedupe.metrics "$dedupe_metrics")
+
 --
 $(basename "$0") on $(hostname)
 https://github.com/GSA/datagov-dedupe
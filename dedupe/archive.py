@@ -0,0 +1,225 @@
+"""
+A compressed, indexed archive of removed packages. Packages are appended to a
+file of gzip frames (the file is still a valid gzip stream, so zcat works),
+and a SQLite index next to it maps package id, name and identifier to the
+frame holding each package, so one can be found without reading the rest.
+"""
+
+from __future__ import absolute_import
+
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from . import util
+
+log = logging.getLogger(__name__)
+
+# Packages per gzip frame. Frames are also cut on sync(), i.e. before each
+# purge, so a committing run gets smaller frames than a dry run.
+DEFAULT_FRAME_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    id TEXT NOT NULL,
+    name TEXT,
+    identifier TEXT,
+    organization TEXT,
+    run_id TEXT,
+    frame_offset INTEGER NOT NULL,
+    frame_size INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_id ON packages (id);
+CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+CREATE INDEX IF NOT EXISTS packages_identifier ON packages (identifier);
+CREATE INDEX IF NOT EXISTS packages_run_id ON packages (run_id);
+"""
+
+# Columns lookup() can search on
+LOOKUP_FIELDS = ("id", "name", "identifier", "run_id")
+
+
+def index_filename(filename):
+    return filename + ".index"
+
+
+def package_identifier(package):
+    """
+    The identifier the package was deduplicated on: the POD identifier, or
+    the guid for geospatial packages.
+    """
+    return util.get_package_extra(package, "identifier") or util.get_package_extra(package, "guid")
+
+
+class PackageArchive(object):
+    """
+    Appends removed packages to an archive, with the same add/sync/close
+    interface as RemovedPackageLog so the deduper can write to either. Safe to
+    share between dedupers in several threads.
+
+    Packages are buffered and written as a gzip frame every `frame_size`
+    packages or on sync(). A frame is written and fsync'd before it's added to
+    the index, so the index never points past the data.
+    """
+
+    def __init__(self, filename, run_id=None, frame_size=DEFAULT_FRAME_SIZE):
+        self.filename = filename
+        self.run_id = run_id
+        self.frame_size = frame_size
+        self._lock = threading.Lock()
+        self._pending = []
+
+        log.info("Opening removed package archive for writing filename=%s", filename)
+        self._f = open(filename, mode="ab")
+        self._db = sqlite3.connect(index_filename(filename), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def add(self, package):
+        log.debug("Saving package to removed package archive package=%s", package["id"])
+        with self._lock:
+            self._pending.append(package)
+            if len(self._pending) >= self.frame_size:
+                self._write_frame()
+
+    def sync(self):
+        with self._lock:
+            self._write_frame()
+
+    def close(self):
+        self.sync()
+        self._f.close()
+        self._db.close()
+
+    def _write_frame(self):
+        if not self._pending:
+            return
+
+        lines = "".join(json.dumps(package) + "\n" for package in self._pending)
+        frame = gzip.compress(lines.encode("utf8"))
+
+        self._f.seek(0, os.SEEK_END)
+        offset = self._f.tell()
+        self._f.write(frame)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO packages "
+                "(id, name, identifier, organization, run_id, frame_offset, frame_size, position) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        package["id"],
+                        package.get("name"),
+                        package_identifier(package),
+                        (package.get("organization") or {}).get("name"),
+                        self.run_id,
+                        offset,
+                        len(frame),
+                        position,
+                    )
+                    for position, package in enumerate(self._pending)
+                ],
+            )
+        self._pending = []
+
+
+class ArchiveReader(object):
+    """
+    Looks packages up in an archive through its index, decompressing only
+    the frames that hold them.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = open(filename, mode="rb")
+        self._db = sqlite3.connect(index_filename(filename))
+
+    def lookup(self, **fields):
+        """
+        Returns the archived packages matching all the given fields, e.g.
+        lookup(name="my-dataset") or lookup(run_id="20200101000000"), oldest
+        first. A package archived more than once is returned once per copy.
+        """
+        unknown = set(fields) - set(LOOKUP_FIELDS)
+        if unknown or not fields:
+            raise ValueError("Look up packages by one or more of %s" % ", ".join(LOOKUP_FIELDS))
+
+        columns = sorted(fields)
+        rows = self._db.execute(
+            "SELECT frame_offset, frame_size, position FROM packages WHERE %s "
+            "ORDER BY rowid" % " AND ".join("%s = ?" % column for column in columns),
+            [fields[column] for column in columns],
+        ).fetchall()
+
+        packages = []
+        frames = {}
+        for offset, size, position in rows:
+            if offset not in frames:
+                frames[offset] = self._read_frame(offset, size)
+            packages.append(frames[offset][position])
+        return packages
+
+    def _read_frame(self, offset, size):
+        self._f.seek(offset)
+        lines = gzip.decompress(self._f.read(size)).decode("utf8").splitlines()
+        return [json.loads(line) for line in lines]
+
+    def close(self):
+        self._f.close()
+        self._db.close()
+
+
+def import_log(archive, filename):
+    """
+    Adds the packages from a RemovedPackageLog (JSON lines) file to the
+    archive. Returns the number of packages added.
+    """
+    count = 0
+    with codecs.open(filename, encoding="utf8") as f:
+        for line in f:
+            if line.strip():
+                archive.add(json.loads(line))
+                count += 1
+    return count
+
+
+def latest_packages(packages):
+    """
+    Keeps the last copy of each package id, in the order the ids first
+    appear. lookup() returns copies oldest first, so that's the latest one.
+    """
+    latest = {}
+    for package in packages:
+        latest[package["id"]] = package
+    return list(latest.values())
+
+
+def restore_packages(ckan_api, packages, workers=4):
+    """
+    Re-creates the packages in CKAN, `workers` at a time, each from its
+    latest copy when it was archived more than once. Returns the ids of the
+    packages that failed to restore; failures are logged and don't stop the
+    rest.
+    """
+    def restore(package):
+        log.info("Restoring package id=%s name=%s", package["id"], package.get("name"))
+        ckan_api.create_package(package)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(package, executor.submit(restore, package)) for package in latest_packages(packages)]
+        for package, future in futures:
+            try:
+                future.result()
+            except Exception:
+                log.exception("Failed to restore package id=%s", package["id"])
+                failed.append(package["id"])
+    return failed
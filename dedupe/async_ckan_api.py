@@ -0,0 +1,321 @@
+"""
+An asyncio CKAN API client. Queries are built the same way as the blocking
+CkanApiClient, but requests share a pooled aiohttp connector and up to
+`concurrency` of them can be in flight at once.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from .cache import action_for
+from .ckan_api import (
+    BaseCkanApiClient,
+    CkanApiCountException,
+    CkanApiFailureException,
+    CkanApiStatusException,
+)
+from .ratelimit import retry_delay
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 10
+
+
+class AsyncCkanApiClient(BaseCkanApiClient):
+    """
+    Represents an asyncio client to query and submit requests to the CKAN API.
+
+    Use it as an async context manager so the underlying connection pool is
+    closed when you're done:
+
+        async with AsyncCkanApiClient(api_url, api_key, concurrency=20) as api:
+            counts = await asyncio.gather(*[api.get_organization_count(org) for org in orgs])
+    """
+
+    def __init__(self, api_url, api_key, concurrency=DEFAULT_CONCURRENCY, **kwargs):
+        super(AsyncCkanApiClient, self).__init__(api_url, api_key, **kwargs)
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self):
+        if self._session is None:
+            headers = {}
+            if self.api_key:
+                headers["Authorization"] = self.api_key
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers=headers,
+                # Set the auth_tkt cookie to talk to admin API
+                cookies={"auth_tkt": "1"},
+                # Set a 60 second timeout for connections
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, path, **kwargs):
+        """
+        Issues the request and returns the decoded JSON body. At most
+        `concurrency` requests are in flight at any time.
+        """
+        self.check_dry_run(method)
+
+        limiter = self.limiter_for(method)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await asyncio.sleep(limiter.reserve())
+
+            async with self._semaphore:
+                replica = self.acquire_replica(method)
+                url = self.url_for(method, path, replica)
+                bytes_out = len(url) + len(json.dumps(kwargs["json"]) if "json" in kwargs else "")
+                started = time.monotonic()
+                try:
+                    async with self._get_session().request(method, url, **kwargs) as response:
+                        latency = time.monotonic() - started
+                        content = await response.read()
+                except aiohttp.ClientError as exc:
+                    self.release_replica(replica, ok=False)
+                    self.observe(method, path, "error", started, bytes_out=bytes_out)
+                    if replica is None or attempt >= self.max_retries:
+                        raise
+
+                    # Try the read again, likely on another replica
+                    delay = retry_delay(attempt)
+                    log.warning(
+                        "Retrying request error=%r url=%s attempt=%d delay=%.1f", exc, url, attempt + 1, delay
+                    )
+                    if self.metrics is not None:
+                        self.metrics.record_retry(action_for(path), method)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                except BaseException:
+                    # Timeouts, cancellation and the rest aren't retried, but
+                    # the replica is still given back
+                    self.release_replica(replica, ok=False)
+                    self.observe(method, path, "error", started, bytes_out=bytes_out)
+                    raise
+
+                self.release_replica(replica, latency, ok=response.status < 500)
+                self.observe(
+                    method,
+                    path,
+                    response.status,
+                    started,
+                    bytes_in=len(content),
+                    bytes_out=bytes_out,
+                )
+
+            if self.adapt_rate(method, response.status, latency, attempt):
+                delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                log.warning(
+                    "Retrying request status=%d path=%s attempt=%d delay=%.1f",
+                    response.status,
+                    path,
+                    attempt + 1,
+                    delay,
+                )
+                if self.metrics is not None:
+                    self.metrics.record_retry(action_for(path), method)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            break
+
+        if response.status >= 400:
+            log.error(
+                "Unsuccessful status code status=%d body=%s",
+                response.status,
+                content,
+            )
+            raise CkanApiStatusException(
+                "Unsuccessful status code %d" % response.status, response
+            )
+
+        data = json.loads(content)
+
+        if not data.get("success", False):
+            log.error("API failure status=%d body=%s", response.status, content)
+            raise CkanApiFailureException("API reported failure", response)
+
+        return data
+
+    async def get(self, path, **kwargs):
+        data = self.cached(path, kwargs.get("params"))
+        if data is not None:
+            return data
+
+        data = await self.request("GET", path, **kwargs)
+        self.store(path, kwargs.get("params"), data)
+        return data
+
+    async def get_dataset(
+        self, organization_name, identifier, is_collection, sort_order="asc"
+    ):
+        filter_query = self.identifier_filter_query(
+            organization_name, identifier, is_collection
+        )
+
+        rows = 1
+        data = await self.get(
+            "/action/package_search",
+            params={
+                "fq": filter_query,
+                "sort": "metadata_modified " + sort_order,
+                "rows": rows,
+            },
+        )
+
+        results = data["result"]["results"]
+
+        if len(results) != rows:
+            raise CkanApiCountException(
+                "Query reported non-zero count but no data "
+                "count=%(count)s results=%(results)s"
+                % {
+                    "count": data["result"]["count"],
+                    "results": len(results),
+                },
+                None,
+            )
+
+        return results[0]
+
+    async def get_duplicate_identifiers(
+        self, organization_name, is_collection, full_count=False
+    ):
+        filter_query = self.organization_filter_query(organization_name, is_collection)
+
+        data = await self.get(
+            "/3/action/package_search",
+            params=self.duplicate_facet_params(filter_query),
+        )
+
+        dupes = data["result"]["facets"][self.identifier_type]
+
+        # If we want not just the identifiers, but also the counts
+        if full_count:
+            return dupes
+
+        return self.sort_identifiers(dupes)
+
+    async def get_duplicate_facets(
+        self, filter_query, identifier_types=("identifier", "guid")
+    ):
+        """
+        Returns the duplicate identifiers of each type matching the filter,
+        e.g. an organization_filter_query, with their counts, from a single
+        facet query.
+        """
+        data = await self.get(
+            "/3/action/package_search",
+            params=self.duplicate_facet_params(filter_query, identifier_types),
+        )
+
+        facets = data["result"]["facets"]
+        return dict(
+            (identifier_type, facets.get(identifier_type, {}))
+            for identifier_type in identifier_types
+        )
+
+    async def get_dataset_count(self, organization_name, identifier, is_collection):
+        filter_query = self.identifier_filter_query(
+            organization_name, identifier, is_collection
+        )
+
+        data = await self.get(
+            "/action/package_search",
+            params={
+                "fq": filter_query,
+                "rows": 0,
+            },
+        )
+
+        return data["result"]["count"]
+
+    async def get_datasets(
+        self, organization_name, identifier, start=0, rows=1000, is_collection=False
+    ):
+        filter_query = self.identifier_filter_query(
+            organization_name, identifier, is_collection
+        )
+
+        data = await self.get(
+            "/action/package_search",
+            params={
+                "fq": filter_query,
+                "start": start,
+                "rows": rows,
+            },
+        )
+
+        return data["result"]["results"]
+
+    async def get_organizations(self):
+        data = await self.get("/action/organization_list")
+        return data["result"]
+
+    async def get_facet_totals(self, field):
+        """
+        Returns the number of packages for each value of the field, e.g.
+        each organization, from a single catalog-wide facet query.
+        """
+        data = await self.get(
+            "/action/package_search", params=self.facet_totals_params(field)
+        )
+        return data["result"]["facets"][field]
+
+    async def get_organization_totals(self):
+        return await self.get_facet_totals("organization")
+
+    async def get_harvest_source_totals(self):
+        return await self.get_facet_totals("harvest_source_title")
+
+    async def get_organization_count(self, organization_name):
+        data = await self.get(
+            "/action/package_search",
+            params={"q": "organization:%s" % organization_name, "rows": 0},
+        )
+        return data["result"]["count"]
+
+    async def remove_package(self, package_id):
+        if self.dry_run:
+            log.info("Not removing package in dry_run package=%s", package_id)
+            return
+
+        await self.request(
+            "POST",
+            "/action/dataset_purge",
+            json={
+                "id": package_id,
+            },
+        )
+        self.invalidate(package_id)
+
+    async def update_package(self, package):
+        if self.dry_run:
+            log.info("Not updating package in dry_run package=%s", package["id"])
+            return
+
+        await self.request("POST", "/action/package_update", json=package)
+        self.invalidate(package["id"], package.get("name"))
@@ -1,4 +1,3 @@
-
 from __future__ import absolute_import
 import codecs
 import unicodecsv as csv
@@ -6,14 +5,126 @@ from datetime import datetime
 import json
 import logging
 import os
+import queue
+import threading
+import time
 
 from . import util
 
 log = logging.getLogger(__name__)
 
+# By default, audit files are fsync'd every 100 records or every second
+DEFAULT_SYNC_EVERY = 100
+DEFAULT_SYNC_INTERVAL = 1.0
+
+# Queued by the timer to ask the writer thread for a sync
+_SYNC = object()
+
+
+class AuditFile(object):
+    '''
+    Wraps an open file so writes go through a background thread, which
+    fsyncs them in groups: after `sync_every` records or `sync_interval`
+    seconds, whichever comes first. This keeps the crash safety of syncing
+    each record without blocking the caller on a syscall per row.
+
+    Call sync() before doing something destructive that the records must
+    survive; it returns once everything written so far is on disk. close()
+    syncs the rest.
+    '''
+    def __init__(self, f, sync_every=DEFAULT_SYNC_EVERY, sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.f = f
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        if self.error:
+            raise IOError('Audit file writer failed: %r' % self.error)
+        self._queue.put(data)
+
+    def sync(self):
+        synced = threading.Event()
+        self._queue.put(synced)
+        synced.wait()
+        if self.error:
+            raise IOError('Audit file writer failed: %r' % self.error)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.f.close()
+
+    def _fsync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def _run(self):
+        unsynced = 0
+        last_synced = time.monotonic()
+        while True:
+            timeout = None
+            if unsynced:
+                timeout = max(0, last_synced + self.sync_interval - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = _SYNC
+
+            try:
+                if item is None or isinstance(item, threading.Event) or item is _SYNC:
+                    if unsynced or item is not _SYNC:
+                        self._fsync()
+                        unsynced = 0
+                        last_synced = time.monotonic()
+                elif not self.error:
+                    self.f.write(item)
+                    unsynced += 1
+                    if unsynced >= self.sync_every:
+                        self._fsync()
+                        unsynced = 0
+                        last_synced = time.monotonic()
+            except Exception as exc:
+                # Keep draining the queue so sync() callers aren't left waiting
+                log.exception('Failed to write audit file')
+                self.error = exc
+                unsynced = 0
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+
+def duplicate_package_row(duplicate_package, retained_package, api_url=None):
+    '''
+    Returns the duplicate package report row for a removed duplicate.
+    '''
+    return {
+        'duplicate_id': duplicate_package['id'],
+        'duplicate_identifier': util.get_package_extra(duplicate_package, 'identifier'),
+        'duplicate_is_collection': bool(util.get_package_extra(duplicate_package, 'collection_metadata')),
+        'duplicate_is_collection_member': bool(util.get_package_extra(duplicate_package, 'collection_package_id')),
+        'duplicate_metadata_created': duplicate_package['metadata_created'],
+        'duplicate_name': duplicate_package['name'],
+        'duplicate_source_hash': util.get_package_extra(duplicate_package, 'source_hash'),
+        'duplicate_harvest_source': util.get_package_extra(duplicate_package, 'harvest_source_id'),
+        'duplicate_title': duplicate_package['title'],
+        'duplicate_url': '%s/dataset/%s' % (api_url, duplicate_package['name']),
+        'organization': duplicate_package['organization']['name'],
+        'retained_id': retained_package['id'],
+        'retained_metadata_created': retained_package['metadata_created'],
+        'retained_harvest_source': util.get_package_extra(retained_package, 'harvest_source_id'),
+        'retained_url': '%s/dataset/%s' % (api_url, retained_package['name']),
+    }
+
 
 class RemovedPackageLog(object):
-    def __init__(self, filename=None, run_id=None):
+    def __init__(self, filename=None, run_id=None, sync_every=DEFAULT_SYNC_EVERY,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
         if not run_id:
             run_id = datetime.now().strftime('%Y%m%d%H%M%S')
 
@@ -21,15 +132,18 @@ class RemovedPackageLog(object):
             filename = 'removed-packages-%s.log' % run_id
 
         log.info('Opening removed packages log for writing filename=%s', filename)
-        self.log = codecs.open(filename, mode='w', encoding='utf8')
+        self.log = AuditFile(codecs.open(filename, mode='w', encoding='utf8'),
+                             sync_every=sync_every, sync_interval=sync_interval)
 
     def add(self, package):
         log.debug('Saving package to removed package log package=%s', package['id'])
         self.log.write(json.dumps(package) + '\n')
 
-        # Persist the write to disk
-        self.log.flush()
-        os.fsync(self.log.fileno())
+    def sync(self):
+        self.log.sync()
+
+    def close(self):
+        self.log.close()
 
 
 class DuplicatePackageLog(object):
@@ -52,7 +166,8 @@ class DuplicatePackageLog(object):
         'retained_harvest_source',          # Retained harvest_source_id (in CKAN extra)
     ]
 
-    def __init__(self, filename=None, api_url=None, run_id=None):
+    def __init__(self, filename=None, api_url=None, run_id=None, sync_every=DEFAULT_SYNC_EVERY,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
         self.api_url = api_url
 
         if not run_id:
@@ -62,31 +177,21 @@ class DuplicatePackageLog(object):
             filename = 'duplicate-packages-%s.csv' % run_id
 
         log.info('Opening duplicate package report for writing filename=%s', filename)
-        self.__f = open(filename, mode='wb')
+        self.__f = AuditFile(open(filename, mode='wb'), sync_every=sync_every, sync_interval=sync_interval)
         self.log = csv.DictWriter(self.__f,
                                   encoding='utf-8', fieldnames=DuplicatePackageLog.fieldnames)
         self.log.writeheader()
+        # Dedupers in several worker threads may share the report
+        self.lock = threading.Lock()
 
     def add(self, duplicate_package, retained_package):
         log.debug('Recording duplicate package to report package=%s', duplicate_package['id'])
-        self.log.writerow({
-            'duplicate_id': duplicate_package['id'],
-            'duplicate_identifier': util.get_package_extra(duplicate_package, 'identifier'),
-            'duplicate_is_collection': bool(util.get_package_extra(duplicate_package, 'collection_metadata')),
-            'duplicate_is_collection_member': bool(util.get_package_extra(duplicate_package, 'collection_package_id')),
-            'duplicate_metadata_created': duplicate_package['metadata_created'],
-            'duplicate_name': duplicate_package['name'],
-            'duplicate_source_hash': util.get_package_extra(duplicate_package, 'source_hash'),
-            'duplicate_harvest_source': util.get_package_extra(duplicate_package, 'harvest_source_id'),
-            'duplicate_title': duplicate_package['title'],
-            'duplicate_url': '%s/dataset/%s' % (self.api_url, duplicate_package['name']),
-            'organization': duplicate_package['organization']['name'],
-            'retained_id': retained_package['id'],
-            'retained_metadata_created': retained_package['metadata_created'],
-            'retained_harvest_source': util.get_package_extra(retained_package, 'harvest_source_id'),
-            'retained_url': '%s/dataset/%s' % (self.api_url, retained_package['name']),
-        })
-
-        # Persist the write to disk
-        self.__f.flush()
-        os.fsync(self.__f.fileno())
+        row = duplicate_package_row(duplicate_package, retained_package, self.api_url)
+        with self.lock:
+            self.log.writerow(row)
+
+    def sync(self):
+        self.__f.sync()
+
+    def close(self):
+        self.__f.close()
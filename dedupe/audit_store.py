@@ -0,0 +1,277 @@
+"""
+A SQLite audit store shared by every run, as an alternative to the per-run
+duplicate package report and removed package log. Rows are indexed by
+package id, identifier, organization, harvest source and run id, so "when
+was this package removed, and what was kept instead?" is one query.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import json
+import sys
+import sqlite3
+import threading
+import time
+
+import unicodecsv as csv
+
+from . import util
+from .audit import DuplicatePackageLog, duplicate_package_row
+
+# Rows are inserted in batches of this many, one transaction each
+DEFAULT_BATCH_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS duplicates (
+    run_id TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    %s
+);
+CREATE INDEX IF NOT EXISTS duplicates_duplicate_id ON duplicates (duplicate_id);
+CREATE INDEX IF NOT EXISTS duplicates_retained_id ON duplicates (retained_id);
+CREATE INDEX IF NOT EXISTS duplicates_identifier ON duplicates (duplicate_identifier);
+CREATE INDEX IF NOT EXISTS duplicates_organization ON duplicates (organization);
+CREATE INDEX IF NOT EXISTS duplicates_harvest_source ON duplicates (duplicate_harvest_source);
+CREATE INDEX IF NOT EXISTS duplicates_run_id ON duplicates (run_id);
+
+CREATE TABLE IF NOT EXISTS removed (
+    run_id TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    package_id TEXT NOT NULL,
+    name TEXT,
+    identifier TEXT,
+    organization TEXT,
+    harvest_source TEXT,
+    package TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS removed_package_id ON removed (package_id);
+CREATE INDEX IF NOT EXISTS removed_identifier ON removed (identifier);
+CREATE INDEX IF NOT EXISTS removed_organization ON removed (organization);
+CREATE INDEX IF NOT EXISTS removed_harvest_source ON removed (harvest_source);
+CREATE INDEX IF NOT EXISTS removed_run_id ON removed (run_id);
+""" % ",\n    ".join("%s TEXT" % field for field in DuplicatePackageLog.fieldnames)
+
+REMOVED_COLUMNS = ("run_id", "recorded", "package_id", "name", "identifier", "organization",
+                   "harvest_source", "package")
+
+
+class AuditStore(object):
+    """
+    SQLite database of duplicate and removed packages across runs. Safe to
+    share between dedupers in several threads.
+
+    Rows are buffered and inserted `batch_size` at a time in a single
+    transaction, or when a row is added `sync_interval` seconds or more after
+    the last insert. sync() inserts whatever is buffered, and the database
+    runs with synchronous=FULL, so a synced row survives a crash; the deduper
+    syncs before every purge.
+    """
+
+    def __init__(self, filename, run_id, batch_size=DEFAULT_BATCH_SIZE, sync_interval=None):
+        self.filename = filename
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._duplicates = []
+        self._removed = []
+        self._flushed = time.monotonic()
+
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.executescript(SCHEMA)
+
+    def duplicate_log(self, api_url=None):
+        """
+        Returns a view of the store that can stand in for DuplicatePackageLog.
+        """
+        return StoreDuplicatePackageLog(self, api_url)
+
+    def removed_log(self):
+        """
+        Returns a view of the store that can stand in for RemovedPackageLog.
+        """
+        return StoreRemovedPackageLog(self)
+
+    def add_duplicate(self, row):
+        with self._lock:
+            self._duplicates.append(row)
+            self._flush_if_full()
+
+    def add_removed(self, package):
+        organization = package.get("organization") or {}
+        row = (
+            self.run_id,
+            time.time(),
+            package["id"],
+            package.get("name"),
+            util.get_package_extra(package, "identifier") or util.get_package_extra(package, "guid"),
+            organization.get("name"),
+            util.get_package_extra(package, "harvest_source_id"),
+            json.dumps(package),
+        )
+        with self._lock:
+            self._removed.append(row)
+            self._flush_if_full()
+
+    def sync(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.sync()
+        self._db.close()
+
+    def _flush_if_full(self):
+        if len(self._duplicates) + len(self._removed) >= self.batch_size:
+            self._flush()
+        elif self.sync_interval is not None and time.monotonic() - self._flushed >= self.sync_interval:
+            self._flush()
+
+    def _flush(self):
+        if not self._duplicates and not self._removed:
+            return
+
+        columns = ("run_id", "recorded") + tuple(DuplicatePackageLog.fieldnames)
+        recorded = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO duplicates (%s) VALUES (%s)" % (", ".join(columns), ", ".join("?" * len(columns))),
+                [
+                    (self.run_id, recorded) + tuple(_text(row[field]) for field in DuplicatePackageLog.fieldnames)
+                    for row in self._duplicates
+                ],
+            )
+            self._db.executemany(
+                "INSERT INTO removed (%s) VALUES (%s)"
+                % (", ".join(REMOVED_COLUMNS), ", ".join("?" * len(REMOVED_COLUMNS))),
+                self._removed,
+            )
+        self._duplicates = []
+        self._removed = []
+        self._flushed = time.monotonic()
+
+
+def _text(value):
+    # Keep booleans as the CSV report writes them
+    return str(value) if isinstance(value, bool) else value
+
+
+class StoreDuplicatePackageLog(object):
+    def __init__(self, store, api_url=None):
+        self.store = store
+        self.api_url = api_url
+
+    def add(self, duplicate_package, retained_package):
+        self.store.add_duplicate(duplicate_package_row(duplicate_package, retained_package, self.api_url))
+
+    def sync(self):
+        self.store.sync()
+
+    def close(self):
+        # The store itself is closed by its owner
+        self.store.sync()
+
+
+class StoreRemovedPackageLog(object):
+    def __init__(self, store):
+        self.store = store
+
+    def add(self, package):
+        self.store.add_removed(package)
+
+    def sync(self):
+        self.store.sync()
+
+    def close(self):
+        self.store.sync()
+
+
+def _where(filters):
+    filters = dict((column, value) for column, value in filters.items() if value is not None)
+    if not filters:
+        return "", []
+    columns = sorted(filters)
+    return " WHERE " + " AND ".join("%s = ?" % column for column in columns), [filters[c] for c in columns]
+
+
+def export_duplicates(filename, f, run_id=None, organization=None):
+    """
+    Writes duplicates from the store to f (opened in binary mode) as a
+    duplicate package report CSV.
+    """
+    where, params = _where({"run_id": run_id, "organization": organization})
+    db = sqlite3.connect(filename)
+    try:
+        writer = csv.DictWriter(f, encoding="utf-8", fieldnames=DuplicatePackageLog.fieldnames)
+        writer.writeheader()
+        cursor = db.execute(
+            "SELECT %s FROM duplicates%s ORDER BY rowid" % (", ".join(DuplicatePackageLog.fieldnames), where),
+            params,
+        )
+        for row in cursor:
+            writer.writerow(dict(zip(DuplicatePackageLog.fieldnames, row)))
+    finally:
+        db.close()
+
+
+def export_removed(filename, f, run_id=None, organization=None):
+    """
+    Writes removed packages from the store to f as a removed package log,
+    one JSON package per line.
+    """
+    where, params = _where({"run_id": run_id, "organization": organization})
+    db = sqlite3.connect(filename)
+    try:
+        for (package,) in db.execute("SELECT package FROM removed%s ORDER BY rowid" % where, params):
+            f.write(package + "\n")
+    finally:
+        db.close()
+
+
+def package_history(filename, package_id):
+    """
+    Returns every duplicate report row where the package was the duplicate
+    or the retained package, oldest first, with the run id and the time it
+    was recorded.
+    """
+    columns = ["run_id", "recorded"] + DuplicatePackageLog.fieldnames
+    db = sqlite3.connect(filename)
+    try:
+        rows = db.execute(
+            "SELECT %s FROM duplicates WHERE duplicate_id = ? "
+            "UNION ALL SELECT %s FROM duplicates WHERE retained_id = ? "
+            "ORDER BY recorded" % (", ".join(columns), ", ".join(columns)),
+            (package_id, package_id),
+        ).fetchall()
+    finally:
+        db.close()
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queries and exports an audit store.")
+    parser.add_argument("store", help="Path to the audit store database.")
+    parser.add_argument("command", choices=("duplicates", "removed", "history"),
+                        help="duplicates: the report as CSV, removed: removed packages as JSON lines, "
+                             "history: duplicate rows for --package-id as JSON lines.")
+    parser.add_argument("--run-id", default=None, help="Only export this run.")
+    parser.add_argument("--organization", default=None, help="Only export this organization.")
+    parser.add_argument("--package-id", default=None, help="The package to show the history of.")
+    args = parser.parse_args()
+
+    if args.command == "duplicates":
+        export_duplicates(args.store, sys.stdout.buffer, run_id=args.run_id, organization=args.organization)
+    elif args.command == "removed":
+        export_removed(args.store, sys.stdout, run_id=args.run_id, organization=args.organization)
+    else:
+        if not args.package_id:
+            parser.error("history needs --package-id")
+        for row in package_history(args.store, args.package_id):
+            sys.stdout.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+A persistent on-disk cache for CKAN API GET responses, so re-running reports
+against the same catalog doesn't re-fetch everything.
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+log = logging.getLogger(__name__)
+
+# Seconds to keep responses for each CKAN action. Listings of organizations
+# and harvest sources rarely change; searches go stale as harvests run.
+DEFAULT_TTLS = {
+    "organization_list": 24 * 60 * 60,
+    "package_search": 60 * 60,
+    "package_show": 10 * 60,
+}
+DEFAULT_TTL = 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    action TEXT NOT NULL,
+    data TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    aggregate INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS entry_packages (
+    key TEXT NOT NULL,
+    package TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entry_packages_package ON entry_packages (package);
+CREATE INDEX IF NOT EXISTS entry_packages_key ON entry_packages (key);
+"""
+
+
+def action_for(path):
+    """
+    Returns the CKAN action name for an API path, e.g. package_search for
+    /3/action/package_search?q=...
+    """
+    return urlsplit(path).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def cache_key(path, params=None, base_url=None):
+    """
+    Normalizes the path and params (including any inline query string) into a
+    stable key, so the same query always hits the same entry. The base URL of
+    the CKAN instance is part of the key, so one cache file can be shared by
+    runs against different instances (e.g. staging and production).
+    """
+    url = urlsplit(path)
+    items = parse_qsl(url.query, keep_blank_values=True)
+    for name, value in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            items.extend((name, str(v)) for v in value)
+        else:
+            items.append((name, str(value)))
+    return json.dumps([base_url, action_for(path), sorted(items)])
+
+
+def referenced_packages(data, params=None):
+    """
+    Returns the ids and names of packages a response refers to, so the entry
+    can be invalidated when one of them is written.
+    """
+    packages = set()
+    result = data.get("result")
+    if isinstance(result, dict):
+        for package in result.get("results") or []:
+            if isinstance(package, dict):
+                packages.update(
+                    package[field] for field in ("id", "name") if package.get(field)
+                )
+        packages.update(result[field] for field in ("id", "name") if result.get(field))
+    if params and params.get("id"):
+        packages.add(params["id"])
+    return packages
+
+
+class ReadCache(object):
+    """
+    SQLite-backed cache of decoded CKAN GET responses, keyed on the normalized
+    path and params. Entries expire after a per-action TTL and the least
+    recently used entries are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, filename, ttls=None, default_ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        log.info("Opening read cache filename=%s", filename)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def ttl_for(self, action):
+        return self.ttls.get(action, self.default_ttl)
+
+    def get(self, path, params=None, base_url=None):
+        """
+        Returns the cached response data, or None on a miss or expired entry.
+        """
+        key = cache_key(path, params, base_url)
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT data, expires FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            data, expires = row
+            if expires < now:
+                self._delete(key)
+                return None
+
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+
+        log.debug("Read cache hit key=%s", key)
+        return json.loads(data)
+
+    def set(self, path, params, data, base_url=None):
+        key = cache_key(path, params, base_url)
+        action = action_for(path)
+        serialized = json.dumps(data)
+        packages = referenced_packages(data, params)
+        now = time.time()
+
+        with self._lock, self._db:
+            self._delete(key)
+            self._db.execute(
+                "INSERT INTO entries (key, action, data, size, aggregate, expires, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, action, serialized, len(serialized), not packages, now + self.ttl_for(action), now),
+            )
+            self._db.executemany(
+                "INSERT INTO entry_packages (key, package) VALUES (?, ?)",
+                [(key, package) for package in packages],
+            )
+            self._evict()
+
+    def invalidate_package(self, *packages):
+        """
+        Drops every entry that refers to one of the given package ids or
+        names. Counts and facets don't list packages but change with any
+        write, so searches without package results are dropped too.
+        """
+        with self._lock, self._db:
+            keys = set(
+                row[0]
+                for package in packages
+                if package
+                for row in self._db.execute(
+                    "SELECT key FROM entry_packages WHERE package = ?", (package,)
+                )
+            )
+            keys.update(
+                row[0]
+                for row in self._db.execute(
+                    "SELECT key FROM entries WHERE action = 'package_search' AND aggregate"
+                )
+            )
+            for key in keys:
+                self._delete(key)
+
+        log.debug("Invalidated read cache entries packages=%r count=%d", packages, len(keys))
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entries")
+            self._db.execute("DELETE FROM entry_packages")
+
+    def close(self):
+        self._db.close()
+
+    def _delete(self, key):
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._db.execute("DELETE FROM entry_packages WHERE key = ?", (key,))
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.max_bytes:
+            key, size = self._db.execute(
+                "SELECT key, size FROM entries ORDER BY accessed LIMIT 1"
+            ).fetchone()
+            self._delete(key)
+            total -= size
@@ -1,13 +1,42 @@
 from __future__ import absolute_import
 
 import logging
+import threading
+import time
 
+import ijson
 import requests
+from urllib3.util.retry import Retry
+
+from . import util
+from .cache import action_for
+from .replicas import ReplicaPool
+from .ratelimit import RETRY_STATUSES, THROTTLE_STATUSES, retry_delay
 
 log = logging.getLogger(__name__)
 
 READ_ONLY_METHODS = ["GET"]
 
+# Package fields read by the deduper and audit logs. With projection enabled,
+# searches request only these instead of full package bodies.
+PROJECTED_PACKAGE_FIELDS = [
+    "id",
+    "name",
+    "title",
+    "metadata_created",
+    "metadata_modified",
+    "organization",
+]
+PROJECTED_PACKAGE_EXTRAS = [
+    "identifier",
+    "guid",
+    "source_hash",
+    "harvest_source_id",
+    "collection_package_id",
+    "collection_metadata",
+    "datagov_dedupe",
+]
+
 
 class CkanApiException(Exception):
     def __init__(self, message, response):
@@ -51,9 +80,75 @@ class DryRunException(Exception):
     pass
 
 
-class CkanApiClient(object):
+def unflatten_projected_package(doc):
     """
-    Represents a client to query and submit requests to the CKAN API.
+    Converts a projected Solr document back into the shape of a package dict
+    (organization dict, extras list) so callers can treat it like a package.
+    """
+    package = dict(
+        (field, doc[field]) for field in PROJECTED_PACKAGE_FIELDS if field in doc
+    )
+    package["organization"] = {"name": doc.get("organization")}
+    package["extras"] = [
+        dict(key=key, value=doc["extras_" + key])
+        for key in PROJECTED_PACKAGE_EXTRAS
+        if doc.get("extras_" + key) is not None
+    ]
+    return package
+
+
+def connection_retries(response):
+    """
+    Returns how many times urllib3 retried the request at the connection
+    level (see HTTPAdapter max_retries).
+    """
+    history = getattr(getattr(response.raw, "retries", None), "history", None)
+    if not isinstance(history, tuple):
+        return 0
+    return len(history)
+
+
+class CountingReader(object):
+    """
+    Wraps a file-like response body and counts the bytes read from it.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class CkanApiResponse(object):
+    """
+    A successful CKAN API response. The JSON body is decoded exactly once, when
+    the response is checked for success, and kept on the object.
+    """
+
+    def __init__(self, response, data):
+        self.response = response
+        self.data = data
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def result(self):
+        return self.data["result"]
+
+    def json(self):
+        return self.data
+
+
+class BaseCkanApiClient(object):
+    """
+    Configuration and query building shared by the blocking and asyncio CKAN
+    API clients.
     """
 
     def __init__(
@@ -64,35 +159,312 @@ class CkanApiClient(object):
         identifier_type="identifier",
         api_read_url=None,
         reverse=False,
+        projection=False,
+        cache=None,
+        metrics=None,
+        read_limiter=None,
+        write_limiter=None,
+        max_retries=3,
     ):
         self.api_url = api_url
         if api_read_url is None:
-            self.api_read_url = api_url
+            api_read_url = api_url
+        # Reads can be spread over several read-only URLs
+        if isinstance(api_read_url, (list, tuple)):
+            read_urls = list(api_read_url)
         else:
-            self.api_read_url = api_read_url
+            read_urls = [api_read_url]
+        self.api_read_url = read_urls[0]
+        self.read_replicas = ReplicaPool(read_urls)
+        self.api_key = api_key
         self.dry_run = dry_run
         self.reverse = reverse
-        self.client = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=3)
-        self.client.mount("https://", adapter)
-        self.client.headers.update(Authorization=api_key)
-        # Set the auth_tkt cookie to talk to admin API
-        self.client.cookies = requests.cookies.cookiejar_from_dict(dict(auth_tkt="1"))
         self.identifier_type = identifier_type
-
-    def request(self, method, path, **kwargs):
+        self.projection = projection
+        self.cache = cache
+        self.metrics = metrics
+        self.read_limiter = read_limiter
+        self.write_limiter = write_limiter
+        self.max_retries = max_retries
+
+    def url_for(self, method, path, replica=None):
         if method == "POST":
-            url = "%s/api%s" % (self.api_url, path)
-        else:
-            url = "%s/api%s" % (self.api_read_url, path)
+            return "%s/api%s" % (self.api_url, path)
+        if replica is not None:
+            return "%s/api%s" % (replica.url, path)
+        return "%s/api%s" % (self.api_read_url, path)
+
+    def acquire_replica(self, method):
+        """
+        Picks the read replica for a GET. Writes stay pinned to api_url.
+        """
+        if method == "POST":
+            return None
+        return self.read_replicas.acquire()
+
+    def release_replica(self, replica, latency=None, ok=True):
+        if replica is not None:
+            self.read_replicas.release(replica, latency, ok)
 
+    def check_dry_run(self, method):
         if self.dry_run and method not in READ_ONLY_METHODS:
             raise DryRunException("Cannot call method in dry_run method=%s" % method)
 
+    def identifier_filter_query(self, organization_name, identifier, is_collection):
+        filter_query = '%s:"%s" AND organization:"%s" AND type:dataset' % (
+            self.identifier_type,
+            identifier,
+            organization_name,
+        )
+        if is_collection:
+            filter_query = "%s AND collection_package_id:*" % filter_query
+        return filter_query
+
+    def organization_filter_query(self, organization_name, is_collection):
+        filter_query = 'organization:"%s" AND type:dataset' % organization_name
+        if is_collection:
+            filter_query = "%s AND collection_package_id:*" % filter_query
+        return filter_query
+
+    def harvest_source_filter_query(self, harvest_source_title, is_collection):
+        filter_query = (
+            'harvest_source_title:"%s" AND type:dataset' % harvest_source_title
+        )
+        if is_collection:
+            filter_query = "%s AND collection_package_id:*" % filter_query
+        return filter_query
+
+    def duplicate_facet_params(self, filter_query, identifier_types=None):
+        """
+        Facets the identifiers with more than one package. Several identifier
+        types can be faceted in the same request.
+        """
+        if identifier_types is None:
+            identifier_types = [self.identifier_type]
+        return {
+            "fq": filter_query,
+            "facet.field": "[%s]" % ",".join('"%s"' % field for field in identifier_types),
+            "facet.limit": -1,
+            "facet.mincount": 2,
+            "rows": 0,
+        }
+
+    def limiter_for(self, method):
+        """
+        Reads and writes go to different URLs (api_read_url vs api_url), so
+        each has its own rate budget.
+        """
+        if method in READ_ONLY_METHODS:
+            return self.read_limiter
+        return self.write_limiter
+
+    def adapt_rate(self, method, status, latency, attempt):
+        """
+        Feeds the response to the rate limiter and returns True if the request
+        should be retried. Only idempotent (GET) requests are retried.
+        """
+        limiter = self.limiter_for(method)
+        if limiter is not None:
+            if status in THROTTLE_STATUSES:
+                limiter.throttled()
+            elif status < 500:
+                limiter.succeeded(latency)
+
+        if method not in READ_ONLY_METHODS or attempt >= self.max_retries:
+            return False
+        return status in RETRY_STATUSES
+
+    def observe(self, method, path, status, started, bytes_in=0, bytes_out=0, retries=0):
+        """
+        Records a request in the metrics, if enabled. `started` is the
+        time.monotonic() value from when the request was sent.
+        """
+        if self.metrics is not None:
+            self.metrics.record(
+                action_for(path),
+                method,
+                status,
+                time.monotonic() - started,
+                bytes_in=bytes_in,
+                bytes_out=bytes_out,
+                retries=retries,
+            )
+
+    def cached(self, path, params):
+        """
+        Returns the cached response data for a GET, or None.
+        """
+        if self.cache is None:
+            return None
+        # Read replicas serve the same instance, so key on its main URL
+        return self.cache.get(path, params, self.api_url)
+
+    def store(self, path, params, data):
+        if self.cache is not None:
+            self.cache.set(path, params, data, self.api_url)
+
+    def invalidate(self, *packages):
+        """
+        Drops cached responses touching the packages after they're written.
+        """
+        if self.cache is not None:
+            self.cache.invalidate_package(*packages)
+
+    def projected(self, params):
+        """
+        Adds the field list to package_search params when projection is
+        enabled. Fields are sent as a repeated parameter so CKAN sees a list.
+        """
+        if not self.projection:
+            return params
+
+        fields = PROJECTED_PACKAGE_FIELDS + [
+            "extras_" + key for key in PROJECTED_PACKAGE_EXTRAS
+        ]
+        return dict(params, fl=fields)
+
+    def package_results(self, results):
+        """
+        Normalizes projected search results. Works lazily when given a
+        generator of results.
+        """
+        if not self.projection:
+            return results
+        if isinstance(results, list):
+            return [unflatten_projected_package(result) for result in results]
+        return (unflatten_projected_package(result) for result in results)
+
+    def facet_totals_params(self, field):
+        return {
+            "facet.field": '["%s"]' % field,
+            "facet.limit": -1,
+            "rows": 0,
+        }
+
+    def sort_identifiers(self, dupes):
+        # If you want to run 2 scripts in parallel, run one version with normal sort
+        # and another with `--reverse` flag
+        return sorted(dupes, reverse=self.reverse)
+
+
+class CkanApiClient(BaseCkanApiClient):
+    """
+    Represents a client to query and submit requests to the CKAN API.
+    """
+
+    def __init__(self, api_url, api_key, pool_size=10, **kwargs):
+        super(CkanApiClient, self).__init__(api_url, api_key, **kwargs)
+        self.pool_size = pool_size
+        # requests sessions aren't thread-safe, and the client is shared by
+        # the identifier, collection and write-behind threads, so each thread
+        # gets its own session.
+        self._local = threading.local()
+
+    @property
+    def client(self):
+        """
+        The requests session for the current thread.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self.new_session()
+        return session
+
+    def new_session(self):
+        session = requests.Session()
+        # A thread can hold a streamed response open while it makes other
+        # requests, so keep a few connections instead of reconnecting
+        retries = Retry(total=3, read=False, backoff_factor=0.5)
+        adapter = requests.adapters.HTTPAdapter(max_retries=retries, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        # send() retries reads from separate replicas itself, likely on
+        # another replica, so they aren't retried here as well
+        for replica in self.read_replicas.replicas:
+            if replica.url != self.api_url:
+                session.mount(replica.url + "/",
+                              requests.adapters.HTTPAdapter(max_retries=0, pool_maxsize=self.pool_size))
+        session.headers.update(Authorization=self.api_key)
+        # Set the auth_tkt cookie to talk to admin API
+        session.cookies = requests.cookies.cookiejar_from_dict(dict(auth_tkt="1"))
+        return session
+
+    def send(self, method, path, **kwargs):
+        """
+        Sends the request and checks the status code, without decoding the
+        body.
+        """
+        self.check_dry_run(method)
+
         # Set a 60 second timeout for connections
         kwargs.setdefault("timeout", 60)
 
-        response = self.client.request(method, url, **kwargs)
+        limiter = self.limiter_for(method)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+
+            replica = self.acquire_replica(method)
+            url = self.url_for(method, path, replica)
+            started = time.monotonic()
+            try:
+                response = self.client.request(method, url, **kwargs)
+            except requests.RequestException as exc:
+                self.release_replica(replica, ok=False)
+                self.observe(method, path, "error", started)
+                # Requests to api_url were already retried by the adapter
+                if replica is None or replica.url == self.api_url or attempt >= self.max_retries:
+                    raise
+
+                # Try the read again, likely on another replica
+                delay = retry_delay(attempt)
+                log.warning(
+                    "Retrying request error=%r url=%s attempt=%d delay=%.1f", exc, url, attempt + 1, delay
+                )
+                if self.metrics is not None:
+                    self.metrics.record_retry(action_for(path), method)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Anything else isn't retried, but the replica is still given back
+                self.release_replica(replica, ok=False)
+                self.observe(method, path, "error", started)
+                raise
+
+            # Time to response headers, so big pages don't look like a slow server
+            latency = response.elapsed.total_seconds()
+            self.release_replica(replica, latency, ok=response.status_code < 500)
+
+            self.observe(
+                method,
+                path,
+                response.status_code,
+                started,
+                # Streamed bodies are counted as they're read
+                bytes_in=0 if kwargs.get("stream") else len(response.content),
+                bytes_out=len(response.request.url) + len(response.request.body or ""),
+                retries=connection_retries(response),
+            )
+
+            if self.adapt_rate(method, response.status_code, latency, attempt):
+                delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                log.warning(
+                    "Retrying request status=%d path=%s attempt=%d delay=%.1f",
+                    response.status_code,
+                    path,
+                    attempt + 1,
+                    delay,
+                )
+                if self.metrics is not None:
+                    self.metrics.record_retry(action_for(path), method)
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            break
+
         if response.status_code >= 400:
             log.error(
                 "Unsuccessful status code status=%d body=%s",
@@ -103,42 +475,88 @@ class CkanApiClient(object):
                 "Unsuccessful status code %d" % response.status_code, response
             )
 
-        if not response.json().get("success", False):
+        return response
+
+    def request(self, method, path, **kwargs):
+        response = self.send(method, path, **kwargs)
+        data = response.json()
+
+        if not data.get("success", False):
             log.error(
                 "API failure status=%d body=%s", response.status_code, response.content
             )
             raise CkanApiFailureException("API reported failure", response)
 
-        return response
+        return CkanApiResponse(response, data)
+
+    def request_stream(self, method, path, prefix="result.results.item", **kwargs):
+        """
+        Yields the items under `prefix` one at a time as the body is read,
+        without materializing the whole response. Used for large search pages.
+
+        CKAN reports failures with an error status, which send() checks before
+        any item is yielded. The body's success flag is checked as it's
+        parsed, and once more at the end in case it comes after the items.
+        """
+        response = self.send(method, path, stream=True, **kwargs)
+        # Let urllib3 handle gzip/deflate content encoding for us
+        response.raw.decode_content = True
+        body = CountingReader(response.raw)
+        success = []
+
+        def events():
+            for event in ijson.parse(body, use_float=True):
+                if event[0] == "success" and event[1] == "boolean":
+                    success.append(event[2])
+                    if not event[2]:
+                        break
+                yield event
+
+        try:
+            for item in ijson.items(events(), prefix):
+                yield item
+            if success != [True]:
+                log.error("API failure status=%d path=%s", response.status_code, path)
+                raise CkanApiFailureException("API reported failure", response)
+        finally:
+            response.close()
+            if self.metrics is not None:
+                self.metrics.record_bytes_in(action_for(path), method, body.bytes_read)
 
     def get(self, path, **kwargs):
-        return self.request("GET", path, **kwargs)
+        data = self.cached(path, kwargs.get("params"))
+        if data is not None:
+            return CkanApiResponse(None, data)
+
+        response = self.request("GET", path, **kwargs)
+        self.store(path, kwargs.get("params"), response.data)
+        return response
 
     def get_dataset(
         self, organization_name, identifier, is_collection, sort_order="asc"
     ):
-        filter_query = '%s:"%s" AND organization:"%s" AND type:dataset' % (
-            self.identifier_type,
-            identifier,
-            organization_name,
+        filter_query = self.identifier_filter_query(
+            organization_name, identifier, is_collection
         )
-        if is_collection:
-            filter_query = "%s AND collection_package_id:*" % filter_query
 
         rows = 1
-        response = self.get(
+        # Bypass the read cache, the retained package's body is written back
+        response = self.request(
+            "GET",
             "/action/package_search",
-            params={
-                "fq": filter_query,
-                "sort": "metadata_modified " + sort_order,
-                "rows": rows,
-            },
+            params=self.projected(
+                {
+                    "fq": filter_query,
+                    "sort": "metadata_modified " + sort_order,
+                    "rows": rows,
+                }
+            ),
         )
 
-        results = response.json()["result"]["results"]
+        results = self.package_results(response.result["results"])
 
         if len(results) != rows:
-            count = response.json()["result"]["count"]
+            count = response.result["count"]
             raise CkanApiCountException(
                 "Query reported non-zero count but no data "
                 "count=%(count)s results=%(results)s"
@@ -158,70 +576,135 @@ class CkanApiClient(object):
                 "id": name,
             },
         )
-        return response.json()["result"]
+        return response.result
+
+    def package_exists(self, package_id):
+        """
+        Checks the package is active in the database. A package that was
+        deleted but not purged is still shown, in the deleted state, so it
+        doesn't count. Not cached, since this is for catching drift between
+        Solr and the database.
+        """
+        package = self.get_package(package_id)
+        return package is not None and package.get("state") == "active"
+
+    def get_package(self, package_id):
+        """
+        Returns the current package from package_show, or None if it no
+        longer exists. Not cached, since the body is about to be written back.
+        """
+        try:
+            response = self.request("GET", "/action/package_show", params={"id": package_id})
+        except CkanApiStatusException as exc:
+            if getattr(exc.response, "status_code", None) == 404:
+                return None
+            raise
+        return response.result
+
+    def full_package(self, package):
+        """
+        Returns the full package body for a search result. Projected results
+        only carry a few fields, so before writing we fetch the whole package
+        with package_show. In dry-run nothing is written and the result is
+        returned as-is.
+        """
+        if not self.projection or self.dry_run:
+            return package
+
+        # Bypass the read cache, we're about to write this body back
+        response = self.request(
+            "GET", "/action/package_show", params={"id": package["id"]}
+        )
+        return response.result
+
+    def get_packages(self, package_ids, chunk_size=50):
+        """
+        Returns the current full packages for the given ids, keyed by id.
+        Packages that no longer exist are left out. Ids are OR'd together
+        `chunk_size` at a time, so checking a batch of packages costs a search
+        or two instead of a package_show each.
+        """
+        package_ids = list(package_ids)
+        packages = {}
+        for start in range(0, len(package_ids), chunk_size):
+            chunk = package_ids[start:start + chunk_size]
+            # Bypass the read cache, these bodies may be written back
+            response = self.request(
+                "GET",
+                "/action/package_search",
+                params={
+                    "fq": "id:(%s)" % " OR ".join('"%s"' % package_id for package_id in chunk),
+                    "rows": len(chunk),
+                },
+            )
+            packages.update(
+                (package["id"], package) for package in response.result["results"]
+            )
+        return packages
+
+    def find_indexed_names(self, names, chunk_size=50):
+        """
+        Returns the subset of the package names, of any type, that are in the
+        search index. Names are OR'd together `chunk_size` at a time.
+        """
+        names = list(names)
+        indexed = set()
+        for start in range(0, len(names), chunk_size):
+            chunk = names[start:start + chunk_size]
+            # Bypass the read cache, this is confirming what's indexed now
+            response = self.request(
+                "GET",
+                "/action/package_search",
+                params={
+                    # Name any dataset_type so CKAN doesn't limit the search to datasets
+                    "fq": "+dataset_type:* +name:(%s)" % " OR ".join('"%s"' % name for name in chunk),
+                    "fl": ["name"],
+                    "rows": len(chunk),
+                },
+            )
+            indexed.update(result["name"] for result in response.result["results"])
+        return indexed
 
     def get_duplicate_identifiers(
         self, organization_name, is_collection, full_count=False
     ):
-        filter_query = 'organization:"%s" AND type:dataset' % organization_name
-        if is_collection:
-            filter_query = "%s AND collection_package_id:*" % filter_query
+        filter_query = self.organization_filter_query(organization_name, is_collection)
 
         response = self.get(
             "/3/action/package_search",
-            params={
-                "fq": filter_query,
-                "facet.field": '["' + self.identifier_type + '"]',
-                "facet.limit": -1,
-                "facet.mincount": 2,
-                "rows": 0,
-            },
+            params=self.duplicate_facet_params(filter_query),
         )
 
-        dupes = response.json()["result"]["facets"][self.identifier_type]
+        dupes = response.result["facets"][self.identifier_type]
 
         # If we want not just the identifiers, but also the counts
         if full_count:
             return dupes
 
-        # If you want to run 2 scripts in parallel, run one version with normal sort
-        # and another with `--reverse` flag
-        return sorted(dupes, reverse=self.reverse)
+        return self.sort_identifiers(dupes)
 
     def get_duplicate_identifiers_source(
         self, harvest_source_title, is_collection, full_count=False
     ):
-        filter_query = (
-            'harvest_source_title:"%s" AND type:dataset' % harvest_source_title
+        filter_query = self.harvest_source_filter_query(
+            harvest_source_title, is_collection
         )
-        if is_collection:
-            filter_query = "%s AND collection_package_id:*" % filter_query
 
         response = self.get(
             "/3/action/package_search",
-            params={
-                "fq": filter_query,
-                "facet.field": '["' + self.identifier_type + '"]',
-                "facet.limit": -1,
-                "facet.mincount": 2,
-                "rows": 0,
-            },
+            params=self.duplicate_facet_params(filter_query),
         )
 
-        dupes = response.json()["result"]["facets"][self.identifier_type]
+        dupes = response.result["facets"][self.identifier_type]
 
         # If we want not just the identifiers, but also the counts
         if full_count:
             return dupes
 
     def get_dataset_count(self, organization_name, identifier, is_collection):
-        filter_query = '%s:"%s" AND organization:"%s" AND type:dataset' % (
-            self.identifier_type,
-            identifier,
-            organization_name,
+        filter_query = self.identifier_filter_query(
+            organization_name, identifier, is_collection
         )
-        if is_collection:
-            filter_query = "%s AND collection_package_id:*" % filter_query
 
         response = self.get(
             "/action/package_search",
@@ -232,46 +715,141 @@ class CkanApiClient(object):
             },
         )
 
-        return response.json()["result"]["count"]
+        return response.result["count"]
 
     def get_datasets_in_collection(self, package_id):
-        filter_query = "collection_package_id:%s" % package_id
-
-        response = self.get(
-            "/action/package_search",
-            params={
-                "fq": filter_query,
-                "sort": "metadata_created desc",
-                "rows": 0,
-            },
-        )
+        filter_query = 'collection_package_id:"%s"' % package_id
 
-        search_result = response.json()["result"]
-        if search_result["count"] > 0:
-            return search_result["results"]
+        datasets = list(self.iter_datasets(filter_query))
+        if datasets:
+            return datasets
         return None
 
+    def get_collection_index(self, organization_name):
+        """
+        Returns the ids of the organization's collection members keyed by the
+        collection_package_id they point at, from a single search that only
+        lists ids, so the index stays small for big organizations.
+        """
+        filter_query = self.organization_filter_query(organization_name, is_collection=True)
+
+        index = {}
+        for doc in self.iter_datasets(filter_query, fields=["id", "extras_collection_package_id"]):
+            collection_package_id = doc.get("extras_collection_package_id")
+            if collection_package_id:
+                index.setdefault(collection_package_id, []).append(doc["id"])
+        return index
+
     def get_datasets(
         self, organization_name, identifier, start=0, rows=1000, is_collection=False
     ):
-        filter_query = '%s:"%s" AND organization:"%s" AND type:dataset' % (
-            self.identifier_type,
-            identifier,
-            organization_name,
+        filter_query = self.identifier_filter_query(
+            organization_name, identifier, is_collection
         )
-        if is_collection:
-            filter_query = "%s AND collection_package_id:*" % filter_query
 
         response = self.get(
             "/action/package_search",
-            params={
-                "fq": filter_query,
-                "start": start,
-                "rows": rows,
-            },
+            params=self.projected(
+                {
+                    "fq": filter_query,
+                    "start": start,
+                    "rows": rows,
+                }
+            ),
         )
 
-        return response.json()["result"]["results"]
+        return self.package_results(response.result["results"])
+
+    def iter_datasets(self, fq, sort="id asc", batch=1000, fields=None, stream=False):
+        """
+        Yields every package matching the filter query, `batch` packages per
+        request. Each page is read in full before any of it is yielded, so no
+        response is held open while the caller writes to the API. Read-only
+        reports can pass stream=True to decode each page incrementally and
+        get packages as they arrive instead.
+
+        CKAN's package_search only passes whitelisted parameters through to
+        Solr, so cursorMark isn't available. Instead this uses keyset
+        pagination: results are sorted on the unique `id` field and each page
+        filters on ids past the last one seen, so every page costs the same no
+        matter how deep we are.
+
+        `fields` limits the results to those Solr fields (which must include
+        id), e.g. to list ids and names only. They're returned as is.
+        """
+        field, _, direction = sort.partition(" ")
+        if field != "id" or direction not in ("asc", "desc"):
+            raise ValueError("iter_datasets requires a sort on id, got sort=%s" % sort)
+
+        last_id = None
+        while True:
+            page_filter_query = fq
+            if last_id is not None:
+                if direction == "asc":
+                    id_range = 'id:{"%s" TO *]' % last_id
+                else:
+                    id_range = 'id:[* TO "%s"}' % last_id
+                page_filter_query = "(%s) AND %s" % (fq, id_range)
+
+            params = {
+                "fq": page_filter_query,
+                "sort": sort,
+                "rows": batch,
+            }
+            if fields is None:
+                params = self.projected(params)
+            else:
+                params["fl"] = list(fields)
+            if stream:
+                results = self.request_stream(
+                    "GET", "/action/package_search", params=params
+                )
+            else:
+                # Not cached: these packages are about to be written
+                results = self.request(
+                    "GET", "/action/package_search", params=params
+                ).result["results"]
+            if fields is None:
+                results = self.package_results(results)
+
+            count = 0
+            for result in results:
+                count += 1
+                last_id = result["id"]
+                yield result
+
+            if count < batch:
+                return
+
+    def iter_duplicate_groups(
+        self, organization_name, identifiers, is_collection, chunk_size=50
+    ):
+        """
+        Yields (identifier, packages) for each of the given duplicate
+        identifiers in the organization.
+
+        Rather than querying each identifier separately, identifiers are
+        OR'd together `chunk_size` at a time and the matching packages are
+        streamed with iter_datasets, then grouped locally on the identifier
+        extra. This costs a few large paged responses per organization
+        instead of several requests per identifier.
+        """
+        for start in range(0, len(identifiers), chunk_size):
+            chunk = identifiers[start:start + chunk_size]
+            filter_query = "%s AND %s:(%s)" % (
+                self.organization_filter_query(organization_name, is_collection),
+                self.identifier_type,
+                " OR ".join('"%s"' % identifier for identifier in chunk),
+            )
+
+            groups = dict((identifier, []) for identifier in chunk)
+            for package in self.iter_datasets(filter_query):
+                identifier = util.get_package_extra(package, self.identifier_type)
+                if identifier in groups:
+                    groups[identifier].append(package)
+
+            for identifier in chunk:
+                yield identifier, groups[identifier]
 
     def get_all_datasets(
         self, start=0, rows=1000, organization="*", is_collection=False
@@ -280,18 +858,29 @@ class CkanApiClient(object):
 
         response = self.get(
             "/action/package_search",
-            params={
-                "fq": filter_query,
-                "start": start,
-                "rows": rows,
-            },
+            params=self.projected(
+                {
+                    "fq": filter_query,
+                    "start": start,
+                    "rows": rows,
+                }
+            ),
         )
 
-        return response.json()["result"]["results"]
+        return self.package_results(response.result["results"])
+
+    def iter_package_names(self):
+        """
+        Streams the names of every active public package in the database, of
+        every type, from package_list. The names are read from a single
+        response, so they're one snapshot of the table rather than pages
+        that shift as packages are added and removed.
+        """
+        return self.request_stream("GET", "/action/package_list", prefix="result.item")
 
     def get_organizations(self):
         response = self.get("/action/organization_list")
-        return response.json()["result"]
+        return response.result
 
     def get_harvest_sources(self):
         start = 0
@@ -300,8 +889,8 @@ class CkanApiClient(object):
             response = self.get(
                 f"/action/package_search?fq=dataset_type:harvest&rows=1000&start={start}"
             )
-            harvest_sources += response.json()["result"]["results"]
-            if response.json()["result"]["count"] <= start + 1000:
+            harvest_sources += response.result["results"]
+            if response.result["count"] <= start + 1000:
                 break
             else:
                 start += 1000
@@ -312,14 +901,14 @@ class CkanApiClient(object):
         response = self.get(
             "/action/package_search?q=organization:%s&rows=0" % organization_name
         )
-        return response.json()["result"]["count"]
+        return response.result["count"]
 
     def get_harvest_source_count(self, harvest_source_title):
         response = self.get(
             '/action/package_search?q=harvest_source_title:"%s"&rows=0'
             % harvest_source_title
         )
-        return response.json()["result"]["count"]
+        return response.result["count"]
 
     def remove_package(self, package_id):
         if self.dry_run:
@@ -333,6 +922,7 @@ class CkanApiClient(object):
                 "id": package_id,
             },
         )
+        self.invalidate(package_id)
 
     def update_package(self, package):
         if self.dry_run:
@@ -340,3 +930,16 @@ class CkanApiClient(object):
             return
 
         self.request("POST", "/action/package_update", json=package)
+        self.invalidate(package["id"], package.get("name"))
+
+    def create_package(self, package):
+        """
+        Creates the package as given, keeping its id. Used to restore purged
+        packages, so it needs a sysadmin API key.
+        """
+        if self.dry_run:
+            log.info("Not creating package in dry_run package=%s", package["id"])
+            return
+
+        self.request("POST", "/action/package_create", json=package)
+        self.invalidate(package["id"], package.get("name"))
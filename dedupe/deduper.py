@@ -4,11 +4,16 @@ retained package and removes the rest.
 '''
 
 from __future__ import absolute_import
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 import itertools
 import logging
+import threading
 
-from .ckan_api import CkanApiFailureException, CkanApiCountException, CkanApiStatusException
+from .ckan_api import CkanApiException, CkanApiFailureException, CkanApiCountException, CkanApiStatusException
+from .journal import COMMITTED, PLANNED, PURGED
+from .plan import entry_package_ids, plan_entry, stale_reason
 from . import util
 
 module_log = logging.getLogger(__name__)
@@ -27,6 +32,37 @@ class ContextLoggerAdapter(logging.LoggerAdapter):
         return '%s %s' % (msg, kv_pairs), kwargs
 
 
+class PackageUpdate(object):
+    '''
+    Buffers changes to a package so they're written with a single
+    package_update, however many steps of the dedupe touch it.
+    '''
+    def __init__(self, package):
+        self.package = package
+        self.changed = set()
+
+    def set_extra(self, key, value=None):
+        if util.get_package_extra(self.package, key) != value:
+            util.set_package_extra(self.package, key, value)
+            self.changed.add(key)
+
+    def rename(self, name):
+        if name != self.package['name']:
+            self.package['name'] = name
+            self.changed.add('name')
+
+    def flush(self, ckan_api):
+        '''
+        Writes the buffered changes, if there are any. Returns the names of
+        the fields that were changed. If the write fails the changes stay
+        buffered, so flushing again retries them.
+        '''
+        if self.changed:
+            ckan_api.update_package(self.package)
+        changed, self.changed = self.changed, set()
+        return changed
+
+
 class Deduper(object):
     def __init__(self,
                  organization_name,
@@ -37,7 +73,17 @@ class Deduper(object):
                  run_id=None,
                  oldest=True,
                  update_name=False,
-                 identifier_type='identifier'):
+                 identifier_type='identifier',
+                 grouped=False,
+                 identifier_workers=1,
+                 plan=None,
+                 journal=None,
+                 mark_retained=True,
+                 collection_workers=4,
+                 writer=None,
+                 prefetch=0,
+                 prefetch_max_packages=1000,
+                 shard=None):
         self.organization_name = organization_name
         self.ckan_api = ckan_api
         self.log = ContextLoggerAdapter(module_log, {'organization': organization_name})
@@ -48,6 +94,34 @@ class Deduper(object):
         self.oldest = oldest
         self.update_name = update_name
         self.identifier_type = identifier_type
+        self.grouped = grouped
+        # Number of identifiers to deduplicate at once
+        self.identifier_workers = identifier_workers
+        # PlanWriter to record the changes to, instead of making them
+        self.plan = plan
+        # Journal to checkpoint group states to, for resuming the run
+        self.journal = journal
+        # Whether to record the run on retained packages (datagov_dedupe_retained).
+        # The journal keeps that record locally instead.
+        self.mark_retained = mark_retained
+        # Number of collection members to re-point at once
+        self.collection_workers = collection_workers
+        # collection_package_id -> member package ids, built on first use
+        self._collection_index = None
+        # Collection members this deduper re-pointed, so applying a plan
+        # doesn't take its own updates for changes made since the plan
+        self._repointed_ids = set()
+        self._collection_lock = threading.Lock()
+        # WriteBehind queue for purges and updates, instead of writing inline
+        self.writer = writer
+        # Futures of the queued commits, to wait for before returning
+        self._queued_commits = []
+        # Number of identifiers ahead to fetch the groups of, and the largest
+        # group to hold in memory (bigger ones are paged through when their turn comes)
+        self.prefetch = prefetch
+        self.prefetch_max_packages = prefetch_max_packages
+        # (index, count) slice of the duplicate identifiers this deduper handles
+        self.shard = shard
 
         if not run_id:
             run_id = datetime.now().strftime('%Y%m%d%H%M%S')
@@ -65,6 +139,9 @@ class Deduper(object):
         deduplicated. Then collection duplicate dataset identifiers are fetched
         and deduplicated. They are processed separately due to differences in
         query parameters.
+
+        Returns the total number of duplicate datasets, or None if the deduper
+        was stopped before it finished.
         '''
 
         def _fetch_and_dedupe_identifiers(is_collection):
@@ -84,34 +161,64 @@ class Deduper(object):
                 self.log.error('Failed to fetch %s dataset identifiers for organization', label)
                 self.log.exception(exc)
                 # continue onto the next organization
-                return
+                return 0
+
+            if self.shard is not None:
+                # The organization is part of the key, so each organization's
+                # identifiers are spread over every shard
+                identifiers = [identifier for identifier in identifiers
+                               if util.in_shard('%s/%s' % (self.organization_name, identifier), self.shard)]
 
             self.log.info('Found %s dataset identifiers with duplicates count=%d',
                           label,
                           len(identifiers))
 
-            duplicate_count = 0
-            count = itertools.count(start=1)
-            # Work with the identifer name, since that's all we need and it's a
-            # little cleaner.
-            for identifier in identifiers:
+            if self.journal is not None:
+                committed = self.journal.committed(self.organization_name, self.identifier_type, is_collection)
+                if committed:
+                    self.log.info('Skipping %s dataset identifiers committed earlier in the run count=%d',
+                                  label, len(committed))
+                    identifiers = [identifier for identifier in identifiers if identifier not in committed]
+
+            if self.grouped:
+                # Fetch every duplicate group for the organization in a few
+                # large pages, rather than querying each identifier.
+                groups = self.ckan_api.iter_duplicate_groups(self.organization_name,
+                                                             identifiers,
+                                                             is_collection)
+            elif self.prefetch:
+                groups = self.prefetched_groups(identifiers, is_collection)
+            else:
+                groups = ((identifier, None) for identifier in identifiers)
+
+            def _dedupe_group(identifier, datasets, progress):
                 if self.stopped:
                     raise DeduperStopException()
 
                 self.log.info('Deduplicating %s=%s progress=%r',
-                              self.identifier_type, identifier, (next(count), len(identifiers)))
+                              self.identifier_type, identifier, progress)
                 try:
-                    duplicate_count += self.dedupe_identifier(identifier, is_collection)
+                    return self.dedupe_identifier(identifier, is_collection, datasets)
                 except CkanApiFailureException:
                     self.log.error('Failed to dedupe %s=%s', self.identifier_type, identifier)
                     # Move on to next identifier
-                    continue
+                    return 0
                 except CkanApiCountException:
                     self.log.error('Got an invalid count, this may not be a duplicate or there '
                                    'could be inconsistencies between db and solr. Try running the '
                                    'db_solr_sync job. %s=%s', self.identifier_type, identifier)
                     # Move on to next identifier
-                    continue
+                    return 0
+
+            count = itertools.count(start=1)
+            # Work with the identifer name, since that's all we need and it's a
+            # little cleaner.
+            jobs = ((identifier, datasets, (next(count), len(identifiers)))
+                    for identifier, datasets in groups)
+            if self.identifier_workers > 1:
+                duplicate_count = self._dedupe_concurrently(_dedupe_group, jobs)
+            else:
+                duplicate_count = sum(_dedupe_group(*job) for job in jobs)
 
             self.log.info('Removed duplicates for %s datasets duplicate_count=%d',
                           label,
@@ -137,9 +244,105 @@ class Deduper(object):
             # Just return to end processing early and gracefully
             return
 
+        if self.writer is not None:
+            self.wait_for_writes()
+
         self.log.info('Summary duplicate_count=%d', total_duplicate_count)
+        return total_duplicate_count
+
+    def prefetched_groups(self, identifiers, is_collection):
+        '''
+        Yields (identifier, datasets) for each identifier, with the datasets
+        of the next `prefetch` identifiers fetched on background threads
+        while the current one is deduplicated. At most prefetch + 1 groups
+        are held at once. Groups larger than prefetch_max_packages, or whose
+        fetch failed, are yielded with datasets=None so dedupe_identifier
+        fetches them itself. Pending fetches are cancelled on stop().
+        '''
+        def _fetch(identifier):
+            if self.stopped:
+                return None
+
+            filter_query = self.ckan_api.identifier_filter_query(self.organization_name, identifier, is_collection)
+            try:
+                datasets = list(itertools.islice(self.ckan_api.iter_datasets(filter_query),
+                                                 self.prefetch_max_packages + 1))
+            except CkanApiException as exc:
+                self.log.warning('Failed to prefetch %s=%s error=%r', self.identifier_type, identifier, exc)
+                return None
+
+            if len(datasets) > self.prefetch_max_packages:
+                return None
+            return datasets
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            try:
+                for identifier in identifiers:
+                    pending.append((identifier, executor.submit(_fetch, identifier)))
+                    if len(pending) > self.prefetch:
+                        identifier, future = pending.popleft()
+                        yield identifier, future.result()
+
+                while pending:
+                    identifier, future = pending.popleft()
+                    yield identifier, future.result()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def _dedupe_concurrently(self, dedupe_group, jobs):
+        '''
+        Runs dedupe_group over the jobs on a pool of identifier_workers
+        threads and returns the summed duplicate count. Only a couple of jobs
+        per worker are queued at a time, so grouped fetches stay lazy and a
+        stop doesn't leave a long queue to cancel.
+        '''
+        duplicate_count = 0
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.identifier_workers) as executor:
+            try:
+                for job in jobs:
+                    if self.stopped:
+                        raise DeduperStopException()
+
+                    if len(pending) >= 2 * self.identifier_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        duplicate_count += sum(future.result() for future in done)
+
+                    pending.add(executor.submit(dedupe_group, *job))
+
+                done, pending = wait(pending)
+                duplicate_count += sum(future.result() for future in done)
+            finally:
+                # On a stop or error, drop the queued identifiers; the ones
+                # in progress stop at their next check of self.stopped.
+                for future in pending:
+                    future.cancel()
+
+        return duplicate_count
 
     def remove_duplicate(self, duplicate_package, retained_package):
+        '''
+        Removes the duplicate. Returns its full package if it was removed,
+        or None.
+        '''
+        # The removed package log must hold the full package so it can be
+        # restored, not just the projected search fields.
+        duplicate_package = self.ckan_api.full_package(duplicate_package)
+
+        if self.purge_duplicate(duplicate_package, retained_package):
+            return duplicate_package
+        return None
+
+    def purge_duplicate(self, duplicate_package, retained_package, collection_member_ids=None,
+                        remove_package=None):
+        '''
+        Records the duplicate in the audit logs, re-points its collection
+        members to the retained package and purges it. Returns True if it was
+        purged. remove_package, if given, makes the purge instead of
+        ckan_api.remove_package, e.g. to retry it.
+        '''
         self.log.info('Removing duplicate package=%r',
                       (duplicate_package['id'], duplicate_package['name']))
         if self.removed_package_log:
@@ -148,80 +351,128 @@ class Deduper(object):
         if self.duplicate_package_log:
             self.duplicate_package_log.add(duplicate_package, retained_package)
 
-        self.update_collection_datasets(duplicate_package, retained_package)
+        self.update_collection_datasets(duplicate_package, retained_package, collection_member_ids)
 
+        # The purge can't be undone, so its records must be on disk first
+        self.sync_audit_logs()
         try:
-            self.ckan_api.remove_package(duplicate_package['id'])
+            (remove_package or self.ckan_api.remove_package)(duplicate_package['id'])
         except CkanApiStatusException:
             self.log.warning('Failed to remove package, skipping: %r',
                              (duplicate_package['id'], duplicate_package['name']))
+            return False
+        return True
 
-        if (len(duplicate_package['name']) < len(retained_package['name']) and self.update_name):
-            # If the package to be retained has extra random character at
-            #  the end of the name, we want to rename it to the "standard"
-            #  name to keep the typical URL.
-            self.log.info('Renaming kept package from %s to %s',
-                          retained_package['name'], duplicate_package['name'])
-            retained_package['name'] = duplicate_package['name']
-            self.ckan_api.update_package(retained_package)
-            if self.removed_package_log:
-                self.removed_package_log.add(retained_package)
+    def sync_audit_logs(self):
+        for audit_log in (self.removed_package_log, self.duplicate_package_log):
+            if audit_log:
+                audit_log.sync()
+
+    def rename_target(self, retained_package, duplicate_packages):
+        '''
+        Returns the shortest duplicate name if it's shorter than the retained
+        package's, the "standard" name to rename the retained package to, or
+        None when there's nothing to rename.
+        '''
+        if not self.update_name or not duplicate_packages:
+            return None
+
+        name = min((package['name'] for package in duplicate_packages), key=len)
+        if len(name) < len(retained_package['name']):
+            return name
+        return None
+
+    def collection_members(self, package_id):
+        '''
+        Returns the ids of the organization's collection members that point
+        at the package. The first call indexes the ids of every collection
+        member in the organization with one search, so later lookups are
+        local. Only the organization is searched: harvested collection
+        members are created in their parent's organization.
+        '''
+        with self._collection_lock:
+            if self._collection_index is None:
+                self.log.info('Indexing collection members')
+                self._collection_index = self.ckan_api.get_collection_index(self.organization_name)
+            return list(self._collection_index.get(package_id, []))
 
-    def update_collection_datasets(self, duplicate_package, retained_package):
+    def update_collection_datasets(self, duplicate_package, retained_package, collection_member_ids=None):
         # Collection records may not have changed, and may be linked to the
         #  dataset that is marked for removal. Update collection records
         #  to point to the dataset that will be retained
-        collection_datasets = self.ckan_api.get_datasets_in_collection(duplicate_package['id'])
-        if collection_datasets is not None:
-            self.log.info('Updating collection records for dataset=%r',
-                          (duplicate_package['id'], duplicate_package['name']))
-            for cd in collection_datasets:
-                self.log.info('Updating record %s', cd['title'])
-                for e in cd['extras']:
-                    if e['key'] == "collection_package_id":
-                        e['value'] = retained_package['id']
-                        break
-                self.ckan_api.update_package(cd)
-                if self.collection_package_log:
-                    self.collection_package_log.add(retained_package['id'])
-                self.log.info('Updated record with collection id %s', retained_package['id'])
+        if collection_member_ids is None:
+            collection_member_ids = self.collection_members(duplicate_package['id'])
+        if not collection_member_ids:
+            return
 
-    def mark_retained_package(self, retained_package):
+        self.log.info('Updating collection records for dataset=%r count=%d',
+                      (duplicate_package['id'], duplicate_package['name']), len(collection_member_ids))
+
+        def _update(member_id):
+            # Fetch the member fresh, it's written back as a whole
+            cd = self.ckan_api.get_package(member_id)
+            if cd is None or util.get_package_extra(cd, 'collection_package_id') != duplicate_package['id']:
+                self.log.info('Collection record no longer points at the dataset, skipping record=%s', member_id)
+                return None
+
+            self.log.info('Updating record %s', cd['title'])
+            for e in cd['extras']:
+                if e['key'] == "collection_package_id":
+                    e['value'] = retained_package['id']
+                    break
+            self.ckan_api.update_package(cd)
+            if self.collection_package_log:
+                self.collection_package_log.add(retained_package['id'])
+            self.log.info('Updated record with collection id %s', retained_package['id'])
+            return member_id
+
+        with ThreadPoolExecutor(max_workers=self.collection_workers) as executor:
+            # list() re-raises the first failure, before the parent is purged
+            updated = [member_id for member_id in executor.map(_update, collection_member_ids) if member_id]
+
+        with self._collection_lock:
+            self._repointed_ids.update(updated)
+            if self._collection_index is not None:
+                self._collection_index.pop(duplicate_package['id'], None)
+                self._collection_index.setdefault(retained_package['id'], []).extend(updated)
+
+    def commit_retained_package(self, retained_package, name=None):
         '''
-        Mark the retained package with a datagov_dedupe property in case we're
-        interrupted. This allows us to continue with removing duplicates when we resume.
-
-        Note: we're currently not mutating the data in a way that wouldn't be idempotent.
-
-        Note: this isn't really necessary anymore because we're not doing a
-        rename which required us to gather the state up front in case we are
-        interrupted. We leave this here in case rename behavior needs to be re-added.
+        Commits every change to the retained package in a single
+        package_update: the rename to the standard name, if there is one, and
+        the record of this run. Nothing is written if nothing changed.
         '''
-        self.log.info('Marking retained dataset for idempotency package=%r',
-                      (retained_package['id'], retained_package['name']))
-        util.set_package_extra(retained_package, 'datagov_dedupe',
-                               self.run_id)
-
-        # Call the update API
-        self.log.debug('Mark retained package in API package=%r',
-                       (retained_package['id'], retained_package['name']))
-        self.ckan_api.update_package(retained_package)
+        self.flush_retained_update(self.retained_update(retained_package, name))
 
-    def commit_retained_package(self, retained_package):
+    def retained_update(self, retained_package, name=None):
         '''
-        Unmarks the package for deduplication and commits any data changes.
+        Buffers the changes commit_retained_package makes.
         '''
-        # Unmark the retained package
-        util.set_package_extra(retained_package, 'datagov_dedupe', None)
+        update = PackageUpdate(retained_package)
+
+        if name:
+            # If the package to be retained has extra random character at
+            #  the end of the name, we want to rename it to the "standard"
+            #  name to keep the typical URL.
+            self.log.info('Renaming kept package from %s to %s',
+                          retained_package['name'], name)
+            update.rename(name)
+
+        if self.mark_retained:
+            # Clear the marker left by runs that marked the package up front
+            update.set_extra('datagov_dedupe', None)
+            # Add the run_id so there is some record we can look back on.
+            update.set_extra('datagov_dedupe_retained', self.run_id)
 
-        # Add the run_id so there is some record we can look back on.
-        util.set_package_extra(retained_package, 'datagov_dedupe_retained', self.run_id)
+        return update
 
+    def flush_retained_update(self, update):
         self.log.debug('Commit retained package in API package=%r',
-                       (retained_package['id'], retained_package['name']))
-        self.ckan_api.update_package(retained_package)
+                       (update.package['id'], update.package['name']))
+        if 'name' in update.flush(self.ckan_api) and self.removed_package_log:
+            self.removed_package_log.add(update.package)
 
-    def dedupe_identifier(self, identifier, is_collection=False):
+    def dedupe_identifier(self, identifier, is_collection=False, datasets=None):
         '''
         Removes duplicate datasets for the given identifier. The
         deduper is meant to be idempotent so that if it is interrupted, it can
@@ -231,17 +482,23 @@ class Deduper(object):
            a. If there is only one dataset, no duplicates. Continue with next identifier.
         2. Fetch the dataset which is to be retained (oldest or newest depending on
             --newest).
-        3. Mark the retained dataset as being processed.
-        4. Fetch the datasets for this identifier in batches.
-        5. For each dataset:
+        3. Stream the datasets for this identifier in batches.
+        4. For each dataset:
            a. Check if this is the retained dataset, in which we skip.
            b. Remove the dataset.
-        6. Commit the retained dataset as being processed.
+        5. Commit the retained dataset, renaming it to the shortest name of
+           the removed datasets (with --update-name).
 
-        We make sure the commit of the retained dataset happens last. This
-        keeps the logging cleaner, since we don't want to confuse ourselves
-        logging information that is potentially changing. This also means the
-        same information is logged in dry-run vs read/write.
+        If the group's datasets were already fetched (see --grouped), they are
+        passed in as :datasets and steps 1, 2 and 3 are done locally without
+        any API calls.
+
+        We make sure the commit of the retained dataset happens last, as the
+        only write to it. package_update re-indexes the package synchronously,
+        so every change is buffered into that one call. It also keeps the
+        logging cleaner, since we don't want to confuse ourselves logging
+        information that is potentially changing, and means the same
+        information is logged in dry-run vs read/write.
 
         Returns the number of duplicate datasets.
         '''
@@ -251,8 +508,11 @@ class Deduper(object):
             {'organization': self.organization_name, self.identifier_type: identifier},
         )
 
-        log.debug('Fetching number of datasets for unique identifier')
-        dataset_count = self.ckan_api.get_dataset_count(self.organization_name, identifier, is_collection)
+        if datasets is not None:
+            dataset_count = len(datasets)
+        else:
+            log.debug('Fetching number of datasets for unique identifier')
+            dataset_count = self.ckan_api.get_dataset_count(self.organization_name, identifier, is_collection)
         log.info('Found packages count=%d', dataset_count)
 
         # If there is only one or less, there's no duplicates.
@@ -260,52 +520,40 @@ class Deduper(object):
             log.debug('No duplicates found for identifier.')
             return 0
 
-        sort_order = 'asc' if self.oldest else 'desc'
         # We want to keep the oldest dataset
         self.log.debug('Fetching %s dataset for %s=%s', 'oldest' if self.oldest else 'newest',
                        self.identifier_type, identifier)
-        retained_dataset = self.ckan_api.get_dataset(self.organization_name,
-                                                     identifier,
-                                                     is_collection,
-                                                     sort_order=sort_order)
-
-        # Check if the dedupe process has been started on this package
-        if not util.get_package_extra(retained_dataset, 'datagov_dedupe'):
-            # We mark the retained package as having started the dedupe
-            # process. This helps us record information like the original
-            # package name so that in case we are interrupted, we can pick up
-            # where we left off.
-            #
-            # If we're interrupted, it's possible the original dataset would've
-            # been removed, so we need to make sure we collect all information
-            # we need for the final retained update now.
-            self.mark_retained_package(retained_dataset)
-
-        # Fetch datasets in batches
-        def get_datasets(total, rows=1000):
-            '''
-            Returns a generator for fetching additional packages in batches of :rows.
-            '''
-            start = 0
-            while start < total:
-                log.debug(
-                    'Batch fetching datasets for %s offset=%d rows=%d total=%d',
-                    self.identifier_type, start, rows, total)
-                datasets = self.ckan_api.get_datasets(self.organization_name, identifier, start, rows, is_collection)
-                if len(datasets) < 1:
-                    log.warning('Got zero datasets from API offset=%d total=%d', start, total)
-                    raise StopIteration
-
-                start += len(datasets)
-                for dataset in datasets:
-                    yield dataset
+        if datasets is not None:
+            retained_dataset = self.select_retained_dataset(datasets)
+        else:
+            sort_order = 'asc' if self.oldest else 'desc'
+            retained_dataset = self.ckan_api.get_dataset(self.organization_name,
+                                                         identifier,
+                                                         is_collection,
+                                                         sort_order=sort_order)
+
+        if datasets is None:
+            filter_query = self.ckan_api.identifier_filter_query(self.organization_name, identifier, is_collection)
+            datasets = self.ckan_api.iter_datasets(filter_query)
+
+        if self.plan is not None:
+            return self.plan_identifier(identifier, is_collection, retained_dataset, datasets)
+
+        # Search results may be projected; the retained package is written
+        # back, so we need its full body.
+        retained_dataset = self.ckan_api.full_package(retained_dataset)
+        self.checkpoint(identifier, is_collection, PLANNED, retained_dataset)
 
         # Now we can collect the datasets for removal
         duplicate_count = 0
-        for dataset in get_datasets(dataset_count):
+        fetched_count = 0
+        removed = []
+        for dataset in datasets:
             if self.stopped:
                 raise DeduperStopException()
 
+            fetched_count += 1
+
             if dataset['organization']['name'] != self.organization_name:
                 log.warning('Dataset harvested by organization but not part of organization pkg_org_name=%s package=%r',
                             dataset['organization']['name'], (dataset['id'], dataset['name']))
@@ -316,20 +564,271 @@ class Deduper(object):
                 continue
 
             duplicate_count += 1
+            if self.writer is not None:
+                self.queue_removal(identifier, is_collection, dataset, retained_dataset, removed)
+                continue
+
             try:
-                self.remove_duplicate(dataset, retained_dataset)
+                removed_dataset = self.remove_duplicate(dataset, retained_dataset)
             except CkanApiFailureException as e:
                 log.error('Failed to remove dataset status_code=%s package=%r',
                           e.response.status_code, (dataset['id'], dataset['name']))
                 continue
+            if removed_dataset is not None:
+                removed.append(removed_dataset)
+
+        if fetched_count < dataset_count:
+            log.warning('Got fewer datasets from API than expected fetched=%d total=%d',
+                        fetched_count, dataset_count)
+
+        if self.writer is not None:
+            self.queue_commit(identifier, is_collection, retained_dataset, removed)
+            return duplicate_count
+
+        self.checkpoint(identifier, is_collection, PURGED, retained_dataset)
 
         # Commit the retained package
         self.log.info('Committing retained package package=%r',
                       (retained_dataset['id'], retained_dataset['name']))
-        self.commit_retained_package(retained_dataset)
+        self.commit_retained_package(retained_dataset, self.rename_target(retained_dataset, removed))
+        self.checkpoint(identifier, is_collection, COMMITTED, retained_dataset)
 
         return duplicate_count
 
+    def queue_removal(self, identifier, is_collection, duplicate_package, retained_package, removed):
+        '''
+        Queues the removal of a duplicate on the writer, in its group's lane.
+        It goes through purge_duplicate like an inline removal, so the audit
+        logs are written and synced before the purge. Only the purge itself
+        is retried. Once it's confirmed, the removed package is added to
+        :removed for the commit to pick a name from.
+        '''
+        def _purge():
+            package = self.ckan_api.full_package(duplicate_package)
+            if self.purge_duplicate(package, retained_package, remove_package=self.remove_with_retries):
+                return package
+            return None
+
+        def _purged(package):
+            if package is not None:
+                self.log.info('Removed duplicate package=%r', (package['id'], package['name']))
+                removed.append(package)
+
+        def _failed(exc):
+            self.log.warning('Failed to remove package, skipping: %r error=%r',
+                             (duplicate_package['id'], duplicate_package['name']), exc)
+
+        self.writer.submit((self.organization_name, identifier, is_collection), _purge, _purged, _failed,
+                           retry=False)
+
+    def remove_with_retries(self, package_id):
+        '''
+        Purges the package, retrying transient failures on the writer. A purge
+        can go through before its response fails, so a 404 on a retry means
+        an earlier attempt succeeded.
+        '''
+        attempts = itertools.count()
+
+        def _remove():
+            attempt = next(attempts)
+            try:
+                self.ckan_api.remove_package(package_id)
+            except CkanApiStatusException as exc:
+                if attempt and getattr(exc.response, 'status_code', None) == 404:
+                    self.log.info('Package was purged by an earlier attempt package=%s', package_id)
+                    return
+                raise
+
+        self.writer.retry(_remove)
+
+    def queue_commit(self, identifier, is_collection, retained_package, removed):
+        '''
+        Queues the commit of the retained package behind its group's purges.
+        The rename target is picked when the commit runs, from the duplicates
+        that were actually removed.
+        '''
+        updates = []
+
+        def _commit():
+            self.checkpoint(identifier, is_collection, PURGED, retained_package)
+            if not updates:
+                self.log.info('Committing retained package package=%r',
+                              (retained_package['id'], retained_package['name']))
+                updates.append(self.retained_update(retained_package,
+                                                    self.rename_target(retained_package, removed)))
+            # A retried commit flushes the same buffered changes
+            self.flush_retained_update(updates[0])
+
+        def _committed(result):
+            self.checkpoint(identifier, is_collection, COMMITTED, retained_package)
+
+        def _failed(exc):
+            self.log.error('Failed to commit retained package package=%r error=%r',
+                           (retained_package['id'], retained_package['name']), exc)
+
+        self._queued_commits.append(
+            self.writer.submit((self.organization_name, identifier, is_collection), _commit, _committed, _failed))
+
+    def wait_for_writes(self):
+        '''
+        Waits for the commits this deduper queued on the writer, and with
+        them every write queued before them in the same lanes.
+        '''
+        commits, self._queued_commits = self._queued_commits, []
+        wait(commits)
+
+    def checkpoint(self, identifier, is_collection, state, retained_package, identifier_type=None):
+        '''
+        Records the state of an identifier's group in the journal, if any. A
+        dry run changes nothing, so it records nothing either; otherwise a
+        committing run with the same run id would skip the group.
+        '''
+        if self.journal is None or self.ckan_api.dry_run:
+            return
+        self.journal.record(self.organization_name, identifier_type or self.identifier_type, identifier,
+                            is_collection, state, retained_package['id'])
+
+    def plan_identifier(self, identifier, is_collection, retained_dataset, datasets):
+        '''
+        Records the changes dedupe_identifier would make for this identifier
+        in the plan, without making them. Returns the number of duplicate
+        datasets.
+        '''
+        duplicates = []
+        for dataset in datasets:
+            if self.stopped:
+                raise DeduperStopException()
+
+            if dataset['organization']['name'] != self.organization_name:
+                continue
+            if dataset['id'] == retained_dataset['id']:
+                continue
+            duplicates.append(dataset)
+
+        collection_children = {}
+        for duplicate in duplicates:
+            children = self.collection_members(duplicate['id'])
+            if children:
+                collection_children[duplicate['id']] = children
+
+        self.log.info('Planning removal of duplicates %s=%s duplicate_count=%d',
+                      self.identifier_type, identifier, len(duplicates))
+        self.plan.add(plan_entry(self.organization_name,
+                                 self.identifier_type,
+                                 identifier,
+                                 is_collection,
+                                 retained_dataset,
+                                 duplicates,
+                                 collection_children,
+                                 self.rename_target(retained_dataset, duplicates)))
+        return len(duplicates)
+
+    def apply_plan(self, entries, batch_size=20):
+        '''
+        Makes the changes recorded in plan entries for this organization.
+
+        Entries are handled in batches: the current bodies of every package a
+        batch touches are fetched with a search or two, and groups that
+        changed since they were planned are skipped. Nothing else is read, the
+        rest is writes.
+
+        Returns the number of duplicate datasets removed, or None if the
+        deduper was stopped before it finished.
+        '''
+        entries = iter(entries)
+        duplicate_count = 0
+        try:
+            while True:
+                batch = list(itertools.islice(entries, batch_size))
+                if not batch:
+                    break
+
+                if self.journal is not None:
+                    batch = [entry for entry in batch
+                             if self.journal.state(entry['organization'], entry['identifier_type'],
+                                                   entry['identifier'], entry['is_collection']) != COMMITTED]
+                    if not batch:
+                        continue
+
+                package_ids = set()
+                for entry in batch:
+                    package_ids.update(entry_package_ids(entry))
+                packages = self.ckan_api.get_packages(package_ids)
+
+                for entry in batch:
+                    if self.stopped:
+                        raise DeduperStopException()
+
+                    try:
+                        duplicate_count += self.apply_plan_entry(entry, packages)
+                    except CkanApiFailureException:
+                        self.log.error('Failed to apply plan %s=%s',
+                                       entry['identifier_type'], entry['identifier'])
+                        continue
+        except DeduperStopException:
+            self.log.warning('Deduper is stopped, cleaning up...')
+            return None
+
+        self.log.info('Summary duplicate_count=%d', duplicate_count)
+        return duplicate_count
+
+    def apply_plan_entry(self, entry, packages):
+        '''
+        Applies one planned duplicate group, given the current packages by
+        id. Returns the number of duplicates removed.
+        '''
+        log = ContextLoggerAdapter(
+            module_log,
+            {'organization': self.organization_name, entry['identifier_type']: entry['identifier']},
+        )
+
+        if entry['organization'] != self.organization_name:
+            log.warning('Plan entry belongs to another organization plan_org_name=%s', entry['organization'])
+            return 0
+
+        duplicates = [packages[duplicate['id']] for duplicate in entry['duplicates']
+                      if duplicate['id'] in packages]
+        if not duplicates:
+            log.info('Plan already applied, skipping')
+            return 0
+
+        with self._collection_lock:
+            repointed_ids = set(self._repointed_ids)
+        reason = stale_reason(entry, packages, repointed_ids)
+        if reason:
+            log.warning('Plan is out of date, skipping reason="%s"', reason)
+            return 0
+
+        retained_dataset = packages[entry['retained']['id']]
+        self.checkpoint(entry['identifier'], entry['is_collection'], PLANNED, retained_dataset,
+                        identifier_type=entry['identifier_type'])
+
+        kept_names = set()
+        for duplicate in duplicates:
+            # Members are fetched fresh, and skipped if they were re-pointed since
+            children = entry['collection_children'].get(duplicate['id'], [])
+            if not self.purge_duplicate(duplicate, retained_dataset, children):
+                kept_names.add(duplicate['name'])
+        self.checkpoint(entry['identifier'], entry['is_collection'], PURGED, retained_dataset,
+                        identifier_type=entry['identifier_type'])
+
+        # The rename target's name is only free if its package is gone
+        rename = entry['rename'] if entry['rename'] not in kept_names else None
+        log.info('Committing retained package package=%r',
+                 (retained_dataset['id'], retained_dataset['name']))
+        self.commit_retained_package(retained_dataset, rename)
+        self.checkpoint(entry['identifier'], entry['is_collection'], COMMITTED, retained_dataset,
+                        identifier_type=entry['identifier_type'])
+        return len(duplicates)
+
+    def select_retained_dataset(self, datasets):
+        '''
+        Picks the dataset to retain from an already fetched group, the same
+        way get_dataset does: oldest (or newest) by metadata_modified.
+        '''
+        choose = min if self.oldest else max
+        return choose(datasets, key=lambda dataset: dataset['metadata_modified'])
+
     def stop(self):
         '''
         Tells the Deduper to stop processing anymore records.
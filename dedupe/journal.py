@@ -0,0 +1,89 @@
+"""
+A local checkpoint journal of deduplicated groups, so an interrupted run can
+be resumed with the same --run-id without re-processing finished identifiers.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Group states, in the order a group goes through them
+PLANNED = "planned"
+PURGED = "purged"
+COMMITTED = "committed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    run_id TEXT NOT NULL,
+    organization TEXT NOT NULL,
+    identifier_type TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    is_collection INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    retained_id TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (run_id, organization, identifier_type, identifier, is_collection)
+);
+"""
+
+
+class Journal(object):
+    """
+    SQLite journal of duplicate group states for a run, keyed by run id,
+    organization, identifier type (identifier or guid) and identifier. Only
+    committing runs write to it, so a dry run never marks a group as done for
+    a later committing run with the same run id. The database is in WAL mode and every state
+    change is its own transaction, so a crash loses at most the last change,
+    and redoing a group is idempotent anyway.
+    """
+
+    def __init__(self, filename, run_id):
+        self.run_id = run_id
+        self._lock = threading.Lock()
+
+        log.info("Opening dedupe journal filename=%s run_id=%s", filename, run_id)
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL keeps the database consistent through a crash
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def state(self, organization, identifier_type, identifier, is_collection):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT state FROM checkpoints WHERE run_id = ? AND organization = ? "
+                "AND identifier_type = ? AND identifier = ? AND is_collection = ?",
+                (self.run_id, organization, identifier_type, identifier, bool(is_collection)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def committed(self, organization, identifier_type, is_collection):
+        """
+        Returns the set of identifiers of the type already committed for the
+        organization.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT identifier FROM checkpoints WHERE run_id = ? AND organization = ? "
+                "AND identifier_type = ? AND is_collection = ? AND state = ?",
+                (self.run_id, organization, identifier_type, bool(is_collection), COMMITTED),
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def record(self, organization, identifier_type, identifier, is_collection, state, retained_id=None):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints "
+                "(run_id, organization, identifier_type, identifier, is_collection, state, retained_id, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.run_id, organization, identifier_type, identifier, bool(is_collection), state,
+                 retained_id, time.time()),
+            )
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,250 @@
+"""
+Per-endpoint instrumentation for CKAN API requests: request counts, bytes in
+and out, status codes, retries and latency histograms, keyed by CKAN action
+and HTTP method. Dump it at the end of a run as JSON or as a Prometheus
+textfile.
+
+Print a summary table of a JSON dump with:
+
+    $ python -m dedupe.metrics metrics.json
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        Estimates the q-quantile by interpolating linearly within the bucket
+        it falls in. The open-ended last bucket is capped at the max seen.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            upper = min(bound, self.max)
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "buckets": dict(
+                (str(bound), count) for bound, count in zip(self.buckets, self.counts)
+            ),
+            "quantiles": dict(
+                ("p%d" % (q * 100), self.quantile(q)) for q in QUANTILES
+            ),
+        }
+
+
+class EndpointMetrics(object):
+    def __init__(self):
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.retries = 0
+        self.statuses = Counter()
+        self.latency = LatencyHistogram()
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "retries": self.retries,
+            "statuses": dict((str(status), count) for status, count in self.statuses.items()),
+            "latency": self.latency.as_dict(),
+        }
+
+
+class ApiMetrics(object):
+    """
+    Thread-safe collection of EndpointMetrics keyed by (action, method).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _endpoint(self, action, method):
+        key = (action, method)
+        if key not in self._endpoints:
+            self._endpoints[key] = EndpointMetrics()
+        return self._endpoints[key]
+
+    def record(self, action, method, status, seconds, bytes_in=0, bytes_out=0, retries=0):
+        """
+        Records a completed request. Use status="error" for requests that
+        never got a response.
+        """
+        with self._lock:
+            endpoint = self._endpoint(action, method)
+            endpoint.requests += 1
+            endpoint.bytes_in += bytes_in
+            endpoint.bytes_out += bytes_out
+            endpoint.retries += retries
+            endpoint.statuses[status] += 1
+            endpoint.latency.observe(seconds)
+
+    def record_bytes_in(self, action, method, bytes_in):
+        """
+        Adds body bytes read after the request was recorded, for streamed
+        responses.
+        """
+        with self._lock:
+            self._endpoint(action, method).bytes_in += bytes_in
+
+    def record_retry(self, action, method):
+        with self._lock:
+            self._endpoint(action, method).retries += 1
+
+    def as_dict(self):
+        with self._lock:
+            return dict(
+                ("%s %s" % (method, action), endpoint.as_dict())
+                for (action, method), endpoint in sorted(self._endpoints.items())
+            )
+
+    def dump_json(self, filename):
+        log.info("Writing API metrics filename=%s", filename)
+        with open(filename, "w") as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    def prometheus_lines(self):
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+
+        lines = []
+
+        def label_text(action, method, **extra):
+            labels = [("action", action), ("method", method)] + sorted(extra.items())
+            return ",".join('%s="%s"' % label for label in labels)
+
+        def header(name, metric_type, help_text):
+            lines.append("# HELP dedupe_ckan_%s %s" % (name, help_text))
+            lines.append("# TYPE dedupe_ckan_%s %s" % (name, metric_type))
+
+        header("requests_total", "counter", "CKAN API requests.")
+        for (action, method), endpoint in endpoints:
+            for status, count in sorted(endpoint.statuses.items(), key=str):
+                lines.append("dedupe_ckan_requests_total{%s} %d" % (
+                    label_text(action, method, status=status), count))
+
+        for name, attribute, help_text in (
+            ("retries_total", "retries", "CKAN API request retries."),
+            ("received_bytes_total", "bytes_in", "Response bytes received."),
+            ("sent_bytes_total", "bytes_out", "Request bytes sent."),
+        ):
+            header(name, "counter", help_text)
+            for (action, method), endpoint in endpoints:
+                lines.append("dedupe_ckan_%s{%s} %d" % (
+                    name, label_text(action, method), getattr(endpoint, attribute)))
+
+        header("request_duration_seconds", "histogram", "CKAN API request latency in seconds.")
+        for (action, method), endpoint in endpoints:
+            histogram = endpoint.latency
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append("dedupe_ckan_request_duration_seconds_bucket{%s} %d" % (
+                    label_text(action, method, le=le), cumulative))
+            lines.append("dedupe_ckan_request_duration_seconds_sum{%s} %s" % (
+                label_text(action, method), histogram.sum))
+            lines.append("dedupe_ckan_request_duration_seconds_count{%s} %d" % (
+                label_text(action, method), histogram.count))
+
+        return lines
+
+    def dump_prometheus(self, filename):
+        """
+        Writes a Prometheus textfile. The file is written next to the target
+        and renamed into place so a collector never reads a partial file.
+        """
+        log.info("Writing API metrics textfile filename=%s", filename)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            f.write("\n".join(self.prometheus_lines()) + "\n")
+        os.rename(tmp_filename, filename)
+
+
+def dump(metrics, json_filename=None, textfile=None):
+    """
+    Writes the metrics to whichever of the outputs were requested.
+    """
+    if json_filename:
+        metrics.dump_json(json_filename)
+    if textfile:
+        metrics.dump_prometheus(textfile)
+
+
+def format_summary(metrics):
+    """
+    Formats a JSON metrics dump as a plain text table for reports.
+    """
+    def quantile_ms(value):
+        return "-" if value is None else "%.0f" % (value * 1000)
+
+    rows = [("endpoint", "requests", "retries", "MB in", "MB out", "p50 ms", "p95 ms", "p99 ms", "statuses")]
+    for name, endpoint in sorted(metrics.items()):
+        quantiles = endpoint["latency"]["quantiles"]
+        rows.append((
+            name,
+            str(endpoint["requests"]),
+            str(endpoint["retries"]),
+            "%.1f" % (endpoint["bytes_in"] / 1e6),
+            "%.1f" % (endpoint["bytes_out"] / 1e6),
+            quantile_ms(quantiles["p50"]),
+            quantile_ms(quantiles["p95"]),
+            quantile_ms(quantiles["p99"]),
+            " ".join("%s=%d" % item for item in sorted(endpoint["statuses"].items())),
+        ))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+        for row in rows
+    )
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as f:
+        print(format_summary(json.load(f)))
@@ -0,0 +1,135 @@
+"""
+Dedupe plans: the writes a dry run would make, one JSON line per duplicate
+group, so a reviewed plan can be applied by a --commit run without detecting
+the duplicates all over again.
+"""
+
+from __future__ import absolute_import
+
+import codecs
+from datetime import datetime, timezone
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def package_ref(package):
+    """
+    The fields of a package the plan needs: enough to find it again and to
+    tell whether it changed since the plan was made.
+    """
+    return {
+        "id": package["id"],
+        "name": package["name"],
+        "metadata_modified": package.get("metadata_modified"),
+    }
+
+
+def plan_entry(organization_name, identifier_type, identifier, is_collection,
+               retained_package, duplicate_packages, collection_children=None, rename=None):
+    """
+    Builds the plan for one duplicate group. collection_children maps each
+    duplicate id to the ids of the collection members that point at it.
+    """
+    return {
+        "organization": organization_name,
+        "identifier_type": identifier_type,
+        "identifier": identifier,
+        "is_collection": is_collection,
+        "retained": package_ref(retained_package),
+        "duplicates": [package_ref(package) for package in duplicate_packages],
+        "collection_children": collection_children or {},
+        "rename": rename,
+    }
+
+
+def entry_package_ids(entry):
+    """
+    Returns the ids of the packages the entry is checked against: the
+    retained package and its duplicates. Collection members are fetched one
+    at a time, right before they're updated.
+    """
+    ids = [entry["retained"]["id"]]
+    ids.extend(duplicate["id"] for duplicate in entry["duplicates"])
+    return ids
+
+
+def modified_time(value):
+    """
+    Parses a metadata_modified timestamp to compare it with another one. The
+    package dicts have microseconds and no timezone, while projected search
+    results come from SOLR, which stores milliseconds in UTC with a "Z", so
+    both are compared as naive UTC times to the millisecond.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        # Not a timestamp we know, so only an identical value matches
+        return value
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.replace(microsecond=parsed.microsecond // 1000 * 1000)
+
+
+def modified_since(package, ref):
+    return modified_time(package.get("metadata_modified")) != modified_time(ref["metadata_modified"])
+
+
+def stale_reason(entry, packages, applied_ids=()):
+    """
+    Compares a plan entry with the current packages (by id) and returns why
+    it can't be applied as planned, or None if it can. applied_ids are the
+    packages the apply itself has changed since the plan was made (collection
+    members it re-pointed), which aren't counted as modified.
+    """
+    retained = packages.get(entry["retained"]["id"])
+    if retained is None:
+        return "retained package is gone"
+
+    if retained["id"] not in applied_ids and modified_since(retained, entry["retained"]):
+        return "retained package was modified"
+
+    for duplicate in entry["duplicates"]:
+        package = packages.get(duplicate["id"])
+        if package is not None and duplicate["id"] not in applied_ids and modified_since(package, duplicate):
+            return "duplicate package %s was modified" % duplicate["id"]
+
+    return None
+
+
+class PlanWriter(object):
+    """
+    Appends plan entries to a JSON lines file. Safe to share between dedupers
+    in several threads.
+    """
+
+    def __init__(self, filename):
+        log.info("Opening dedupe plan for writing filename=%s", filename)
+        self.filename = filename
+        self.f = codecs.open(filename, mode="w", encoding="utf8")
+        self.lock = threading.Lock()
+
+    def add(self, entry):
+        line = json.dumps(entry, sort_keys=True) + "\n"
+        with self.lock:
+            self.f.write(line)
+            # Flush each group so the plan can be followed while it's written
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def read_plan(filename):
+    """
+    Streams the entries of a plan file.
+    """
+    log.info("Reading dedupe plan filename=%s", filename)
+    with codecs.open(filename, encoding="utf8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,134 @@
+"""
+Client-side rate limiting for the CKAN API. A token bucket paces requests and
+an AIMD controller adjusts its rate: additive increase while responses are
+fast and healthy, multiplicative decrease when the server throttles us
+(429/503) or latency climbs.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Status codes that mean the server wants us to slow down
+THROTTLE_STATUSES = (429, 503)
+# Status codes worth retrying for idempotent requests
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. reserve() takes a token and returns how long the
+    caller has to wait before using it, so blocking and asyncio callers can
+    share the same bucket.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate is driven by an AIMD controller.
+
+    Every healthy response below `latency_target` seconds raises the rate by
+    about `increase` requests/second per second of traffic. A throttling
+    response, or a smoothed latency above the target, multiplies the rate by
+    `decrease`, at most once per `cooldown` seconds so a burst of slow
+    responses only counts once.
+    """
+
+    def __init__(self, name, rate, min_rate=0.2, max_rate=50, increase=1.0, decrease=0.5,
+                 latency_target=2.0, cooldown=1.0):
+        super(AdaptiveRateLimiter, self).__init__(rate)
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.latency = None
+        self._decreased = 0
+
+    def _set_rate(self, rate):
+        # Called with the lock held
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+        self.burst = max(1, self.rate)
+
+    def _back_off(self, reason):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased < self.cooldown:
+                return
+            self._decreased = now
+            self._set_rate(self.rate * self.decrease)
+            rate = self.rate
+        log.info("Backing off API rate limiter=%s reason=%s rate=%.2f", self.name, reason, rate)
+
+    def succeeded(self, latency):
+        with self._lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            slow = self.latency > self.latency_target
+            if not slow:
+                self._set_rate(self.rate + self.increase / self.rate)
+
+        if slow:
+            self._back_off('latency')
+
+    def throttled(self):
+        self._back_off('throttled')
+
+
+def read_limiter(max_rate):
+    """
+    Limiter for the read-only URL, starting at half of max_rate.
+    """
+    return AdaptiveRateLimiter("read", max_rate / 2.0, max_rate=max_rate)
+
+
+def write_limiter(max_rate):
+    """
+    Limiter for the read-write URL. Purges and updates re-index synchronously,
+    so they're allowed to take longer before we call the server slow.
+    """
+    return AdaptiveRateLimiter("write", max_rate / 2.0, max_rate=max_rate, latency_target=10.0)
+
+
+def retry_delay(attempt, retry_after=None, base=0.5, cap=30):
+    """
+    Full-jitter exponential backoff, never shorter than the server's
+    Retry-After (in seconds) when it sent one.
+    """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    try:
+        delay = max(delay, float(retry_after))
+    except (TypeError, ValueError):
+        pass
+    return delay
@@ -0,0 +1,87 @@
+"""
+Load balancing of read-only requests across several CKAN read URLs.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Replica(object):
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        # Smoothed latency in seconds, None until the first response
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0
+
+    def __repr__(self):
+        return "Replica(%r)" % self.url
+
+
+class ReplicaPool(object):
+    """
+    Picks a read URL for each request, preferring the replica with the lowest
+    expected wait: its EWMA latency weighted by the requests it already has in
+    flight. A replica that fails `failure_threshold` times in a row (connection
+    errors or 5xx) is ejected for `eject_seconds`, then tried again.
+    """
+
+    def __init__(self, urls, alpha=0.3, failure_threshold=3, eject_seconds=30):
+        if not urls:
+            raise ValueError("ReplicaPool needs at least one URL")
+
+        self.replicas = [Replica(url) for url in urls]
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+
+    def _score(self, replica):
+        # Untried replicas look as fast as the fastest one so they get traffic
+        known = [r.latency for r in self.replicas if r.latency is not None]
+        latency = replica.latency if replica.latency is not None else min(known or [1.0])
+        return (replica.outstanding + 1) * latency
+
+    def acquire(self):
+        """
+        Returns the replica to send the next read to. Callers must release()
+        it when the request completes.
+        """
+        with self._lock:
+            now = time.monotonic()
+            healthy = [r for r in self.replicas if r.ejected_until <= now]
+            if healthy:
+                replica = min(healthy, key=self._score)
+            else:
+                # Everything is ejected, use whichever comes back first
+                replica = min(self.replicas, key=lambda r: r.ejected_until)
+            replica.outstanding += 1
+            return replica
+
+    def release(self, replica, latency=None, ok=True):
+        with self._lock:
+            replica.outstanding -= 1
+            if not ok:
+                replica.failures += 1
+                if replica.failures >= self.failure_threshold:
+                    replica.ejected_until = time.monotonic() + self.eject_seconds
+                    replica.failures = 0
+                    log.warning(
+                        "Ejecting read replica url=%s seconds=%d",
+                        replica.url,
+                        self.eject_seconds,
+                    )
+                return
+
+            replica.failures = 0
+            if latency is not None:
+                if replica.latency is None:
+                    replica.latency = latency
+                else:
+                    replica.latency = self.alpha * latency + (1 - self.alpha) * replica.latency
@@ -0,0 +1,32 @@
+'''
+Package dicts shared by the tests.
+'''
+from __future__ import absolute_import
+
+
+def extras(**values):
+    '''
+    Builds a package's extras list, e.g. extras(identifier='id-a').
+    '''
+    return [{'key': key, 'value': value} for key, value in values.items()]
+
+
+def package(package_id, name=None, metadata_modified='2020-01-01T00:00:00', extras=None,
+            organization='test-org', **fields):
+    '''
+    Builds a package as package_search returns it. The name defaults to
+    package-<id>, and the title to the name. Any other fields are set as
+    given.
+    '''
+    name = name or 'package-%s' % package_id
+    result = {
+        'id': package_id,
+        'name': name,
+        'title': name,
+        'metadata_created': metadata_modified,
+        'metadata_modified': metadata_modified,
+        'organization': {'name': organization},
+        'extras': extras or [],
+    }
+    result.update(fields)
+    return result
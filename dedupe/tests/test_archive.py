@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..archive import ArchiveReader, PackageArchive, import_log, restore_packages
+from .fixtures import extras, package
+
+
+def archived(i, identifier=None):
+    return package('package-%d' % i, name='dataset-%d' % i, extras=extras(identifier=identifier or 'id-%d' % i))
+
+
+class TestPackageArchive(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'removed.jsonl.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        archive = PackageArchive(self.filename, run_id='run-1', frame_size=3)
+        for i in range(7):
+            archive.add(archived(i, identifier='shared' if i in (2, 5) else None))
+        archive.close()
+
+        reader = ArchiveReader(self.filename)
+        self.assertEqual(reader.lookup(id='package-4'), [archived(4)])
+        self.assertEqual(reader.lookup(name='dataset-6'), [archived(6)])
+        self.assertEqual([p['id'] for p in reader.lookup(identifier='shared')], ['package-2', 'package-5'])
+        self.assertEqual(len(reader.lookup(run_id='run-1')), 7)
+        self.assertEqual(reader.lookup(id='package-9'), [])
+        with self.assertRaises(ValueError):
+            reader.lookup(title='Dataset')
+        reader.close()
+
+    def test_readable_with_gzip(self):
+        archive = PackageArchive(self.filename, frame_size=2)
+        for i in range(5):
+            archive.add(archived(i))
+        archive.close()
+
+        with gzip.open(self.filename, 'rt') as f:
+            self.assertEqual([json.loads(line)['id'] for line in f], ['package-%d' % i for i in range(5)])
+
+    def test_sync_writes_frame(self):
+        archive = PackageArchive(self.filename, run_id='run-1')
+        archive.add(archived(1))
+        self.assertEqual(ArchiveReader(self.filename).lookup(id='package-1'), [])
+
+        archive.sync()
+        self.assertEqual(ArchiveReader(self.filename).lookup(id='package-1'), [archived(1)])
+        archive.close()
+
+    def test_append_runs(self):
+        for run_id in ('run-1', 'run-2'):
+            archive = PackageArchive(self.filename, run_id=run_id)
+            archive.add(archived(1))
+            archive.close()
+
+        reader = ArchiveReader(self.filename)
+        self.assertEqual(len(reader.lookup(id='package-1')), 2)
+        self.assertEqual(len(reader.lookup(id='package-1', run_id='run-2')), 1)
+
+    def test_import_log(self):
+        log_filename = os.path.join(self.tmpdir, 'removed-packages.log')
+        with open(log_filename, 'w') as f:
+            f.write(''.join(json.dumps(archived(i)) + '\n' for i in range(3)))
+
+        archive = PackageArchive(self.filename)
+        self.assertEqual(import_log(archive, log_filename), 3)
+        archive.close()
+
+        self.assertEqual(ArchiveReader(self.filename).lookup(id='package-2'), [archived(2)])
+
+
+class TestRestorePackages(unittest.TestCase):
+    def test_restore_packages(self):
+        ckan_api = mock.Mock()
+        ckan_api.create_package.side_effect = [None, Exception('name in use'), None]
+
+        failed = restore_packages(ckan_api, [archived(1), archived(2), archived(3)], workers=1)
+
+        self.assertEqual(failed, ['package-2'])
+        self.assertEqual(ckan_api.create_package.call_count, 3)
+
+    def test_restore_packages_latest_copy(self):
+        ckan_api = mock.Mock()
+        old, new = archived(1), dict(archived(1), title='renamed')
+
+        failed = restore_packages(ckan_api, [old, archived(2), new], workers=1)
+
+        self.assertEqual(failed, [])
+        self.assertEqual(ckan_api.create_package.call_args_list, [mock.call(new), mock.call(archived(2))])
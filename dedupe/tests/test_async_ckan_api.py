@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+import asyncio
+import unittest
+
+import mock
+
+from ..async_ckan_api import AsyncCkanApiClient
+from ..ckan_api import DryRunException
+
+
+class TestAsyncCkanApiClient(unittest.TestCase):
+    def test_request_dry_run(self):
+        api = AsyncCkanApiClient('http://test', 'api-key-abc', dry_run=True)
+        with self.assertRaises(DryRunException):
+            asyncio.run(api.request('POST', '/action/test'))
+
+    def test_replica_released_on_timeout(self):
+        api = AsyncCkanApiClient('http://test', 'api-key-abc', api_read_url=['http://read-1'])
+        session = mock.Mock()
+        session.request.side_effect = asyncio.TimeoutError()
+
+        with mock.patch.object(api, '_get_session', return_value=session):
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(api.request('GET', '/action/package_search'))
+
+        replica, = api.read_replicas.replicas
+        self.assertEqual(replica.outstanding, 0)
+
+    def test_remove_package(self):
+        with mock.patch.object(AsyncCkanApiClient, 'request', return_value=None) as mock_request:
+            api = AsyncCkanApiClient('http://test', 'api-key-abc', dry_run=False)
+            asyncio.run(api.remove_package('package-123'))
+
+        mock_request.assert_called_with('POST', mock.ANY, json=dict(id='package-123'))
+
+    def test_get_duplicate_identifiers_fan_out(self):
+        facets = {'result': {'facets': {'identifier': {'b': 2, 'a': 3}}}}
+        with mock.patch.object(AsyncCkanApiClient, 'request', return_value=facets):
+            api = AsyncCkanApiClient('http://test', 'api-key-abc')
+
+            async def fan_out():
+                return await asyncio.gather(*[
+                    api.get_duplicate_identifiers(org, False) for org in ('org-1', 'org-2')])
+
+            results = asyncio.run(fan_out())
+
+        self.assertEqual(results, [['a', 'b'], ['a', 'b']])
+
+    def test_get_duplicate_facets(self):
+        facets = {'result': {'facets': {'identifier': {'a': 2}, 'guid': {'b': 3}}}}
+        with mock.patch.object(AsyncCkanApiClient, 'request', return_value=facets) as mock_request:
+            api = AsyncCkanApiClient('http://test', 'api-key-abc')
+            result = asyncio.run(api.get_duplicate_facets(api.organization_filter_query('org-1', False)))
+
+        self.assertEqual(result, {'identifier': {'a': 2}, 'guid': {'b': 3}})
+        # Both identifier types come from the same request
+        mock_request.assert_called_once()
+        self.assertEqual(mock_request.call_args[1]['params']['facet.field'], '["identifier","guid"]')
+
+    def test_get_organization_totals(self):
+        facets = {'result': {'facets': {'organization': {'org-1': 10, 'org-2': 1}}}}
+        with mock.patch.object(AsyncCkanApiClient, 'request', return_value=facets) as mock_request:
+            api = AsyncCkanApiClient('http://test', 'api-key-abc')
+            totals = asyncio.run(api.get_organization_totals())
+
+        self.assertEqual(totals, {'org-1': 10, 'org-2': 1})
+        mock_request.assert_called_once()
+
+    def test_get_harvest_source_totals(self):
+        facets = {'result': {'facets': {'harvest_source_title': {'Source 1': 10}}}}
+        with mock.patch.object(AsyncCkanApiClient, 'request', return_value=facets) as mock_request:
+            api = AsyncCkanApiClient('http://test', 'api-key-abc')
+            totals = asyncio.run(api.get_harvest_source_totals())
+
+        self.assertEqual(totals, {'Source 1': 10})
+        self.assertEqual(mock_request.call_args[1]['params']['facet.field'], '["harvest_source_title"]')
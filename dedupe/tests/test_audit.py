@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+import io
+import unittest
+
+import mock
+
+from ..audit import AuditFile
+
+
+class StubFile(io.StringIO):
+    def fileno(self):
+        return 0
+
+    def close(self):
+        self.closed_value = self.getvalue()
+        super(StubFile, self).close()
+
+
+@mock.patch('dedupe.audit.os.fsync')
+class TestAuditFile(unittest.TestCase):
+    def test_sync_every(self, mock_fsync):
+        f = StubFile()
+        audit_file = AuditFile(f, sync_every=3, sync_interval=60)
+        for i in range(7):
+            audit_file.write('record %d\n' % i)
+        audit_file.close()
+
+        # Two full groups of 3, then the last record on close
+        self.assertEqual(mock_fsync.call_count, 3)
+        self.assertEqual(f.closed_value.count('\n'), 7)
+
+    def test_sync(self, mock_fsync):
+        f = StubFile()
+        audit_file = AuditFile(f, sync_every=100, sync_interval=60)
+        audit_file.write('record\n')
+        audit_file.sync()
+
+        mock_fsync.assert_called_once_with(0)
+        self.assertEqual(f.getvalue(), 'record\n')
+        audit_file.close()
+
+    def test_sync_interval(self, mock_fsync):
+        f = StubFile()
+        audit_file = AuditFile(f, sync_every=100, sync_interval=0.01)
+        audit_file.write('record\n')
+
+        for _ in range(100):
+            if mock_fsync.called:
+                break
+            audit_file._thread.join(0.01)
+        mock_fsync.assert_called_once_with(0)
+        audit_file.close()
+
+    def test_write_error(self, mock_fsync):
+        mock_fsync.side_effect = OSError('disk full')
+        audit_file = AuditFile(StubFile(), sync_every=1)
+        audit_file.write('record\n')
+
+        with self.assertRaises(IOError):
+            audit_file.sync()
+        with self.assertRaises(IOError):
+            audit_file.write('another record\n')
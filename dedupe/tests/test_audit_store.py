@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..audit import DuplicatePackageLog
+from ..audit_store import AuditStore, export_duplicates, export_removed, package_history
+from .fixtures import extras, package
+
+
+def audited(package_id, harvest_source='source-1'):
+    return package(package_id, name='dataset-%s' % package_id, title='Dataset %s' % package_id,
+                   extras=extras(identifier='id-a', harvest_source_id=harvest_source))
+
+
+class TestAuditStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'audit.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, run_id, duplicate_id, retained_id, batch_size=100):
+        store = AuditStore(self.filename, run_id, batch_size=batch_size)
+        store.removed_log().add(audited(duplicate_id))
+        store.duplicate_log(api_url='http://test').add(audited(duplicate_id), audited(retained_id))
+        store.close()
+
+    def test_package_history(self):
+        self.record('run-1', 'package-2', 'package-1')
+        self.record('run-2', 'package-3', 'package-1')
+
+        history = package_history(self.filename, 'package-2')
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]['run_id'], 'run-1')
+        self.assertEqual(history[0]['retained_id'], 'package-1')
+
+        history = package_history(self.filename, 'package-1')
+        self.assertEqual([row['duplicate_id'] for row in history], ['package-2', 'package-3'])
+
+    def test_export_duplicates(self):
+        self.record('run-1', 'package-2', 'package-1')
+        self.record('run-2', 'package-3', 'package-1')
+
+        f = io.BytesIO()
+        export_duplicates(self.filename, f, run_id='run-2')
+        lines = f.getvalue().decode('utf8').splitlines()
+
+        self.assertEqual(lines[0], ','.join(DuplicatePackageLog.fieldnames))
+        self.assertEqual(len(lines), 2)
+        self.assertIn('package-3', lines[1])
+        self.assertIn('http://test/dataset/dataset-package-1', lines[1])
+        self.assertIn('False', lines[1])
+
+    def test_export_removed(self):
+        self.record('run-1', 'package-2', 'package-1')
+
+        f = io.StringIO()
+        export_removed(self.filename, f)
+        self.assertEqual([json.loads(line) for line in f.getvalue().splitlines()], [audited('package-2')])
+
+    def test_batches(self):
+        store = AuditStore(self.filename, 'run-1', batch_size=2)
+        removed_log = store.removed_log()
+        removed_log.add(audited('package-1'))
+        self.assertEqual(self.removed_count(), 0)
+
+        removed_log.add(audited('package-2'))
+        self.assertEqual(self.removed_count(), 2)
+
+        removed_log.add(audited('package-3'))
+        removed_log.sync()
+        self.assertEqual(self.removed_count(), 3)
+        store.close()
+
+    @mock.patch('dedupe.audit_store.time.monotonic')
+    def test_sync_interval(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        store = AuditStore(self.filename, 'run-1', batch_size=100, sync_interval=1.0)
+        removed_log = store.removed_log()
+        removed_log.add(audited('package-1'))
+        self.assertEqual(self.removed_count(), 0)
+
+        mock_monotonic.return_value = 1.5
+        removed_log.add(audited('package-2'))
+        self.assertEqual(self.removed_count(), 2)
+        store.close()
+
+    def removed_count(self):
+        f = io.StringIO()
+        export_removed(self.filename, f)
+        return len(f.getvalue().splitlines())
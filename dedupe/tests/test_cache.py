@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ..cache import ReadCache, cache_key
+
+
+class TestReadCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ReadCache(os.path.join(self.tmpdir, 'cache.sqlite'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache_key_normalizes_params(self):
+        self.assertEqual(cache_key('/action/package_search?rows=0&q=organization:gsa-gov'),
+                         cache_key('/action/package_search', {'q': 'organization:gsa-gov', 'rows': 0}))
+
+    def test_cache_key_per_instance(self):
+        data = {'success': True, 'result': ['org-1']}
+        self.cache.set('/action/organization_list', None, data, base_url='https://staging')
+
+        self.assertIsNone(self.cache.get('/action/organization_list', base_url='https://prod'))
+        self.assertEqual(self.cache.get('/action/organization_list', base_url='https://staging'), data)
+
+    def test_get_set(self):
+        data = {'success': True, 'result': ['org-1', 'org-2']}
+        self.assertIsNone(self.cache.get('/action/organization_list'))
+
+        self.cache.set('/action/organization_list', None, data)
+
+        self.assertEqual(self.cache.get('/action/organization_list'), data)
+
+    def test_expired(self):
+        self.cache.set('/action/package_show', {'id': 'package-1'}, {'result': {'id': 'package-1'}})
+
+        with mock.patch('time.time', return_value=2 ** 40):
+            self.assertIsNone(self.cache.get('/action/package_show', {'id': 'package-1'}))
+
+    def test_invalidate_package(self):
+        search = {'result': {'count': 1, 'results': [{'id': 'package-1', 'name': 'package'}]}}
+        other = {'result': {'count': 1, 'results': [{'id': 'package-2', 'name': 'other'}]}}
+        count = {'result': {'count': 7, 'results': []}}
+        self.cache.set('/action/package_search', {'fq': 'a'}, search)
+        self.cache.set('/action/package_search', {'fq': 'b'}, other)
+        self.cache.set('/action/package_search', {'fq': 'c', 'rows': 0}, count)
+
+        self.cache.invalidate_package('package-1')
+
+        self.assertIsNone(self.cache.get('/action/package_search', {'fq': 'a'}))
+        self.assertIsNone(self.cache.get('/action/package_search', {'fq': 'c', 'rows': 0}))
+        self.assertEqual(self.cache.get('/action/package_search', {'fq': 'b'}), other)
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 150
+        data = {'result': 'x' * 40}
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = 1000
+            self.cache.set('/action/package_show', {'id': '1'}, data)
+            mock_time.return_value = 1001
+            self.cache.set('/action/package_show', {'id': '2'}, data)
+            # Touch the first entry so the second is least recently used
+            mock_time.return_value = 1002
+            self.cache.get('/action/package_show', {'id': '1'})
+            mock_time.return_value = 1003
+            self.cache.set('/action/package_show', {'id': '3'}, data)
+
+            self.assertIsNone(self.cache.get('/action/package_show', {'id': '2'}))
+            self.assertEqual(self.cache.get('/action/package_show', {'id': '1'}), data)
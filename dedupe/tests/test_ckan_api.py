@@ -1,9 +1,14 @@
 from __future__ import absolute_import
+import io
+import threading
 import unittest
 
 import mock
 
-from ..ckan_api import DryRunException, CkanApiClient, CkanApiCountException
+from ..ckan_api import (DryRunException, CkanApiClient, CkanApiCountException, CkanApiFailureException,
+                        CkanApiStatusException)
+from ..metrics import ApiMetrics
+from .fixtures import extras, package
 
 
 class StubResponse(object):
@@ -13,6 +18,10 @@ class StubResponse(object):
     def __init__(self, data=None):
         self.data = data if data else dict()
 
+    @property
+    def result(self):
+        return self.data['result']
+
     def json(self):
         return self.data
 
@@ -37,6 +46,49 @@ class TestCkanApiClient(unittest.TestCase):
 
         mock_request.assert_not_called()
 
+    def test_create_package(self):
+        with mock.patch.object(CkanApiClient, 'request', return_value=None) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc', dry_run=False)
+            api.create_package({'id': 'package-123', 'name': 'dataset'})
+
+        mock_request.assert_called_with('POST', '/action/package_create',
+                                        json={'id': 'package-123', 'name': 'dataset'})
+
+    def test_package_exists(self):
+        active = StubResponse({'result': {'id': 'package-123', 'state': 'active'}})
+        with mock.patch.object(CkanApiClient, 'request', return_value=active) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            self.assertTrue(api.package_exists('package-123'))
+
+        mock_request.assert_called_with('GET', '/action/package_show', params={'id': 'package-123'})
+
+        deleted = StubResponse({'result': {'id': 'package-123', 'state': 'deleted'}})
+        with mock.patch.object(CkanApiClient, 'request', return_value=deleted):
+            self.assertFalse(api.package_exists('package-123'))
+
+    def test_package_exists_missing(self):
+        not_found = CkanApiStatusException('Unsuccessful status code 404', mock.Mock(status_code=404))
+        with mock.patch.object(CkanApiClient, 'request', side_effect=not_found):
+            api = CkanApiClient('http://test', 'api-key-abc')
+            self.assertFalse(api.package_exists('package-123'))
+
+        server_error = CkanApiStatusException('Unsuccessful status code 500', mock.Mock(status_code=500))
+        with mock.patch.object(CkanApiClient, 'request', side_effect=server_error):
+            with self.assertRaises(CkanApiStatusException):
+                api.package_exists('package-123')
+
+    def test_get_dataset_bypasses_cache(self):
+        cache = mock.Mock()
+        response = StubResponse({'result': {'count': 1, 'results': [{'id': 'package-123'}]}})
+        with mock.patch.object(CkanApiClient, 'request', return_value=response):
+            api = CkanApiClient('http://test', 'api-key-abc', cache=cache)
+            self.assertEqual(api.get_dataset('test-organization', 'id-a', is_collection=False),
+                             {'id': 'package-123'})
+
+        # The retained package is written back, so it must be fresh
+        cache.get.assert_not_called()
+        cache.set.assert_not_called()
+
     def test_get_oldest_dataset_count_exception(self):
         invalid_count_response = {
             'result': {
@@ -49,3 +101,249 @@ class TestCkanApiClient(unittest.TestCase):
             api = CkanApiClient('http://test', 'api-key-abc')
             with self.assertRaises(CkanApiCountException):
                 api.get_dataset('test-organization', 'package-123', is_collection=False)
+
+    def test_iter_datasets_keyset_pagination(self):
+        pages = [
+            StubResponse({'result': {'results': [{'id': 'a'}, {'id': 'b'}]}}),
+            StubResponse({'result': {'results': [{'id': 'c'}]}}),
+        ]
+
+        with mock.patch.object(CkanApiClient, 'request', side_effect=pages) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            datasets = list(api.iter_datasets('organization:"test-org"', batch=2))
+
+        self.assertEqual([d['id'] for d in datasets], ['a', 'b', 'c'])
+        first_params = mock_request.call_args_list[0][1]['params']
+        second_params = mock_request.call_args_list[1][1]['params']
+        self.assertEqual(first_params['fq'], 'organization:"test-org"')
+        self.assertEqual(second_params['fq'], '(organization:"test-org") AND id:{"b" TO *]')
+        self.assertEqual(second_params['sort'], 'id asc')
+
+    def test_iter_datasets_fields(self):
+        with mock.patch.object(CkanApiClient, 'request_stream', return_value=iter([{'id': 'a', 'name': 'x'}])) \
+                as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc', projection=True)
+            datasets = list(api.iter_datasets('type:dataset', fields=['id', 'name'], stream=True))
+
+        self.assertEqual(datasets, [{'id': 'a', 'name': 'x'}])
+        self.assertEqual(mock_request.call_args[1]['params']['fl'], ['id', 'name'])
+
+    def test_iter_package_names(self):
+        with mock.patch.object(CkanApiClient, 'request_stream', return_value=iter(['a', 'b', 'c'])) \
+                as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            names = list(api.iter_package_names())
+
+        self.assertEqual(names, ['a', 'b', 'c'])
+        # One snapshot, not offset pages
+        mock_request.assert_called_once_with('GET', '/action/package_list', prefix='result.item')
+
+    def test_find_indexed_names(self):
+        pages = [
+            StubResponse({'result': {'results': [{'name': 'a'}]}}),
+            StubResponse({'result': {'results': [{'name': 'harvest-source'}]}}),
+        ]
+
+        with mock.patch.object(CkanApiClient, 'request', side_effect=pages) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            indexed = api.find_indexed_names(['a', 'b', 'harvest-source'], chunk_size=2)
+
+        self.assertEqual(indexed, {'a', 'harvest-source'})
+        self.assertEqual(mock_request.call_args_list[0][1]['params']['fq'], '+dataset_type:* +name:("a" OR "b")')
+        self.assertEqual(mock_request.call_args_list[1][1]['params']['rows'], 1)
+
+    def test_iter_datasets_requires_id_sort(self):
+        api = CkanApiClient('http://test', 'api-key-abc')
+        with self.assertRaises(ValueError):
+            list(api.iter_datasets('type:dataset', sort='metadata_created asc'))
+
+    def test_iter_duplicate_groups(self):
+        page = StubResponse({'result': {'results': [package('1', extras=extras(identifier='id-a')),
+                                                    package('2', extras=extras(identifier='id-b')),
+                                                    package('3', extras=extras(identifier='id-a'))]}})
+
+        with mock.patch.object(CkanApiClient, 'request', return_value=page) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            groups = list(api.iter_duplicate_groups('test-org', ['id-a', 'id-b'], False))
+
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual([(identifier, [p['id'] for p in packages]) for identifier, packages in groups],
+                         [('id-a', ['1', '3']), ('id-b', ['2'])])
+        self.assertIn('identifier:("id-a" OR "id-b")', mock_request.call_args[1]['params']['fq'])
+
+    def test_get_datasets_projection(self):
+        projected_response = StubResponse({'result': {'results': [{
+            'id': 'package-123',
+            'name': 'package',
+            'organization': 'test-organization',
+            'extras_identifier': 'identifier-1',
+        }]}})
+
+        with mock.patch.object(CkanApiClient, 'request', return_value=projected_response) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc', projection=True)
+            datasets = api.get_datasets('test-organization', 'identifier-1')
+
+        self.assertIn('extras_identifier', mock_request.call_args[1]['params']['fl'])
+        self.assertEqual(datasets, [{
+            'id': 'package-123',
+            'name': 'package',
+            'organization': {'name': 'test-organization'},
+            'extras': [{'key': 'identifier', 'value': 'identifier-1'}],
+        }])
+
+    def test_full_package(self):
+        package = {'id': 'package-123'}
+        full_response = StubResponse({'result': {'id': 'package-123', 'resources': []}})
+        with mock.patch.object(CkanApiClient, 'request', return_value=full_response):
+            projected_api = CkanApiClient('http://test', 'api-key-abc', dry_run=False, projection=True)
+            self.assertEqual(projected_api.full_package(package), {'id': 'package-123', 'resources': []})
+
+            api = CkanApiClient('http://test', 'api-key-abc', dry_run=False)
+            self.assertIs(api.full_package(package), package)
+
+    def test_request_decodes_once(self):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'success': True, 'result': {'count': 1}}
+
+        with mock.patch.object(CkanApiClient, 'send', return_value=response):
+            api = CkanApiClient('http://test', 'api-key-abc')
+            api_response = api.request('GET', '/action/package_search')
+
+        self.assertEqual(api_response.result, {'count': 1})
+        self.assertEqual(api_response.json()['result'], {'count': 1})
+        response.json.assert_called_once_with()
+
+    def test_request_stream(self):
+        response = mock.Mock(status_code=200)
+        response.raw = io.BytesIO(b'{"success": true, "result": {"count": 2, "results": [{"id": "a"}, {"id": "b"}]}}')
+
+        with mock.patch.object(CkanApiClient, 'send', return_value=response):
+            api = CkanApiClient('http://test', 'api-key-abc')
+            items = list(api.request_stream('GET', '/action/package_search'))
+
+        self.assertEqual(items, [{'id': 'a'}, {'id': 'b'}])
+        response.close.assert_called_once_with()
+
+    def test_request_stream_failure(self):
+        for body in (b'{"success": false, "result": {"results": [{"id": "a"}]}}',
+                     b'{"result": {"results": [{"id": "a"}]}, "success": false}',
+                     b'{"result": {"results": [{"id": "a"}]}}'):
+            response = mock.Mock(status_code=200)
+            response.raw = io.BytesIO(body)
+
+            with mock.patch.object(CkanApiClient, 'send', return_value=response):
+                api = CkanApiClient('http://test', 'api-key-abc')
+                with self.assertRaises(CkanApiFailureException):
+                    list(api.request_stream('GET', '/action/package_search'))
+            response.close.assert_called_once_with()
+
+    def test_iter_datasets_reads_pages_before_yielding(self):
+        page = StubResponse({'result': {'results': [{'id': 'a'}]}})
+
+        with mock.patch.object(CkanApiClient, 'request', return_value=page) as mock_request, \
+                mock.patch.object(CkanApiClient, 'request_stream') as mock_stream:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            self.assertEqual(list(api.iter_datasets('type:dataset')), [{'id': 'a'}])
+
+        mock_request.assert_called_once()
+        mock_stream.assert_not_called()
+
+    def test_session_per_thread(self):
+        api = CkanApiClient('http://test', 'api-key-abc')
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(api.client))
+        thread.start()
+        thread.join()
+
+        self.assertIs(api.client, api.client)
+        self.assertIsNot(sessions[0], api.client)
+        self.assertEqual(sessions[0].headers['Authorization'], 'api-key-abc')
+
+    def test_send_records_metrics(self):
+        api_metrics = ApiMetrics()
+        api = CkanApiClient('http://test', 'api-key-abc', metrics=api_metrics)
+        response = mock.Mock(status_code=200, content=b'{"success": true}')
+        response.request.url = 'http://test/api/action/package_search?rows=0'
+        response.request.body = None
+        response.raw.retries.history = ()
+
+        with mock.patch.object(api.client, 'request', return_value=response):
+            api.send('GET', '/action/package_search', params={'rows': 0})
+
+        search = api_metrics.as_dict()['GET package_search']
+        self.assertEqual(search['requests'], 1)
+        self.assertEqual(search['bytes_in'], len(response.content))
+        self.assertEqual(search['statuses'], {'200': 1})
+
+    @mock.patch('time.sleep')
+    def test_send_retries_throttled_get(self, mock_sleep):
+        limiter = mock.Mock()
+        api = CkanApiClient('http://test', 'api-key-abc', read_limiter=limiter)
+        throttled = mock.Mock(status_code=429, content=b'', headers={'Retry-After': '2'})
+        throttled.request.url = 'http://test/api/action/package_search'
+        throttled.request.body = None
+        throttled.elapsed.total_seconds.return_value = 0.1
+        ok = mock.Mock(status_code=200, content=b'{"success": true}', headers={})
+        ok.request.url = 'http://test/api/action/package_search'
+        ok.request.body = None
+        ok.elapsed.total_seconds.return_value = 0.1
+
+        with mock.patch.object(api.client, 'request', side_effect=[throttled, ok]):
+            self.assertIs(api.send('GET', '/action/package_search'), ok)
+
+        limiter.throttled.assert_called_once_with()
+        limiter.succeeded.assert_called_once_with(0.1)
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 2)
+
+    def test_send_does_not_retry_post(self):
+        api = CkanApiClient('http://test', 'api-key-abc', dry_run=False)
+        unavailable = mock.Mock(status_code=503, content=b'', headers={})
+        unavailable.request.url = 'http://test/api/action/dataset_purge'
+        unavailable.request.body = b'{"id": "package-123"}'
+
+        with mock.patch.object(api.client, 'request', return_value=unavailable) as mock_request:
+            with self.assertRaises(CkanApiStatusException):
+                api.send('POST', '/action/dataset_purge', json={'id': 'package-123'})
+
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_get_packages(self):
+        pages = [
+            StubResponse({'result': {'results': [{'id': 'a'}, {'id': 'b'}]}}),
+            StubResponse({'result': {'results': [{'id': 'd'}]}}),
+        ]
+
+        with mock.patch.object(CkanApiClient, 'request', side_effect=pages) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            packages = api.get_packages(['a', 'b', 'c', 'd'], chunk_size=3)
+
+        self.assertEqual(sorted(packages), ['a', 'b', 'd'])
+        params = mock_request.call_args_list[0][1]['params']
+        self.assertEqual(params['fq'], 'id:("a" OR "b" OR "c")')
+        self.assertEqual(params['rows'], 3)
+
+    def test_get_collection_index(self):
+        def member(package_id, collection_package_id):
+            return {'id': package_id, 'extras_collection_package_id': collection_package_id}
+
+        members = [member('a', 'parent-1'), member('b', 'parent-2'), member('c', 'parent-1')]
+        with mock.patch.object(CkanApiClient, 'iter_datasets', return_value=iter(members)) as mock_iter:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            index = api.get_collection_index('test-org')
+
+        mock_iter.assert_called_once_with(
+            'organization:"test-org" AND type:dataset AND collection_package_id:*',
+            fields=['id', 'extras_collection_package_id'])
+        # Only ids are held, the members are fetched fresh when they're updated
+        self.assertEqual(index, {'parent-1': ['a', 'c'], 'parent-2': ['b']})
+
+    def test_get_package(self):
+        missing = mock.Mock(status_code=404)
+        with mock.patch.object(CkanApiClient, 'request',
+                               side_effect=[StubResponse({'result': {'id': 'a'}}),
+                                            CkanApiStatusException('Not found', missing)]) as mock_request:
+            api = CkanApiClient('http://test', 'api-key-abc')
+            self.assertEqual(api.get_package('a'), {'id': 'a'})
+            self.assertIsNone(api.get_package('b'))
+
+        mock_request.assert_called_with('GET', '/action/package_show', params={'id': 'b'})
@@ -1,12 +1,20 @@
 from __future__ import absolute_import
+import io
+import os
+import shutil
+import tempfile
 import unittest
 
 import mock
 
-from ..ckan_api import CkanApiClient
+from ..ckan_api import CkanApiClient, CkanApiCountException, CkanApiFailureException, CkanApiStatusException
 from ..deduper import Deduper
 from ..audit import DuplicatePackageLog, RemovedPackageLog
+from ..audit_store import AuditStore, export_removed
+from ..journal import COMMITTED, PLANNED, PURGED, Journal
+from ..writer import WriteBehind
 from .. import util
+from .fixtures import extras, package
 
 
 class TestDeduper(unittest.TestCase):
@@ -16,6 +24,9 @@ class TestDeduper(unittest.TestCase):
         self.collection_package_log = mock.Mock(RemovedPackageLog)
 
         self.ckan_api = mock.Mock(CkanApiClient)
+        self.ckan_api.dry_run = False
+        self.ckan_api.full_package.side_effect = lambda package: package
+        self.ckan_api.get_collection_index.return_value = {}
         self.deduper = Deduper('test-org',
                                self.ckan_api,
                                removed_package_log=self.removed_package_log,
@@ -24,13 +35,15 @@ class TestDeduper(unittest.TestCase):
                                update_name=True)
 
     def test_remove_duplicate(self):
-        self.ckan_api.get_datasets_in_collection.return_value = [{
+        self.ckan_api.get_collection_index.return_value = {'123': ['child-1']}
+        self.ckan_api.get_package.return_value = {
+            "id": "child-1",
             "title": "dataset-in-collection",
             "extras": [{
                 "key": "collection_package_id",
                 "value": "123"
             }]
-        }]
+        }
         duplicate = {'id': '123', 'name': 'duplicate-package'}
         retained = {'id': '456', 'name': 'retained-package'}
 
@@ -42,34 +55,56 @@ class TestDeduper(unittest.TestCase):
 
         self.collection_package_log.add.assert_called_once_with(retained['id'])
 
+    def test_remove_duplicate_syncs_audit_logs_first(self):
+        calls = mock.Mock()
+        calls.attach_mock(self.removed_package_log.sync, 'removed_sync')
+        calls.attach_mock(self.duplicate_package_log.sync, 'duplicate_sync')
+        calls.attach_mock(self.ckan_api.remove_package, 'remove_package')
+
+        self.deduper.remove_duplicate({'id': '123', 'name': 'duplicate-package'},
+                                      {'id': '456', 'name': 'retained-package'})
+
+        self.assertEqual(calls.mock_calls, [mock.call.removed_sync(), mock.call.duplicate_sync(),
+                                            mock.call.remove_package('123')])
+
     def test_update_name(self):
-        self.ckan_api.get_datasets_in_collection.return_value = []
-        name_extra_characters = {'id': 'to-be-kept', 'name': 'normal-name-12345'}
-        normal_name = {'id': 'duplicate', 'name': 'normal-name'}
+        retained = package('to-be-kept', 'normal-name-12345', '2020-01-01T00:00:00')
+        datasets = [
+            retained,
+            package('duplicate-1', 'normal-name-1', '2021-01-01T00:00:00'),
+            package('duplicate-2', 'normal-name', '2022-01-01T00:00:00'),
+        ]
+
+        self.deduper.dedupe_identifier('id-a', datasets=datasets)
 
-        # The normal name is considered the duplicate in this case
-        self.deduper.remove_duplicate(normal_name, name_extra_characters)
-        # Validate that the to-be-kept
-        self.removed_package_log.add.assert_called_with({'id': 'to-be-kept', 'name': 'normal-name'})
+        # The shortest name is chosen once, and the rename goes out with the
+        # run record in a single update
+        self.ckan_api.update_package.assert_called_once_with(retained)
+        self.assertEqual(retained['name'], 'normal-name')
+        self.assertEqual(util.get_package_extra(retained, 'datagov_dedupe_retained'), self.deduper.run_id)
+        self.removed_package_log.add.assert_called_with(retained)
 
-    def test_mark_retained_package(self):
-        identifier = 'harvest-identifier-1'
+    def test_update_name_duplicate_not_removed(self):
+        self.ckan_api.remove_package.side_effect = CkanApiStatusException('conflict', None)
+        retained = package('to-be-kept', 'normal-name-12345', '2020-01-01T00:00:00')
+        duplicate = package('duplicate', 'normal-name', '2021-01-01T00:00:00')
+
+        self.deduper.dedupe_identifier('id-a', datasets=[retained, duplicate])
+
+        # The name is still taken, so the retained package keeps its own
+        self.assertEqual(retained['name'], 'normal-name-12345')
+        self.ckan_api.update_package.assert_called_once_with(retained)
+
+    def test_commit_retained_package_unchanged(self):
         retained = {
             'id': '456',
             'name': 'retained-package',
-            'extras': [
-                {'key': 'identifier', 'value': identifier},
-            ],
+            'extras': [{'key': 'datagov_dedupe_retained', 'value': self.deduper.run_id}],
         }
-        self.deduper.mark_retained_package(retained)
 
-        self.ckan_api.update_package.assert_called_once_with(retained)
+        self.deduper.commit_retained_package(retained)
 
-        # Package should be recorded with the current run id
-        extra_keys = [extra['key'] for extra in retained['extras']]
-        assert 'datagov_dedupe' in extra_keys
-        datagov_dedupe = util.get_package_extra(retained, 'datagov_dedupe')
-        self.assertEqual(datagov_dedupe, self.deduper.run_id)
+        self.ckan_api.update_package.assert_not_called()
 
     def test_commit_retained_package(self):
         retained = {
@@ -88,3 +123,380 @@ class TestDeduper(unittest.TestCase):
                          'Expected datagov_dedupe extra to be removed from package')
         self.assertIn('datagov_dedupe_retained', extra_keys)
         self.ckan_api.update_package.assert_called_once_with(retained)
+
+    def test_dedupe_identifier_grouped(self):
+        oldest = package('1', metadata_modified='2020-01-01T00:00:00')
+        newer = package('2', metadata_modified='2021-01-01T00:00:00')
+        newest = package('3', metadata_modified='2022-01-01T00:00:00')
+
+        duplicate_count = self.deduper.dedupe_identifier('id-a', datasets=[newer, oldest, newest])
+
+        self.assertEqual(duplicate_count, 2)
+        self.ckan_api.get_dataset_count.assert_not_called()
+        self.ckan_api.get_dataset.assert_not_called()
+        self.ckan_api.iter_datasets.assert_not_called()
+        self.assertEqual(self.ckan_api.remove_package.call_args_list,
+                         [mock.call('2'), mock.call('3')])
+
+    def test_dedupe_returns_total(self):
+        self.ckan_api.get_duplicate_identifiers.side_effect = [['id-a', 'id-b'], ['id-c']]
+
+        with mock.patch.object(self.deduper, 'dedupe_identifier', return_value=2):
+            self.assertEqual(self.deduper.dedupe(), 6)
+
+    def test_dedupe_stopped(self):
+        self.ckan_api.get_duplicate_identifiers.return_value = ['id-a']
+        self.deduper.stop()
+
+        with mock.patch.object(self.deduper, 'dedupe_identifier') as dedupe_identifier:
+            self.assertIsNone(self.deduper.dedupe())
+        dedupe_identifier.assert_not_called()
+
+    def test_dedupe_identifier_workers(self):
+        self.deduper.identifier_workers = 4
+        identifiers = ['id-%d' % i for i in range(20)]
+        self.ckan_api.get_duplicate_identifiers.side_effect = [identifiers, []]
+
+        def dedupe_identifier(identifier, is_collection, datasets):
+            if identifier == 'id-3':
+                raise CkanApiFailureException('failed', None)
+            if identifier == 'id-4':
+                raise CkanApiCountException('bad count', None)
+            return 1
+
+        with mock.patch.object(self.deduper, 'dedupe_identifier', side_effect=dedupe_identifier) as mock_dedupe:
+            self.assertEqual(self.deduper.dedupe(), 18)
+        self.assertEqual(sorted(call[0][0] for call in mock_dedupe.call_args_list), sorted(identifiers))
+
+    def test_dedupe_identifier_workers_stopped(self):
+        self.deduper.identifier_workers = 2
+        self.ckan_api.get_duplicate_identifiers.return_value = ['id-%d' % i for i in range(20)]
+
+        def dedupe_identifier(identifier, is_collection, datasets):
+            self.deduper.stop()
+            return 1
+
+        with mock.patch.object(self.deduper, 'dedupe_identifier', side_effect=dedupe_identifier) as mock_dedupe:
+            self.assertIsNone(self.deduper.dedupe())
+        # Only the identifiers already queued when it stopped were started
+        self.assertLessEqual(mock_dedupe.call_count, 4)
+
+    def test_plan_identifier(self):
+        plan = mock.Mock()
+        self.deduper.plan = plan
+        self.ckan_api.get_collection_index.return_value = {'2': ['child-1']}
+
+        datasets = [
+            package('1', 'package-a-1', '2020-01-01T00:00:00'),
+            package('2', 'package-a', '2021-01-01T00:00:00'),
+            package('3', 'package-a-2', '2022-01-01T00:00:00'),
+        ]
+
+        self.assertEqual(self.deduper.dedupe_identifier('id-a', datasets=datasets), 2)
+
+        self.ckan_api.update_package.assert_not_called()
+        self.ckan_api.remove_package.assert_not_called()
+        entry = plan.add.call_args[0][0]
+        self.assertEqual(entry['retained']['id'], '1')
+        self.assertEqual([duplicate['id'] for duplicate in entry['duplicates']], ['2', '3'])
+        self.assertEqual(entry['collection_children'], {'2': ['child-1']})
+        self.assertEqual(entry['rename'], 'package-a')
+
+    def test_apply_plan(self):
+        retained = package('1', 'package-a-1')
+        duplicate = package('2', 'package-a')
+        child = package('4', 'child', extras=extras(collection_package_id='2'))
+        entry = {
+            'organization': 'test-org',
+            'identifier_type': 'identifier',
+            'identifier': 'id-a',
+            'is_collection': False,
+            'retained': {'id': '1', 'name': 'package-a-1', 'metadata_modified': '2020-01-01T00:00:00'},
+            'duplicates': [
+                {'id': '2', 'name': 'package-a', 'metadata_modified': '2020-01-01T00:00:00'},
+                {'id': '3', 'name': 'package-a-2', 'metadata_modified': '2020-01-01T00:00:00'},
+            ],
+            'collection_children': {'2': ['4']},
+            'rename': 'package-a',
+        }
+        # Package 3 was already removed
+        self.ckan_api.get_packages.return_value = {'1': retained, '2': duplicate}
+        self.ckan_api.get_package.return_value = child
+
+        self.assertEqual(self.deduper.apply_plan([entry]), 1)
+
+        self.ckan_api.get_packages.assert_called_once_with({'1', '2', '3'})
+        self.ckan_api.get_package.assert_called_once_with('4')
+        self.ckan_api.get_collection_index.assert_not_called()
+        self.ckan_api.get_dataset.assert_not_called()
+        self.ckan_api.remove_package.assert_called_once_with('2')
+        self.assertEqual(util.get_package_extra(child, 'collection_package_id'), '1')
+        self.assertEqual(retained['name'], 'package-a')
+        self.assertEqual(util.get_package_extra(retained, 'datagov_dedupe_retained'), self.deduper.run_id)
+        self.assertEqual(self.ckan_api.update_package.call_args_list, [mock.call(child), mock.call(retained)])
+
+    def test_apply_plan_repointed_members_not_stale(self):
+        def entry(identifier, is_collection, retained_id, duplicate_id, collection_children=None):
+            return {
+                'organization': 'test-org',
+                'identifier_type': 'identifier',
+                'identifier': identifier,
+                'is_collection': is_collection,
+                'retained': {'id': retained_id, 'name': 'package-%s' % retained_id,
+                             'metadata_modified': '2020-01-01T00:00:00'},
+                'duplicates': [{'id': duplicate_id, 'name': 'package-%s' % duplicate_id,
+                                'metadata_modified': '2020-01-01T00:00:00'}],
+                'collection_children': collection_children or {},
+                'rename': None,
+            }
+
+        child = package('4', extras=extras(collection_package_id='2'))
+        self.ckan_api.get_package.return_value = child
+        # Re-pointing child 4 in the first group bumped its metadata_modified
+        self.ckan_api.get_packages.side_effect = [
+            {'1': package('1'), '2': package('2')},
+            {'4': package('4', metadata_modified='2022-01-01T00:00:00'), '5': package('5')},
+        ]
+
+        applied = self.deduper.apply_plan([entry('id-a', False, '1', '2', {'2': ['4']}),
+                                           entry('id-b', True, '4', '5')], batch_size=1)
+
+        self.assertEqual(applied, 2)
+        self.assertEqual(self.ckan_api.remove_package.call_args_list, [mock.call('2'), mock.call('5')])
+
+    def test_apply_plan_stale(self):
+        entry = {
+            'organization': 'test-org',
+            'identifier_type': 'identifier',
+            'identifier': 'id-a',
+            'is_collection': False,
+            'retained': {'id': '1', 'name': 'package-a', 'metadata_modified': '2020-01-01T00:00:00'},
+            'duplicates': [{'id': '2', 'name': 'package-a-1', 'metadata_modified': '2020-01-01T00:00:00'}],
+            'collection_children': {},
+            'rename': None,
+        }
+        self.ckan_api.get_packages.return_value = {
+            '1': {'id': '1', 'name': 'package-a', 'metadata_modified': '2021-01-01T00:00:00', 'extras': []},
+            '2': {'id': '2', 'name': 'package-a-1', 'metadata_modified': '2020-01-01T00:00:00', 'extras': []},
+        }
+
+        self.assertEqual(self.deduper.apply_plan([entry]), 0)
+        self.ckan_api.update_package.assert_not_called()
+        self.ckan_api.remove_package.assert_not_called()
+
+    def test_dedupe_shard(self):
+        identifiers = ['id-%d' % i for i in range(100)]
+        self.ckan_api.get_duplicate_identifiers.side_effect = lambda organization, is_collection: \
+            identifiers if not is_collection else []
+
+        shards = []
+        for index in (1, 2, 3):
+            self.deduper.shard = (index, 3)
+            with mock.patch.object(self.deduper, 'dedupe_identifier', return_value=1) as dedupe_identifier:
+                self.deduper.dedupe()
+            shards.append([call[0][0] for call in dedupe_identifier.call_args_list])
+
+        # Every identifier lands in exactly one shard
+        self.assertEqual(sorted(sum(shards, [])), sorted(identifiers))
+        for shard in shards:
+            self.assertTrue(shard)
+
+    def test_dedupe_journal_skips_committed(self):
+        journal = mock.Mock(Journal)
+        journal.committed.side_effect = [{'id-a'}, set()]
+        self.deduper.journal = journal
+        self.ckan_api.get_duplicate_identifiers.side_effect = [['id-a', 'id-b'], []]
+
+        with mock.patch.object(self.deduper, 'dedupe_identifier', return_value=1) as dedupe_identifier:
+            self.assertEqual(self.deduper.dedupe(), 1)
+        dedupe_identifier.assert_called_once_with('id-b', False, None)
+        journal.committed.assert_any_call('test-org', 'identifier', False)
+
+    def test_dedupe_identifier_journal_without_markers(self):
+        journal = mock.Mock(Journal)
+        self.deduper.journal = journal
+        self.deduper.mark_retained = False
+        self.deduper.update_name = False
+
+        datasets = [
+            package('1', 'package-a', '2020-01-01T00:00:00'),
+            package('2', 'package-b', '2021-01-01T00:00:00'),
+        ]
+
+        self.assertEqual(self.deduper.dedupe_identifier('id-a', datasets=datasets), 1)
+
+        self.ckan_api.update_package.assert_not_called()
+        self.ckan_api.remove_package.assert_called_once_with('2')
+        self.assertEqual([call[0][:2] for call in journal.record.call_args_list],
+                         [('test-org', 'identifier')] * 3)
+        self.assertEqual([call[0][4] for call in journal.record.call_args_list],
+                         [PLANNED, PURGED, COMMITTED])
+
+    def test_dedupe_identifier_journal_dry_run(self):
+        journal = mock.Mock(Journal)
+        self.deduper.journal = journal
+        self.ckan_api.dry_run = True
+
+        datasets = [
+            package('1', 'package-a', '2020-01-01T00:00:00'),
+            package('2', 'package-b', '2021-01-01T00:00:00'),
+        ]
+
+        self.deduper.dedupe_identifier('id-a', datasets=datasets)
+        journal.record.assert_not_called()
+
+    def test_collection_index_built_once(self):
+        members = [package(child_id, extras=extras(collection_package_id=parent_id))
+                   for child_id, parent_id in (('child-1', 'dup-1'), ('child-2', 'dup-1'), ('child-3', 'dup-2'))]
+        self.ckan_api.get_collection_index.return_value = {'dup-1': ['child-1', 'child-2'], 'dup-2': ['child-3']}
+        self.ckan_api.get_package.side_effect = dict((m['id'], m) for m in members).get
+        retained = {'id': 'retained', 'name': 'retained'}
+
+        self.deduper.update_collection_datasets({'id': 'dup-1', 'name': 'dup-1'}, retained)
+        self.deduper.update_collection_datasets({'id': 'dup-2', 'name': 'dup-2'}, retained)
+
+        self.ckan_api.get_collection_index.assert_called_once_with('test-org')
+        self.assertEqual(self.ckan_api.update_package.call_count, 3)
+        for member in members:
+            self.assertEqual(util.get_package_extra(member, 'collection_package_id'), 'retained')
+        # The index follows the members to the retained package
+        self.assertEqual(self.deduper.collection_members('dup-1'), [])
+        self.assertEqual(sorted(self.deduper.collection_members('retained')), ['child-1', 'child-2', 'child-3'])
+
+    def test_collection_members_fetched_fresh(self):
+        # child-1 was re-pointed and child-2 removed since the index was built
+        moved = package('child-1', extras=extras(collection_package_id='other'))
+        self.ckan_api.get_collection_index.return_value = {'dup-1': ['child-1', 'child-2']}
+        self.ckan_api.get_package.side_effect = {'child-1': moved}.get
+
+        self.deduper.update_collection_datasets({'id': 'dup-1', 'name': 'dup-1'}, {'id': 'retained'})
+
+        self.ckan_api.update_package.assert_not_called()
+        self.assertEqual(util.get_package_extra(moved, 'collection_package_id'), 'other')
+        self.assertEqual(self.deduper.collection_members('retained'), [])
+
+    def test_dedupe_identifier_write_behind(self):
+        writer = WriteBehind(workers=2)
+        self.deduper.writer = writer
+        calls = []
+        self.ckan_api.remove_package.side_effect = lambda package_id: calls.append(('remove', package_id))
+        self.ckan_api.update_package.side_effect = lambda package: calls.append(('update', package['id']))
+        self.removed_package_log.add.side_effect = lambda package: calls.append(('log', package['id']))
+
+        retained = package('1', 'package-a-1', '2020-01-01T00:00:00')
+        datasets = [retained,
+                    package('2', 'package-a', '2021-01-01T00:00:00'),
+                    package('3', 'package-a-22', '2022-01-01T00:00:00')]
+
+        self.assertEqual(self.deduper.dedupe_identifier('id-a', datasets=datasets), 2)
+        self.deduper.wait_for_writes()
+        writer.close()
+
+        # Each duplicate is logged before its purge, and the retained package
+        # is committed, renamed, after its duplicates are gone
+        self.assertEqual(calls, [('log', '2'), ('remove', '2'), ('log', '3'), ('remove', '3'),
+                                 ('update', '1'), ('log', '1')])
+        self.assertEqual(retained['name'], 'package-a')
+
+    def test_write_behind_syncs_audit_logs_first(self):
+        writer = WriteBehind(workers=1)
+        self.deduper.writer = writer
+        calls = mock.Mock()
+        calls.attach_mock(self.removed_package_log.sync, 'removed_sync')
+        calls.attach_mock(self.duplicate_package_log.sync, 'duplicate_sync')
+        calls.attach_mock(self.ckan_api.remove_package, 'remove_package')
+
+        retained = package('1', 'package-a', '2020-01-01T00:00:00')
+        duplicate = dict(retained, id='2', metadata_modified='2021-01-01T00:00:00')
+
+        self.deduper.dedupe_identifier('id-a', datasets=[retained, duplicate])
+        self.deduper.wait_for_writes()
+        writer.close()
+
+        self.assertEqual(calls.mock_calls, [mock.call.removed_sync(), mock.call.duplicate_sync(),
+                                            mock.call.remove_package('2')])
+
+    def test_write_behind_audit_store_synced_before_purge(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'audit.sqlite')
+        store = AuditStore(filename, 'run-1')
+        self.deduper.removed_package_log = store.removed_log()
+        self.deduper.duplicate_package_log = store.duplicate_log()
+        writer = WriteBehind(workers=1)
+        self.deduper.writer = writer
+
+        def remove_package(package_id):
+            f = io.StringIO()
+            export_removed(filename, f)
+            recorded.append(f.getvalue().count('\n'))
+        recorded = []
+        self.ckan_api.remove_package.side_effect = remove_package
+
+        self.deduper.dedupe_identifier('id-a', datasets=[package('1', metadata_modified='2020-01-01T00:00:00'),
+                                                         package('2', metadata_modified='2021-01-01T00:00:00'),
+                                                         package('3', metadata_modified='2022-01-01T00:00:00')])
+        self.deduper.wait_for_writes()
+        writer.close()
+        store.close()
+
+        # Each removed package was in the database when its purge was made
+        self.assertEqual(recorded, [1, 2])
+
+    @mock.patch('dedupe.writer.time.sleep')
+    def test_dedupe_identifier_write_behind_retry(self, mock_sleep):
+        writer = WriteBehind(workers=1)
+        self.deduper.writer = writer
+        # The first purge goes through but its response is lost
+        self.ckan_api.remove_package.side_effect = [
+            CkanApiStatusException('unavailable', mock.Mock(status_code=503)),
+            CkanApiStatusException('not found', mock.Mock(status_code=404)),
+        ]
+
+        retained = package('1', 'package-a-1', '2020-01-01T00:00:00')
+        duplicate = package('2', 'package-a', '2021-01-01T00:00:00')
+
+        self.deduper.dedupe_identifier('id-a', datasets=[retained, duplicate])
+        self.deduper.wait_for_writes()
+        writer.close()
+
+        # Only the purge was retried, and the package was logged once
+        self.assertEqual(self.ckan_api.full_package.call_count, 2)
+        self.assertEqual(self.ckan_api.remove_package.call_count, 2)
+        self.duplicate_package_log.add.assert_called_once_with(duplicate, retained)
+        # The retry's 404 counts as removed, so the retained package takes its name
+        self.assertEqual(retained['name'], 'package-a')
+
+    def test_prefetched_groups(self):
+        self.deduper.prefetch = 2
+        self.deduper.prefetch_max_packages = 2
+        groups = {
+            'id-a': [{'id': '1'}, {'id': '2'}],
+            'id-b': [{'id': '3'}, {'id': '4'}, {'id': '5'}],
+            'id-c': CkanApiFailureException('failed', None),
+            'id-d': [{'id': '6'}, {'id': '7'}],
+        }
+        self.ckan_api.identifier_filter_query.side_effect = lambda org, identifier, is_collection: identifier
+
+        def iter_datasets(identifier):
+            if isinstance(groups[identifier], Exception):
+                raise groups[identifier]
+            return iter(groups[identifier])
+        self.ckan_api.iter_datasets.side_effect = iter_datasets
+
+        result = list(self.deduper.prefetched_groups(['id-a', 'id-b', 'id-c', 'id-d'], False))
+
+        # Oversized and failed groups are left for dedupe_identifier to fetch
+        self.assertEqual(result, [('id-a', groups['id-a']), ('id-b', None), ('id-c', None), ('id-d', groups['id-d'])])
+
+    def test_prefetched_groups_stopped(self):
+        self.deduper.prefetch = 2
+        self.ckan_api.iter_datasets.return_value = iter([])
+
+        groups = self.deduper.prefetched_groups(['id-%d' % i for i in range(10)], False)
+        next(groups)
+        self.deduper.stop()
+        groups.close()
+
+        # Only the window was ever fetched
+        self.assertLessEqual(self.ckan_api.iter_datasets.call_count, 3)
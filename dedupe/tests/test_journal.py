@@ -0,0 +1,42 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..journal import COMMITTED, PLANNED, PURGED, Journal
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'journal.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record_state(self):
+        journal = Journal(self.filename, 'run-1')
+        self.assertIsNone(journal.state('test-org', 'identifier', 'id-a', False))
+
+        journal.record('test-org', 'identifier', 'id-a', False, PLANNED, 'package-1')
+        journal.record('test-org', 'identifier', 'id-a', False, PURGED, 'package-1')
+        self.assertEqual(journal.state('test-org', 'identifier', 'id-a', False), PURGED)
+        # Collection and non-collection groups are separate
+        self.assertIsNone(journal.state('test-org', 'identifier', 'id-a', True))
+        # And so are identifier and guid groups with the same value
+        self.assertIsNone(journal.state('test-org', 'guid', 'id-a', False))
+
+    def test_committed_survives_reopen(self):
+        journal = Journal(self.filename, 'run-1')
+        journal.record('test-org', 'identifier', 'id-a', False, COMMITTED, 'package-1')
+        journal.record('test-org', 'identifier', 'id-b', False, PURGED, 'package-2')
+        journal.close()
+
+        journal = Journal(self.filename, 'run-1')
+        self.assertEqual(journal.committed('test-org', 'identifier', False), {'id-a'})
+        self.assertEqual(journal.committed('test-org', 'guid', False), set())
+        self.assertEqual(journal.committed('other-org', 'identifier', False), set())
+
+        # Another run starts from scratch
+        self.assertEqual(Journal(self.filename, 'run-2').committed('test-org', 'identifier', False), set())
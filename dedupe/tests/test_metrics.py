@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..metrics import ApiMetrics, LatencyHistogram, format_summary
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_quantile(self):
+        histogram = LatencyHistogram(buckets=(1, 2, float('inf')))
+        for seconds in (0.5, 0.5, 1.5, 1.5, 3):
+            histogram.observe(seconds)
+
+        self.assertEqual(histogram.quantile(0.4), 1)
+        self.assertEqual(histogram.quantile(0.8), 2)
+        self.assertEqual(histogram.quantile(1), 3)
+
+    def test_quantile_empty(self):
+        self.assertIsNone(LatencyHistogram().quantile(0.5))
+
+
+class TestApiMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.metrics = ApiMetrics()
+        self.metrics.record('package_search', 'GET', 200, 0.2, bytes_in=1000, bytes_out=100)
+        self.metrics.record('package_search', 'GET', 503, 1.2, bytes_out=100, retries=1)
+        self.metrics.record('dataset_purge', 'POST', 200, 3.0, bytes_in=50, bytes_out=20)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_dump_json(self):
+        filename = os.path.join(self.tmpdir, 'metrics.json')
+        self.metrics.dump_json(filename)
+
+        with open(filename) as f:
+            data = json.load(f)
+
+        search = data['GET package_search']
+        self.assertEqual(search['requests'], 2)
+        self.assertEqual(search['bytes_in'], 1000)
+        self.assertEqual(search['bytes_out'], 200)
+        self.assertEqual(search['retries'], 1)
+        self.assertEqual(search['statuses'], {'200': 1, '503': 1})
+        self.assertIn('p99', search['latency']['quantiles'])
+        self.assertIn('POST dataset_purge', format_summary(data))
+
+    def test_dump_prometheus(self):
+        filename = os.path.join(self.tmpdir, 'dedupe.prom')
+        self.metrics.dump_prometheus(filename)
+
+        with open(filename) as f:
+            lines = f.read().splitlines()
+
+        self.assertIn('dedupe_ckan_requests_total{action="package_search",method="GET",status="503"} 1', lines)
+        self.assertIn('dedupe_ckan_request_duration_seconds_bucket'
+                      '{action="dataset_purge",method="POST",le="+Inf"} 1', lines)
+        self.assertIn('dedupe_ckan_request_duration_seconds_count{action="package_search",method="GET"} 2', lines)
+        self.assertEqual(os.listdir(self.tmpdir), ['dedupe.prom'])
@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..plan import PlanWriter, entry_package_ids, plan_entry, read_plan, stale_reason
+from .fixtures import package
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.entry = plan_entry('test-org', 'identifier', 'id-a', False,
+                                package('1'), [package('2'), package('3')],
+                                collection_children={'2': ['4']}, rename='package-2')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        filename = os.path.join(self.tmpdir, 'plan.jsonl')
+        writer = PlanWriter(filename)
+        writer.add(self.entry)
+        writer.add(self.entry)
+        writer.close()
+
+        self.assertEqual(list(read_plan(filename)), [self.entry, self.entry])
+
+    def test_entry_package_ids(self):
+        self.assertEqual(entry_package_ids(self.entry), ['1', '2', '3'])
+
+    def test_stale_reason(self):
+        packages = {'1': package('1'), '2': package('2')}
+        # A missing duplicate was already removed
+        self.assertIsNone(stale_reason(self.entry, packages))
+
+        packages['2'] = package('2', metadata_modified='2021-01-01T00:00:00')
+        self.assertEqual(stale_reason(self.entry, packages), 'duplicate package 2 was modified')
+
+        self.assertEqual(stale_reason(self.entry, {}), 'retained package is gone')
+
+    def test_stale_reason_modified_retained(self):
+        modified = package('1', metadata_modified='2021-01-01T00:00:00')
+        self.assertEqual(stale_reason(self.entry, {'1': modified}), 'retained package was modified')
+
+    def test_stale_reason_applied_ids(self):
+        packages = {'1': package('1', metadata_modified='2021-01-01T00:00:00'),
+                    '2': package('2', metadata_modified='2021-01-01T00:00:00')}
+        self.assertIsNone(stale_reason(self.entry, packages, applied_ids={'1', '2'}))
+        self.assertEqual(stale_reason(self.entry, packages, applied_ids={'1'}), 'duplicate package 2 was modified')
+
+    def test_stale_reason_projected_entry(self):
+        # Planned from projected search results, which have SOLR's timestamps
+        entry = plan_entry('test-org', 'identifier', 'id-a', False,
+                           package('1', metadata_modified='2020-01-01T00:00:00.123Z'),
+                           [package('2', metadata_modified='2020-01-02T00:00:00.456Z')])
+        packages = {
+            '1': package('1', metadata_modified='2020-01-01T00:00:00.123456'),
+            '2': package('2', metadata_modified='2020-01-02T00:00:00.456789'),
+        }
+        self.assertIsNone(stale_reason(entry, packages))
+
+        packages['1'] = package('1', metadata_modified='2020-01-01T00:00:00.124000')
+        self.assertEqual(stale_reason(entry, packages), 'retained package was modified')
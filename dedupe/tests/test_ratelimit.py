@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+import unittest
+
+import mock
+
+from ..ratelimit import AdaptiveRateLimiter, TokenBucket, retry_delay
+
+
+class TestTokenBucket(unittest.TestCase):
+    @mock.patch('time.monotonic', return_value=100.0)
+    def test_reserve(self, mock_monotonic):
+        bucket = TokenBucket(rate=2, burst=2)
+
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1.0)
+
+
+class TestAdaptiveRateLimiter(unittest.TestCase):
+    def test_additive_increase(self):
+        limiter = AdaptiveRateLimiter('read', rate=5, max_rate=6, increase=5)
+        for _ in range(10):
+            limiter.succeeded(0.1)
+
+        self.assertEqual(limiter.rate, 6)
+
+    def test_throttled_backs_off_once_per_cooldown(self):
+        limiter = AdaptiveRateLimiter('read', rate=8, cooldown=60)
+        limiter.throttled()
+        limiter.throttled()
+
+        self.assertEqual(limiter.rate, 4)
+
+    def test_slow_latency_backs_off(self):
+        limiter = AdaptiveRateLimiter('write', rate=8, latency_target=1, min_rate=3)
+        limiter.succeeded(10)
+
+        self.assertEqual(limiter.rate, 4)
+        limiter._decreased = 0
+        limiter.succeeded(10)
+        self.assertEqual(limiter.rate, 3)
+
+
+class TestRetryDelay(unittest.TestCase):
+    def test_retry_after(self):
+        self.assertGreaterEqual(retry_delay(0, retry_after='7'), 7)
+
+    def test_jitter_is_capped(self):
+        for attempt in range(10):
+            self.assertLessEqual(retry_delay(attempt, cap=4), 4)
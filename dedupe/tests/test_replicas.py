@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+import unittest
+
+import mock
+import requests
+
+from ..ckan_api import CkanApiClient
+from ..replicas import ReplicaPool
+
+
+class TestReplicaPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ReplicaPool(['http://read-1', 'http://read-2'], failure_threshold=2)
+
+    def test_prefers_lower_latency(self):
+        slow, fast = self.pool.replicas
+        slow.latency = 1.0
+        fast.latency = 0.1
+
+        self.assertIs(self.pool.acquire(), fast)
+
+    def test_spreads_outstanding_requests(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+
+        self.assertIsNot(first, second)
+
+    def test_ejects_failing_replica(self):
+        failing, healthy = self.pool.replicas
+        for _ in range(2):
+            failing.outstanding += 1
+            self.pool.release(failing, ok=False)
+
+        self.assertTrue(failing.ejected_until > 0)
+        for _ in range(5):
+            replica = self.pool.acquire()
+            self.assertIs(replica, healthy)
+            self.pool.release(replica, latency=0.5)
+
+
+class TestCkanApiClientReplicas(unittest.TestCase):
+    def test_reads_use_replicas_writes_pinned(self):
+        api = CkanApiClient('http://write', 'api-key-abc', dry_run=False,
+                            api_read_url=['http://read-1', 'http://read-2'])
+        response = mock.Mock(status_code=200, content=b'{}', headers={})
+        response.request.url = ''
+        response.request.body = None
+        response.elapsed.total_seconds.return_value = 0.1
+
+        with mock.patch.object(api.client, 'request', return_value=response) as mock_request:
+            api.send('GET', '/action/package_search')
+            api.send('POST', '/action/package_update')
+
+        read_url = mock_request.call_args_list[0][0][1]
+        write_url = mock_request.call_args_list[1][0][1]
+        self.assertTrue(read_url.startswith('http://read-'))
+        self.assertEqual(write_url, 'http://write/api/action/package_update')
+
+    def test_replica_released_on_any_error(self):
+        api = CkanApiClient('http://write', 'api-key-abc', api_read_url=['http://read-1'])
+
+        with mock.patch.object(api.client, 'request', side_effect=ValueError('bad url')):
+            with self.assertRaises(ValueError):
+                api.send('GET', '/action/package_search')
+
+        replica, = api.read_replicas.replicas
+        self.assertEqual(replica.outstanding, 0)
+
+    @mock.patch('dedupe.ckan_api.time.sleep')
+    def test_connection_error_retried_with_backoff(self, mock_sleep):
+        api = CkanApiClient('http://write', 'api-key-abc', api_read_url=['http://read-1', 'http://read-2'])
+        response = mock.Mock(status_code=200, content=b'{}', headers={})
+        response.request.url = ''
+        response.request.body = None
+        response.elapsed.total_seconds.return_value = 0.1
+
+        with mock.patch.object(api.client, 'request',
+                               side_effect=[requests.ConnectionError('refused'), response]) as mock_request:
+            self.assertIs(api.send('GET', '/action/package_search'), response)
+
+        self.assertEqual(mock_request.call_count, 2)
+        mock_sleep.assert_called_once()
+        # The replicas aren't retried by the adapter as well
+        self.assertEqual(api.client.get_adapter('http://read-1/api/action/package_search').max_retries.total, 0)
+        self.assertEqual(api.client.get_adapter('https://write/api/action/package_update').max_retries.total, 3)
+
+    @mock.patch('dedupe.ckan_api.time.sleep')
+    def test_connection_error_to_api_url_not_retried_again(self, mock_sleep):
+        api = CkanApiClient('https://write', 'api-key-abc')
+
+        with mock.patch.object(api.client, 'request', side_effect=requests.ConnectionError('refused')) as mock_request:
+            with self.assertRaises(requests.ConnectionError):
+                api.send('GET', '/action/package_search')
+
+        # The adapter already retried it with backoff
+        self.assertEqual(mock_request.call_count, 1)
+        mock_sleep.assert_not_called()
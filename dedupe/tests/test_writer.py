@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+import threading
+import unittest
+
+import mock
+
+from ..ckan_api import CkanApiStatusException
+from ..writer import WriteBehind
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.writer = WriteBehind(workers=4, max_pending=10)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_lane_order(self):
+        calls = []
+        release = threading.Event()
+
+        def write(name):
+            def _write():
+                if name == 'a1':
+                    release.wait(5)
+                calls.append(name)
+                return name
+            return _write
+
+        futures = [self.writer.submit('a', write('a1')),
+                   self.writer.submit('a', write('a2')),
+                   self.writer.submit('b', write('b1'))]
+        # b runs while a is still blocked on its first write
+        self.assertEqual(futures[2].result(5), 'b1')
+        release.set()
+        self.assertEqual([future.result(5) for future in futures], ['a1', 'a2', 'b1'])
+        self.assertEqual(calls, ['b1', 'a1', 'a2'])
+
+    @mock.patch('dedupe.writer.time.sleep')
+    def test_retry_transient_status(self, mock_sleep):
+        fn = mock.Mock(side_effect=[
+            CkanApiStatusException('unavailable', mock.Mock(status_code=503)),
+            'ok',
+        ])
+        on_success = mock.Mock()
+
+        self.assertEqual(self.writer.submit('a', fn, on_success).result(5), 'ok')
+        self.assertEqual(fn.call_count, 2)
+        on_success.assert_called_once_with('ok')
+        mock_sleep.assert_called_once()
+
+    def test_failure_callback(self):
+        error = CkanApiStatusException('not found', mock.Mock(status_code=404))
+        fn = mock.Mock(side_effect=error)
+        on_success = mock.Mock()
+        on_failure = mock.Mock()
+
+        future = self.writer.submit('a', fn, on_success, on_failure)
+        with self.assertRaises(CkanApiStatusException):
+            future.result(5)
+        # Not a transient error, so no retry
+        self.assertEqual(fn.call_count, 1)
+        on_success.assert_not_called()
+        on_failure.assert_called_once_with(error)
+
+        # The lane keeps going after a failure
+        self.assertEqual(self.writer.submit('a', lambda: 'next').result(5), 'next')
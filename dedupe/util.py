@@ -2,6 +2,8 @@
 Utilities for working with CKAN packages.
 '''
 
+import hashlib
+
 
 def get_package_extra(package, key, default=None):
     '''
@@ -26,3 +28,32 @@ def set_package_extra(package, key, value=None):
         extras.append(dict(key=key, value=value))
 
     package['extras'] = extras
+
+
+def parse_shard(value):
+    '''
+    Parses a shard spec like "2/4" into (2, 4). Shards are numbered from 1.
+    '''
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError('Shard must look like K/N, got %r' % value)
+
+    if not 1 <= index <= count:
+        raise ValueError('Shard K/N must have 1 <= K <= N, got %r' % value)
+
+    return index, count
+
+
+def in_shard(key, shard):
+    '''
+    Returns True if the key belongs to the (index, count) shard. Uses md5
+    rather than hash() so every process and machine agrees on the partition.
+    A shard of None matches everything.
+    '''
+    if shard is None:
+        return True
+
+    index, count = shard
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count == index - 1
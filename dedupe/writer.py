@@ -0,0 +1,116 @@
+"""
+Write-behind queue for CKAN writes. dataset_purge and package_update are the
+slowest calls we make, so the deduper queues them here and moves on to
+reading the next duplicate group while a pool of threads works through them.
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import logging
+import threading
+import time
+
+from .ckan_api import CkanApiStatusException
+from .ratelimit import RETRY_STATUSES, retry_delay
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_PENDING = 200
+
+
+class WriteBehind(object):
+    """
+    Runs queued writes on a bounded pool of threads.
+
+    Every write belongs to a lane, e.g. one duplicate group. Writes in the
+    same lane run one after another in the order they were queued, so a
+    group's collection members are re-pointed before its duplicate is purged
+    and the retained package is committed last. Different lanes run
+    concurrently.
+
+    Writes failing with a transient status (429/5xx) are retried with
+    backoff. on_success and on_failure callbacks run on the worker once the
+    write is confirmed or has finally failed, before the lane's next write.
+
+    submit() blocks while `max_pending` writes are queued, so a fast reader
+    can't run arbitrarily far ahead of the writes.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING, max_retries=3):
+        self.max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # Writes waiting behind the one running, for each busy lane
+        self._lanes = {}
+
+    def submit(self, lane, fn, on_success=None, on_failure=None, retry=True):
+        """
+        Queues fn() to run after the writes already queued in the lane.
+        Returns a Future for its result. With retry=False, fn is called once
+        and is expected to retry its own writes, see retry().
+        """
+        self._slots.acquire()
+        task = (fn, on_success, on_failure, retry, Future())
+        with self._lock:
+            if lane in self._lanes:
+                self._lanes[lane].append(task)
+                return task[4]
+            self._lanes[lane] = deque()
+
+        self._executor.submit(self._run_lane, lane, task)
+        return task[4]
+
+    def close(self):
+        """
+        Waits for every queued write to finish.
+        """
+        self._executor.shutdown(wait=True)
+
+    def _run_lane(self, lane, task):
+        while task is not None:
+            fn, on_success, on_failure, retry, future = task
+            try:
+                result = self.retry(fn) if retry else fn()
+                if on_success is not None:
+                    on_success(result)
+            except Exception as exc:
+                if on_failure is not None:
+                    try:
+                        on_failure(exc)
+                    except Exception:
+                        log.exception("Write failure callback failed")
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+            finally:
+                self._slots.release()
+
+            with self._lock:
+                queue = self._lanes[lane]
+                if queue:
+                    task = queue.popleft()
+                else:
+                    del self._lanes[lane]
+                    task = None
+
+    def retry(self, fn):
+        """
+        Calls fn(), retrying it with backoff while it fails with a transient
+        status.
+        """
+        for attempt in itertools.count():
+            try:
+                return fn()
+            except CkanApiStatusException as exc:
+                status = getattr(exc.response, "status_code", None)
+                if status not in RETRY_STATUSES or attempt >= self.max_retries:
+                    raise
+
+                delay = retry_delay(attempt)
+                log.warning("Retrying write status=%d attempt=%d delay=%.1f", status, attempt + 1, delay)
+                time.sleep(delay)
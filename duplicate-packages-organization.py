@@ -1,16 +1,19 @@
 from __future__ import absolute_import
 
 import argparse
+import asyncio
 import csv
-import itertools
 import logging
 import logging.config
-import os
+import signal
 import sys
-import time
 from datetime import datetime
 
+from dedupe.async_ckan_api import DEFAULT_CONCURRENCY, AsyncCkanApiClient
+from dedupe.audit import AuditFile
+from dedupe.cache import DEFAULT_MAX_BYTES, ReadCache
 from dedupe.ckan_api import CkanApiClient
+from dedupe import metrics, ratelimit
 
 
 class OrgDuplicateLog(object):
@@ -31,7 +34,7 @@ class OrgDuplicateLog(object):
             filename = "org-duplicates-%s.csv" % run_id
 
         log.info("Opening duplicate package report for writing filename=%s", filename)
-        self.__f = open(filename, mode="w")
+        self.__f = AuditFile(open(filename, mode="w"))
         self.log = csv.DictWriter(self.__f, fieldnames=OrgDuplicateLog.fieldnames)
         self.log.writeheader()
 
@@ -51,9 +54,8 @@ class OrgDuplicateLog(object):
             }
         )
 
-        # Persist the write to disk
-        self.__f.flush()
-        os.fsync(self.__f.fileno())
+    def close(self):
+        self.__f.close()
 
 
 class HarvestDuplicateLog(object):
@@ -75,7 +77,7 @@ class HarvestDuplicateLog(object):
             filename = "harvest-duplicates-%s.csv" % run_id
 
         log.info("Opening duplicate package report for writing filename=%s", filename)
-        self.__f = open(filename, mode="w")
+        self.__f = AuditFile(open(filename, mode="w"))
         self.log = csv.DictWriter(self.__f, fieldnames=HarvestDuplicateLog.fieldnames)
         self.log.writeheader()
 
@@ -96,9 +98,8 @@ class HarvestDuplicateLog(object):
             }
         )
 
-        # Persist the write to disk
-        self.__f.flush()
-        os.fsync(self.__f.fileno())
+    def close(self):
+        self.__f.close()
 
 
 logging.basicConfig(
@@ -109,7 +110,6 @@ log.setLevel(logging.INFO)
 
 # Define module-level context for signal handling
 stopped = False
-deduper = None
 
 
 def get_org_list(ckan):
@@ -128,19 +128,127 @@ def get_harvest_sources(ckan):
     return harvest_sources_list
 
 
+async def get_duplicate_overview(ckan_api, filter_query, total):
+    """
+    Counts the duplicates matching the filter, with one facet query for
+    both identifier types. Returns None once the run is stopped.
+    """
+    if stopped:
+        return None
+
+    duplicates = {}
+    # Fewer than two datasets can't have duplicates
+    if total >= 2:
+        facets = await ckan_api.get_duplicate_facets(filter_query)
+        duplicates = {**facets["identifier"], **facets["guid"]}
+    count = 0
+
+    for dupe_cnt in duplicates.values():
+        count += dupe_cnt - 1
+
+    return {
+        "number_datasets_duplicated": len(duplicates),
+        "total_duplicate_count": count,
+        "total_datasets": total,
+        "percent_duplicate": round(
+            float(count) / (total if total > 0 else 1) * 100, 2
+        ),
+    }
+
+
+async def get_org_overview(ckan_api, organization, total):
+    log.info("Checking org=%s", organization)
+    overview = await get_duplicate_overview(
+        ckan_api, ckan_api.organization_filter_query(organization, False), total
+    )
+    if overview is None:
+        return None
+    return dict(overview, title="", name=organization)
+
+
+async def get_harvest_overview(ckan_api, harvest_source, total):
+    log.info("Checking harvest source=%s", harvest_source["title"])
+    overview = await get_duplicate_overview(
+        ckan_api,
+        ckan_api.harvest_source_filter_query(harvest_source["title"], False),
+        total,
+    )
+    if overview is None:
+        return None
+    return dict(
+        overview,
+        harvest_name=harvest_source["title"],
+        org_name=harvest_source["organization"]["title"],
+    )
+
+
+async def get_org_overviews(
+    api_url, org_list, concurrency, cache=None, api_metrics=None, read_limiter=None
+):
+    """
+    Gets the dataset totals of every organization from one facet query, then
+    fans out one query per organization for its duplicate identifier and
+    guid facets, keeping up to `concurrency` requests in flight. Overviews
+    are returned in org_list order.
+    """
+    async with AsyncCkanApiClient(
+        api_url,
+        None,
+        concurrency=concurrency,
+        cache=cache,
+        metrics=api_metrics,
+        read_limiter=read_limiter,
+    ) as ckan_api:
+        totals = await ckan_api.get_organization_totals()
+        return await asyncio.gather(
+            *[
+                get_org_overview(ckan_api, organization, totals.get(organization, 0))
+                for organization in org_list
+            ]
+        )
+
+
+async def get_harvest_overviews(
+    api_url,
+    harvest_sources,
+    concurrency,
+    cache=None,
+    api_metrics=None,
+    read_limiter=None,
+):
+    """
+    Same as get_org_overviews, for harvest sources: one facet query for the
+    totals of every source, then one per source with at least two datasets.
+    """
+    async with AsyncCkanApiClient(
+        api_url,
+        None,
+        concurrency=concurrency,
+        cache=cache,
+        metrics=api_metrics,
+        read_limiter=read_limiter,
+    ) as ckan_api:
+        totals = await ckan_api.get_harvest_source_totals()
+        return await asyncio.gather(
+            *[
+                get_harvest_overview(
+                    ckan_api, harvest_source, totals.get(harvest_source["title"], 0)
+                )
+                for harvest_source in harvest_sources
+            ]
+        )
+
+
 def cleanup(signum, frame):
-    global deduper, stopped
-    log.warning("Stopping any in-progress dedupers...")
+    global stopped
+    log.warning("Stopping, the reports written so far will be synced...")
     stopped = True
-    deduper.stop()
 
 
 def run():
     """
     This code for getting the list of organizations and duplicate duplicate data sets
     """
-    global deduper, stopped
-
     parser = argparse.ArgumentParser(
         description="Detects and removes duplicate packages on "
         "data.gov. By default, duplicates are detected but not "
@@ -170,6 +278,40 @@ def run():
     parser.add_argument(
         "--harvest_sources", action="store_true", help="Get counts by harvest source"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Maximum number of API requests in flight at once.",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="Path to an on-disk cache of API responses, reused across runs.",
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=DEFAULT_MAX_BYTES // (1024 * 1024),
+        help="Evict least recently used cache entries past this size.",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10,
+        help="Maximum API requests per second. The client adapts below this, "
+        "backing off when the server throttles or slows down.",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        default=None,
+        help="Write per-endpoint API request metrics to this JSON file.",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        default=None,
+        help="Write per-endpoint API request metrics to this Prometheus textfile.",
+    )
 
     args = parser.parse_args()
 
@@ -181,98 +323,81 @@ def run():
 
     log.info("run_id=%s", args.run_id)
 
-    ckan_api = CkanApiClient(args.api_url, "None", identifier_type="identifier")
-    ckan_geo_api = CkanApiClient(args.api_url, "None", identifier_type="guid")
+    cache = None
+    if args.cache:
+        cache = ReadCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    api_metrics = metrics.ApiMetrics()
+    # The blocking and asyncio clients share the read budget
+    read_limiter = ratelimit.read_limiter(args.rate)
+    ckan_api = CkanApiClient(
+        args.api_url,
+        "None",
+        cache=cache,
+        metrics=api_metrics,
+        read_limiter=read_limiter,
+    )
 
     log.info("Using api=%s", args.api_url)
 
-    if args.harvest_sources:
-        # Get and organize by harvest source
-        harvest_log = HarvestDuplicateLog(run_id=args.run_id)
-        harvest_sources = get_harvest_sources(ckan_api)
-
-        log.info("Checking %d harvest sources for duplicates", len(harvest_sources))
-
-        # Loop over the harvest sources one at a time
-        count = itertools.count(start=1)
-        for s in harvest_sources:
-            if stopped:
-                break
-            log.info("Checking harvest source=%s", s["title"])
-            total = ckan_api.get_harvest_source_count(s["title"])
-
-            json_duplicates = ckan_api.get_duplicate_identifiers_source(
-                s["title"], False, full_count=True
+    # Setup signal handlers
+    signal.signal(signal.SIGTERM, cleanup)
+    signal.signal(signal.SIGINT, cleanup)
+
+    report_log = None
+    try:
+        if args.harvest_sources:
+            # Get and organize by harvest source
+            report_log = harvest_log = HarvestDuplicateLog(run_id=args.run_id)
+            harvest_sources = get_harvest_sources(ckan_api)
+
+            log.info("Checking %d harvest sources for duplicates", len(harvest_sources))
+
+            harvest_overviews = asyncio.run(
+                get_harvest_overviews(
+                    args.api_url,
+                    harvest_sources,
+                    args.concurrency,
+                    cache,
+                    api_metrics,
+                    read_limiter,
+                )
             )
-            geo_duplicates = ckan_geo_api.get_duplicate_identifiers_source(
-                s["title"], False, full_count=True
-            )
-            duplicates = {**json_duplicates, **geo_duplicates}
-            count = 0
-
-            for dupe_cnt in duplicates.values():
-                count += dupe_cnt - 1
-
-            harvest_source_overview = {
-                "harvest_name": s["title"],
-                "org_name": s["organization"]["title"],
-                "number_datasets_duplicated": len(duplicates),
-                "total_duplicate_count": count,
-                "total_datasets": total,
-                "percent_duplicate": round(
-                    float(count) / (total if total > 0 else 1) * 100, 2
-                ),
-            }
+            for harvest_overview in harvest_overviews:
+                if harvest_overview is not None:
+                    harvest_log.add(harvest_overview)
 
-            harvest_log.add(harvest_source_overview)
-            time.sleep(1)
-
-    else:
-        # Get and organize by org
-        org_log = OrgDuplicateLog(run_id=args.run_id)
-
-        if args.organization_name:
-            org_list = args.organization_name
         else:
-            # get all organizations that have datajson harvester
-            org_list = get_org_list(ckan_api)
-
-        log.info("Checking %d organizations for duplicates", len(org_list))
-
-        # Loop over the organizations one at a time
-        count = itertools.count(start=1)
-        for organization in org_list:
-            if stopped:
-                break
-            log.info("Checking org=%s", organization)
-            total = ckan_api.get_organization_count(organization)
-
-            json_duplicates = ckan_api.get_duplicate_identifiers(
-                organization, False, full_count=True
-            )
-            geo_duplicates = ckan_geo_api.get_duplicate_identifiers(
-                organization, False, full_count=True
+            # Get and organize by org
+            report_log = org_log = OrgDuplicateLog(run_id=args.run_id)
+
+            if args.organization_name:
+                org_list = args.organization_name
+            else:
+                # get all organizations that have datajson harvester
+                org_list = get_org_list(ckan_api)
+
+            log.info("Checking %d organizations for duplicates", len(org_list))
+
+            org_overviews = asyncio.run(
+                get_org_overviews(
+                    args.api_url,
+                    org_list,
+                    args.concurrency,
+                    cache,
+                    api_metrics,
+                    read_limiter,
+                )
             )
-            # duplicates = json_duplicates.copy()
-            # duplicates.update(geo_duplicates)
-            duplicates = {**json_duplicates, **geo_duplicates}
-            count = 0
-
-            for dupe_cnt in duplicates.values():
-                count += dupe_cnt - 1
-
-            org_overview = {
-                "title": "",
-                "name": organization,
-                "number_datasets_duplicated": len(duplicates),
-                "total_duplicate_count": count,
-                "total_datasets": total,
-                "percent_duplicate": round(
-                    float(count) / (total if total > 0 else 1) * 100, 2
-                ),
-            }
-
-            org_log.add(org_overview)
+            for org_overview in org_overviews:
+                if org_overview is not None:
+                    org_log.add(org_overview)
+    finally:
+        if report_log:
+            # Sync whatever is left in the report, even when stopping
+            report_log.close()
+
+    metrics.dump(api_metrics, args.metrics_json, args.metrics_textfile)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,6 @@
-
 from __future__ import absolute_import
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import itertools
 import logging
@@ -8,10 +8,18 @@ import logging.config
 import os
 import signal
 import sys
+import threading
 
-from dedupe.audit import DuplicatePackageLog, RemovedPackageLog
-from dedupe.ckan_api import CkanApiClient
+from dedupe.archive import PackageArchive
+from dedupe.audit import DEFAULT_SYNC_EVERY, DEFAULT_SYNC_INTERVAL, DuplicatePackageLog, RemovedPackageLog
+from dedupe.audit_store import AuditStore
+from dedupe.cache import DEFAULT_MAX_BYTES, ReadCache
+from dedupe.ckan_api import CkanApiClient, CkanApiStatusException
 from dedupe.deduper import Deduper
+from dedupe.journal import Journal
+from dedupe.plan import PlanWriter, read_plan
+from dedupe.writer import WriteBehind
+from dedupe import metrics, ratelimit, util
 
 logging.basicConfig(stream=sys.stdout, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
 log = logging.getLogger('dedupe')
@@ -19,7 +27,8 @@ log.setLevel(logging.INFO)
 
 # Define module-level context for signal handling
 stopped = False
-deduper = None
+dedupers = set()
+dedupers_lock = threading.Lock()
 
 
 def get_org_list(ckan):
@@ -30,33 +39,56 @@ def get_org_list(ckan):
     return organizations_list
 
 
-def cleanup(signum, frame):
-    global deduper, stopped
+def stop_dedupers():
+    global stopped
     log.warning('Stopping any in-progress dedupers...')
     stopped = True
-    deduper.stop()
+    with dedupers_lock:
+        for deduper in dedupers:
+            deduper.stop()
+
+
+def cleanup(signum, frame):
+    stop_dedupers()
+
+
+def log_summary(summary):
+    '''
+    Logs the outcome of each organization. Counts are None for organizations
+    that were stopped or failed before they finished.
+    '''
+    for organization, duplicate_count in sorted(summary.items()):
+        if duplicate_count is None:
+            log.warning('Summary organization=%s incomplete', organization)
+        else:
+            log.info('Run summary organization=%s duplicate_count=%d', organization, duplicate_count)
+
+    log.info('Summary organizations=%d duplicate_count=%d', len(summary),
+             sum(count for count in summary.values() if count))
 
 
 def run():
     '''
     This code for getting the list of organizations and duplicate duplicate data sets
     '''
-    global deduper, stopped
-
     parser = argparse.ArgumentParser(description='Detects and removes duplicate packages on '
                                      'data.gov. By default, duplicates are detected but not '
                                      'actually removed.')
     parser.add_argument('--api-key', default=os.getenv('CKAN_API_KEY', None), help='Admin API key')
     parser.add_argument('--api-url', default='https://catalog-prod-admin-datagov.app.cloud.gov',
                         help='The API base URL to query')
-    parser.add_argument('--api-read-url', default=None,
-                        help='The API base URL to query read-only info, for faster processing')
+    parser.add_argument('--api-read-url', default=None, action='append',
+                        help='The API base URL to query read-only info, for faster processing. '
+                             'Repeat to balance reads across several read-only replicas.')
     parser.add_argument('--commit', action='store_true',
                         help='Treat the API as writeable and commit the changes.')
     parser.add_argument('--newest', action='store_true',
                         help='Keep the newest dataset and remove older ones (default keeps oldest)')
     parser.add_argument('--reverse', action='store_true',
-                        help='Reverse the order of ids to parse (for running with another script in parallel)')
+                        help='Reverse the order of ids to parse')
+    parser.add_argument('--shard', type=util.parse_shard, default=None,
+                        help='Only deduplicate the K-th of N hash partitions of the duplicate identifiers, '
+                             'as K/N. Run N processes with 1/N through N/N to split the work with no overlap.')
     parser.add_argument('--update-name', action='store_true',
                         help=('Update the name of the kept package to be the standard shortest name, '
                               'whether that was the duplicate package name or the to be kept package name.'))
@@ -70,9 +102,72 @@ def run():
                         help='Names of the organizations to deduplicate.')
     parser.add_argument('--geospatial', action='store_true',
                         help='If the organization has geospatial metadata that should be de-duped')
+    parser.add_argument('--grouped', action='store_true',
+                        help='Fetch all duplicate groups for an organization in a few large pages '
+                             'instead of querying each identifier separately.')
+    parser.add_argument('--projection', action='store_true',
+                        help='Only request the package fields the deduper reads from searches, '
+                             'fetching full packages right before they are written.')
+    parser.add_argument('--cache', default=None,
+                        help='Path to an on-disk cache of read-only API responses, reused across runs.')
+    parser.add_argument('--cache-max-mb', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='Evict least recently used cache entries past this size.')
+    parser.add_argument('--metrics-json', default=None,
+                        help='Write per-endpoint API request metrics to this JSON file at the end of the run.')
+    parser.add_argument('--metrics-textfile', default=None,
+                        help='Write per-endpoint API request metrics to this Prometheus textfile.')
+    parser.add_argument('--read-rate', type=float, default=20,
+                        help='Maximum read requests per second. The client adapts below this, '
+                             'backing off when the server throttles or slows down.')
+    parser.add_argument('--write-rate', type=float, default=5,
+                        help='Maximum write requests per second to the read-write API.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of organizations to deduplicate at once, each with its own '
+                             'deduper and API session.')
+    parser.add_argument('--identifier-workers', type=int, default=1,
+                        help='Number of duplicate identifiers to deduplicate at once within each organization.')
+
+    parser.add_argument('--plan', default=None,
+                        help='Write the changes a run would make to this plan file (JSON lines) '
+                             'instead of making them.')
+    parser.add_argument('--apply', default=None,
+                        help='Make the changes recorded in a plan file, instead of searching for '
+                             'duplicates. Groups that changed since they were planned are skipped.')
+    parser.add_argument('--journal', default=None,
+                        help='Path to a local journal of finished duplicate groups. Re-run with the same '
+                             '--run-id and journal to resume an interrupted run without redoing them.')
+    parser.add_argument('--no-mark', action='store_true',
+                        help='Don\'t record the run on retained packages (datagov_dedupe_retained), '
+                             'relying on --journal instead. Retained packages are then only updated '
+                             'to rename them.')
+    parser.add_argument('--write-workers', type=int, default=0,
+                        help='Queue purges and updates on this many background threads, so reads of the '
+                             'next duplicate groups overlap with them. By default writes are made inline.')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='Fetch the duplicate groups of this many identifiers ahead while the current '
+                             'one is deduplicated.')
+    parser.add_argument('--archive', default=None,
+                        help='Append removed packages to this compressed, indexed archive instead of a '
+                             'removed-packages log. See removed-packages-archive.py to look them up.')
+    parser.add_argument('--audit-db', default=None,
+                        help='Record duplicate and removed packages in this SQLite database, shared across '
+                             'runs and indexed for lookups, instead of per-run report and log files. '
+                             'Export them with python -m dedupe.audit_store.')
+    parser.add_argument('--audit-sync-every', type=int, default=DEFAULT_SYNC_EVERY,
+                        help='Fsync the audit logs after this many records, or with --audit-db, insert '
+                             'them in batches of this many. They are always synced before a package is purged.')
+    parser.add_argument('--audit-sync-ms', type=int, default=int(DEFAULT_SYNC_INTERVAL * 1000),
+                        help='Fsync the audit logs at least this often, in milliseconds. With --audit-db, '
+                             'buffered records are inserted with the next record added after this long.')
 
     args = parser.parse_args()
 
+    if args.plan and (args.commit or args.apply):
+        parser.error('--plan only records changes, it cannot be used with --commit or --apply')
+
+    if args.no_mark and not args.journal:
+        parser.error('--no-mark needs a --journal to resume from')
+
     if args.verbose:
         log.setLevel(logging.DEBUG)
 
@@ -86,15 +181,44 @@ def run():
     identifier_type = 'guid' if args.geospatial else 'identifier'
 
     log.info('run_id=%s', args.run_id)
+    if args.shard:
+        log.info('shard=%d/%d', *args.shard)
+    cache = None
+    if args.cache:
+        cache = ReadCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    api_metrics = metrics.ApiMetrics()
+    read_limiter = ratelimit.read_limiter(args.read_rate)
+    write_limiter = ratelimit.write_limiter(args.write_rate)
+
+    # The client keeps a requests session per thread, so the organization,
+    # identifier and write-behind threads can all share it.
     ckan_api = CkanApiClient(args.api_url,
                              args.api_key,
                              dry_run=dry_run,
                              identifier_type=identifier_type,
                              api_read_url=args.api_read_url,
-                             reverse=args.reverse)
+                             reverse=args.reverse,
+                             projection=args.projection,
+                             cache=cache,
+                             metrics=api_metrics,
+                             read_limiter=read_limiter,
+                             write_limiter=write_limiter)
 
-    duplicate_package_log = DuplicatePackageLog(api_url=args.api_url, run_id=args.run_id)
-    removed_package_log = RemovedPackageLog(run_id=args.run_id)
+    audit_sync = dict(sync_every=args.audit_sync_every, sync_interval=args.audit_sync_ms / 1000.0)
+    audit_store = None
+    if args.audit_db:
+        audit_store = AuditStore(args.audit_db, args.run_id, batch_size=args.audit_sync_every,
+                                 sync_interval=args.audit_sync_ms / 1000.0)
+        duplicate_package_log = audit_store.duplicate_log(api_url=args.api_url)
+    else:
+        duplicate_package_log = DuplicatePackageLog(api_url=args.api_url, run_id=args.run_id, **audit_sync)
+    if args.archive:
+        removed_package_log = PackageArchive(args.archive, run_id=args.run_id)
+    elif audit_store:
+        removed_package_log = audit_store.removed_log()
+    else:
+        removed_package_log = RemovedPackageLog(run_id=args.run_id, **audit_sync)
 
     # Setup signal handlers
     signal.signal(signal.SIGTERM, cleanup)
@@ -102,19 +226,44 @@ def run():
 
     log.info('Using api=%s', args.api_url)
 
-    if args.organization_name:
+    journal = None
+    if args.journal:
+        journal = Journal(args.journal, args.run_id)
+
+    writer = None
+    if args.write_workers:
+        writer = WriteBehind(workers=args.write_workers)
+
+    plan_writer = None
+    plan_entries = None
+    if args.plan:
+        plan_writer = PlanWriter(args.plan)
+
+    if args.apply:
+        # Plans are compact, so it's fine to hold one in memory to hand each
+        # organization's groups to a worker.
+        plan_entries = {}
+        for entry in read_plan(args.apply):
+            if args.organization_name and entry['organization'] not in args.organization_name:
+                continue
+            if not util.in_shard('%s/%s' % (entry['organization'], entry['identifier']), args.shard):
+                continue
+            plan_entries.setdefault(entry['organization'], []).append(entry)
+        org_list = list(plan_entries)
+    elif args.organization_name:
         org_list = args.organization_name
     else:
         # get all organizations that have datajson harvester
         org_list = get_org_list(ckan_api)
-
+        # Each deduper's own duplicate facet query skips organizations
+        # without duplicates, so there's no separate scan for them.
     log.info('Deduplicating organizations=%d', len(org_list))
 
-    # Loop over the organizations one at a time
     count = itertools.count(start=1)
-    for organization in org_list:
+
+    def dedupe_organization(organization):
         if stopped:
-            break
+            return None
 
         log.info('Deduplicating organization=%s progress=%r',
                  organization, (next(count), len(org_list)))
@@ -126,8 +275,62 @@ def run():
             run_id=args.run_id,
             oldest=not args.newest,
             update_name=args.update_name,
-            identifier_type=identifier_type)
-        deduper.dedupe()
+            identifier_type=identifier_type,
+            grouped=args.grouped,
+            identifier_workers=args.identifier_workers,
+            plan=plan_writer,
+            journal=journal,
+            mark_retained=not args.no_mark,
+            writer=writer,
+            prefetch=args.prefetch,
+            shard=args.shard)
+
+        with dedupers_lock:
+            dedupers.add(deduper)
+        try:
+            if plan_entries is not None:
+                return deduper.apply_plan(plan_entries[organization])
+            return deduper.dedupe()
+        finally:
+            with dedupers_lock:
+                dedupers.discard(deduper)
+
+    summary = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = dict((executor.submit(dedupe_organization, organization), organization)
+                           for organization in org_list)
+            for future in as_completed(futures):
+                organization = futures[future]
+                try:
+                    summary[organization] = future.result()
+                except CkanApiStatusException:
+                    # The API rejected a request outright (e.g. a bad key or
+                    # permissions), so every other organization would fail
+                    # the same way. Stop them and fail the run.
+                    log.exception('Failed to deduplicate organization=%s', organization)
+                    summary[organization] = None
+                    stop_dedupers()
+                    raise
+                except Exception:
+                    # Organizations are independent, keep going with the rest
+                    log.exception('Failed to deduplicate organization=%s', organization)
+                    summary[organization] = None
+    finally:
+        if writer:
+            # Let the queued writes finish, even when stopping
+            writer.close()
+        # Sync whatever is left in the audit logs
+        duplicate_package_log.close()
+        removed_package_log.close()
+        if audit_store:
+            audit_store.close()
+        log_summary(summary)
+        if plan_writer:
+            plan_writer.close()
+        if journal:
+            journal.close()
+        metrics.dump(api_metrics, args.metrics_json, args.metrics_textfile)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import itertools
 import logging
 import logging.config
 import json
 import sys
-import time
 
 logFormatter = logging.Formatter("%(asctime)s [%(name)s] %(levelname)s: %(message)s")
 log = logging.getLogger('dedupe')
@@ -15,7 +16,75 @@ consoleHandler.setFormatter(logFormatter)
 log.addHandler(consoleHandler)
 log.setLevel(logging.INFO)
 
-from dedupe.ckan_api import CkanApiClient, CkanApiStatusException
+from dedupe.ckan_api import CkanApiClient
+from dedupe import ratelimit
+
+# package_list has every type of package (datasets, harvest sources, ...), so
+# the bulk comparison searches SOLR for every type too. Naming dataset_type
+# keeps CKAN from adding its default dataset_type:dataset filter.
+ALL_TYPES_FILTER_QUERY = '+dataset_type:*'
+
+
+def iter_org_datasets(ckan_api, org_list):
+    for organization in org_list:
+        log.info(f"Listing {organization}'s datasets")
+        yield from ckan_api.iter_datasets(f'type:dataset AND organization:"{organization}"', stream=True)
+
+
+def read_dump_names(filename):
+    '''
+    Streams the package names from a CKAN dump file, one JSON package per
+    line (as written by `ckanapi dump datasets`).
+    '''
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)['name']
+
+
+def find_drift(solr_datasets, db_names):
+    '''
+    Compares the SOLR and DB sides by package name, holding the DB names in
+    a set while the SOLR datasets stream past. Returns the datasets only in
+    SOLR and the (sorted) names only in the DB.
+    '''
+    db_names = set(db_names)
+    solr_only = []
+    for d in solr_datasets:
+        if d['name'] in db_names:
+            db_names.discard(d['name'])
+        else:
+            solr_only.append(d)
+    return solr_only, sorted(db_names)
+
+
+def check_datasets(ckan_api, datasets, workers):
+    '''
+    Checks the datasets exist in the DB, `workers` at a time, and yields
+    (dataset, exists) as each check finishes. exists is None when the check
+    failed for another reason than a 404, so we can't tell. Only a couple of
+    checks per worker are queued, so the datasets can be a stream of the
+    whole catalog.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        datasets = iter(datasets)
+        while True:
+            for d in itertools.islice(datasets, 2 * workers - len(pending)):
+                pending[executor.submit(ckan_api.package_exists, d['id'])] = d
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                d = pending.pop(future)
+                try:
+                    exists = future.result()
+                except Exception:
+                    # Not a 404, so we can't tell; keep checking the rest
+                    log.exception(f"Failed to check {d.get('name')}")
+                    exists = None
+                yield d, exists
 
 
 def run():
@@ -24,50 +93,94 @@ def run():
     parser.add_argument('--api-url', default='https://catalog-prod-admin-datagov.app.cloud.gov',
                         help='The API base URL to query')
     parser.add_argument('organization_name', nargs='*',
-                        help='Names of the organizations to evaluate.')
+                        help='Names of the organizations to evaluate. By default the whole catalog is checked.')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Number of datasets to check at once.')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Maximum API requests per second. The client adapts below this, '
+                             'backing off when the server throttles or slows down.')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only check this many datasets, e.g. for a quick sample.')
+    parser.add_argument('--output', default='broken_datasets.jsonld',
+                        help='Write the datasets missing from the DB (not found, or only there as deleted) '
+                             'to this file, one JSON line each.')
+    parser.add_argument('--retry-output', default='failed_datasets.jsonld',
+                        help='Write the datasets that could not be checked to this file, one JSON line each, '
+                             'to check again later.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Compare every package in SOLR with every name in package_list, of every type, '
+                             'and only probe the packages that differ.')
+    parser.add_argument('--db-dump', default=None,
+                        help='With --bulk, read the DB side from this CKAN dump (JSON lines) '
+                             'instead of package_list.')
+    parser.add_argument('--unindexed-output', default='unindexed_datasets.jsonld',
+                        help='With --bulk, write the names in the DB but not in SOLR to this file.')
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Include verbose log output.')
     args = parser.parse_args()
 
     if args.verbose:
         log.setLevel(logging.DEBUG)
-    
-    ckan_api = CkanApiClient(args.api_url, "None")
 
-    ckan_datasets = []
-    broken_datasets = []
-    
+    ckan_api = CkanApiClient(args.api_url, "None", projection=True,
+                             read_limiter=ratelimit.read_limiter(args.rate),
+                             pool_size=max(10, args.workers))
+
+    if args.bulk:
+        if args.organization_name or args.limit:
+            parser.error('--bulk compares the whole catalog, it takes no organizations or --limit')
+
+        if args.db_dump:
+            db_names = read_dump_names(args.db_dump)
+        else:
+            db_names = ckan_api.iter_package_names()
+        solr_datasets = ckan_api.iter_datasets(ALL_TYPES_FILTER_QUERY, fields=['id', 'name'], stream=True)
+        solr_only, db_only = find_drift(solr_datasets, db_names)
+        log.info(f"Found {len(solr_only)} datasets only in SOLR, {len(db_only)} only in the DB")
+
+        # SOLR was read after the DB side, so look the DB-only names up again
+        # to drop the ones indexed in the meantime
+        indexed = ckan_api.find_indexed_names(db_only)
+        db_only = [name for name in db_only if name not in indexed]
+        log.info(f"Confirmed {len(db_only)} datasets only in the DB")
 
-    if args.organization_name:
-        org_list = args.organization_name
+        with open(args.unindexed_output, "w") as output:
+            for name in db_only:
+                output.write(json.dumps({'name': name}) + "\n")
+
+        # package_list is a snapshot, so confirm each one before reporting it
+        ckan_datasets = solr_only
+    elif args.organization_name:
+        ckan_datasets = iter_org_datasets(ckan_api, args.organization_name)
     else:
-        # get all organizations that have datajson harvester
-        org_list = ckan_api.get_organizations()
-    for organization in org_list:
-        start=0
-        rows=1000
-        org_datasets = []
-        while len(org_datasets) % rows == 0:
-            org_datasets += ckan_api.get_all_datasets(start=start, rows=rows, organization=organization)
-            start += rows
-        ckan_datasets += org_datasets
-        log.info(f"Have {organization}'s datasets, {len(org_datasets)}")
-        if len(ckan_datasets) > 20:
-            break
-
-
-    with open("broken_datasets.jsonld", "w") as output:
-        for d in ckan_datasets:
-            # Check if dataset page works/exists
-            try:
-                # time.sleep(1)
-                ckan_api.check_dataset(d.get('id'))
+        ckan_datasets = ckan_api.iter_datasets('type:dataset', stream=True)
+    if args.limit:
+        ckan_datasets = itertools.islice(ckan_datasets, args.limit)
+
+    checked = broken = failed = 0
+    with open(args.output, "w") as output, open(args.retry_output, "w") as retry_output:
+        for d, exists in check_datasets(ckan_api, ckan_datasets, args.workers):
+            checked += 1
+            if exists is None:
+                failed += 1
+                retry_output.write(json.dumps(d) + "\n")
+                retry_output.flush()
+            elif exists:
                 log.debug(f"{d.get('name')} checks out")
-            except CkanApiStatusException:
+            else:
                 log.error(f"{d.get('name')} does not exist")
-                broken_datasets.append(d)
+                broken += 1
                 output.write(json.dumps(d) + ("\n"))
+                # Results can be followed while the check runs
+                output.flush()
+            if checked % 1000 == 0:
+                log.info(f"Checked {checked} datasets, {broken} missing, {failed} failed")
+
+    log.info(f"Checked {checked} datasets, {broken} missing, {failed} failed")
+    if failed:
+        log.error(f"Could not check {failed} datasets, see {args.retry_output}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+import argparse
+import json
+import logging
+import os
+import sys
+
+from dedupe.archive import LOOKUP_FIELDS, ArchiveReader, PackageArchive, import_log, latest_packages, restore_packages
+from dedupe.ckan_api import CkanApiClient
+
+logging.basicConfig(stream=sys.stderr, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+log = logging.getLogger('dedupe')
+log.setLevel(logging.INFO)
+
+
+def lookup_fields(args):
+    return dict((field, getattr(args, field)) for field in LOOKUP_FIELDS if getattr(args, field))
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Looks up and restores packages in a removed '
+                                     'package archive written with --archive.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help='Add removed-packages-*.log files to an archive.')
+    import_parser.add_argument('archive', help='Path to the archive.')
+    import_parser.add_argument('logs', nargs='+', help='Removed package logs to add.')
+    import_parser.add_argument('--run-id', default=None,
+                               help='Record the packages under this run id, to look them up by run.')
+
+    for command, command_help in (('lookup', 'Print matching packages as JSON lines.'),
+                                  ('restore', 'Re-create matching packages in CKAN.')):
+        command_parser = subparsers.add_parser(command, help=command_help)
+        command_parser.add_argument('archive', help='Path to the archive.')
+        command_parser.add_argument('--id', default=None, help='Package id.')
+        command_parser.add_argument('--name', default=None, help='Package name.')
+        command_parser.add_argument('--identifier', default=None, help='Package identifier (or guid).')
+        command_parser.add_argument('--run-id', default=None, help='Every package removed by this run.')
+
+    restore_parser = subparsers.choices['restore']
+    restore_parser.add_argument('--api-key', default=os.getenv('CKAN_API_KEY', None), help='Admin API key')
+    restore_parser.add_argument('--api-url', default='https://catalog-prod-admin-datagov.app.cloud.gov',
+                                help='The API base URL to restore packages to')
+    restore_parser.add_argument('--commit', action='store_true',
+                                help='Treat the API as writeable and actually restore the packages.')
+    restore_parser.add_argument('--workers', type=int, default=4,
+                                help='Number of packages to restore at once.')
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        archive = PackageArchive(args.archive, run_id=args.run_id)
+        try:
+            for filename in args.logs:
+                log.info('Imported packages=%d filename=%s', import_log(archive, filename), filename)
+        finally:
+            archive.close()
+        return
+
+    fields = lookup_fields(args)
+    if not fields:
+        parser.error('give at least one of --id, --name, --identifier or --run-id')
+
+    reader = ArchiveReader(args.archive)
+    try:
+        packages = reader.lookup(**fields)
+    finally:
+        reader.close()
+    log.info('Found packages=%d', len(packages))
+
+    if args.command == 'lookup':
+        for package in packages:
+            sys.stdout.write(json.dumps(package) + '\n')
+        return
+
+    if not args.commit:
+        log.info('Dry-run enabled')
+    ckan_api = CkanApiClient(args.api_url, args.api_key, dry_run=not args.commit, pool_size=max(10, args.workers))
+    packages = latest_packages(packages)
+    failed = restore_packages(ckan_api, packages, workers=args.workers)
+    log.info('Restored packages=%d failed=%d', len(packages) - len(failed), len(failed))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()